@@ -0,0 +1,416 @@
+''' Parts shared by SilentInstaller.py and ScriptedInstaller.py. Runs on Python 2.7, like
+ScriptedInstaller, and on Python 3.
+
+Both installers add their own directory and this directory to their module path, so either keep
+it next to the tsm and tabadmin directories when copying the scripts, or copy this file next to
+the script. '''
+
+from __future__ import print_function
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+
+def version_sort_key(version):
+    ''' Sort key for package versions. Numeric parts compare as numbers, so 20201.20.0913
+    sorts after 2019.4.0 and 10.10 sorts after 10.9. Text parts sort below numbers and below
+    the end of a version, so a leftover directory such as "old", or a pre-release such as
+    10.5-beta, sorts before the releases (10.5). '''
+
+    parts = [(2, int(part), '') if part.isdigit() else (0, 0, part) for part in re.split(r'[.\-_]', version)]
+    return tuple(parts + [(1, 0, '')])
+
+
+def list_directory(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+def find_versioned_binaries(install_dir, binary_name):
+    ''' Returns (version, directory) for every directory of the known layouts that contains the
+    binary, newest version first. The layouts are <install dir>/<version>/bin, used by tabadmin,
+    and <install dir>/packages/bin.<version>, used by tsm. '''
+
+    candidates = []
+    for entry in list_directory(install_dir):
+        candidates.append((entry, os.path.join(install_dir, entry, 'bin')))
+    packages_dir = os.path.join(install_dir, 'packages')
+    for entry in list_directory(packages_dir):
+        if entry.startswith('bin.'):
+            candidates.append((entry[len('bin.'):], os.path.join(packages_dir, entry)))
+    found = [candidate for candidate in candidates if os.path.isfile(os.path.join(candidate[1], binary_name))]
+    found.sort(key=lambda candidate: version_sort_key(candidate[0]), reverse=True)
+    return found
+
+
+def binaries_version(directory):
+    ''' The version of a binaries directory found outside the known layouts, taken from its name
+    like the layouts do: the parent of a bin directory, or what follows bin. '''
+
+    name = os.path.basename(os.path.normpath(directory))
+    if name.lower() == 'bin':
+        return os.path.basename(os.path.dirname(os.path.normpath(directory)))
+    if name.startswith('bin.'):
+        return name[len('bin.'):]
+    return name
+
+
+def read_binaries_index(index_path):
+    ''' The binaries index, or an empty one if it is missing or damaged; the next search
+    rebuilds it '''
+
+    try:
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+    except (IOError, OSError, ValueError):
+        return {}
+    return index if isinstance(index, dict) else {}
+
+
+def write_binaries_index(index_path, index):
+    try:
+        with open(index_path, 'w') as index_file:
+            json.dump(index, index_file, indent=2, sort_keys=True)
+    except (IOError, OSError) as ex:
+        print('Could not write the binaries index %s: %s' % (index_path, str(ex)), file=sys.stderr)
+
+
+def find_binaries_directory(install_dir, binary_name, index_path, write_index=True):
+    ''' The directory of the newest binary under the installation directory, or None. Looks in
+    the known layouts first, then in the binaries index at index_path, and only searches the
+    whole installation directory if neither has it. A directory found by that search is added
+    to the index, so that a non-standard layout only has to be searched once, unless
+    write_index is False, e.g. for a plan that must not change anything. '''
+
+    found = find_versioned_binaries(install_dir, binary_name)
+    if found:
+        return found[0][1]
+
+    index_key = os.path.normcase(os.path.abspath(install_dir))
+    index = read_binaries_index(index_path)
+    entry = index.get(index_key)
+    if isinstance(entry, dict) and os.path.isfile(os.path.join(str(entry.get('path')), binary_name)):
+        return entry['path']
+
+    print('%s not found in the usual places; searching %s' % (binary_name, install_dir))
+    for root, dirs, files in os.walk(install_dir):
+        if binary_name in files:
+            if write_index:
+                index[index_key] = {'version': binaries_version(root), 'path': root}
+                write_binaries_index(index_path, index)
+            return root
+    return None
+
+
+def process_time():
+    ''' CPU time of this process, all threads '''
+    if hasattr(time, 'process_time'):
+        return time.process_time()
+    return sum(os.times()[:2])
+
+
+class InstallTrace(object):
+    ''' Records timing spans for the logical installation steps and for every external command.
+    Each finished span is appended to a json lines trace file, and all spans can be exported in
+    the Chrome trace event format (chrome://tracing, Perfetto). Until open() is called, spans
+    are only kept in memory. '''
+
+    def __init__(self):
+        self.path = None
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.origin = time.time()
+
+    def open(self, path):
+        self.path = path
+        open(path, 'w').close()
+
+    def current_step(self):
+        return getattr(self.local, 'step', None)
+
+    def record(self, span):
+        with self.lock:
+            self.spans.append(span)
+            if self.path is None:
+                return
+            with open(self.path, 'a') as trace_file:
+                trace_file.write(json.dumps(span) + '\n')
+
+    def span(self, name, kind='step', **fields):
+        ''' A context manager timing a logical step '''
+        return TraceSpan(self, name, kind, fields)
+
+    def command(self, command, exit_code, started, wall_time, cpu_time, peak_rss):
+        ''' Records one finished external command '''
+        self.record({
+            'kind': 'command',
+            'step': self.current_step(),
+            'command': command,
+            'exitCode': exit_code,
+            'start': started,
+            'wallTime': round(wall_time, 3),
+            'cpuTime': None if cpu_time is None else round(cpu_time, 3),
+            'peakRss': peak_rss,
+            'thread': threading.current_thread().name
+        })
+
+    def retry(self, command, attempt, exit_code, reason, delay):
+        ''' Records a failed attempt of a command that is retried, timed as the wait before the retry '''
+        self.record({
+            'kind': 'retry',
+            'name': 'retry ' + command,
+            'step': self.current_step(),
+            'command': command,
+            'attempt': attempt,
+            'exitCode': exit_code,
+            'reason': reason,
+            'start': time.time(),
+            'wallTime': round(delay, 3),
+            'thread': threading.current_thread().name
+        })
+
+    def export_chrome(self, path):
+        ''' Writes all spans as complete ("X") events of the Chrome trace event format '''
+        threads = {}
+        events = []
+        for span in self.spans:
+            tid = threads.setdefault(span['thread'], len(threads) + 1)
+            name = span.get('name') or os.path.basename(str(span['command']).split(' ')[0])
+            args = dict((key, value) for key, value in span.items() if key not in ('start', 'wallTime', 'thread'))
+            events.append({'name': name, 'cat': span['kind'], 'ph': 'X', 'pid': 1, 'tid': tid,
+                'ts': int((span['start'] - self.origin) * 1e6), 'dur': int(span['wallTime'] * 1e6), 'args': args})
+        for thread_name, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': thread_name}})
+        with open(path, 'w') as chrome_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, chrome_file)
+
+    def close(self):
+        ''' Exports the Chrome trace next to the json lines trace file '''
+        if self.path is not None:
+            chrome_path = os.path.splitext(self.path)[0] + '.chrome.json'
+            self.export_chrome(chrome_path)
+            print('Install trace written to %s and %s' % (self.path, chrome_path))
+
+
+class TraceSpan(object):
+    def __init__(self, trace, name, kind, fields):
+        self.trace = trace
+        self.name = name
+        self.kind = kind
+        self.fields = fields
+
+    def __enter__(self):
+        self.started = time.time()
+        self.cpu_started = process_time()
+        self.outer_step = self.trace.current_step()
+        if self.kind == 'step':
+            self.trace.local.step = self.name
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.trace.local.step = self.outer_step
+        span = {
+            'kind': self.kind,
+            'name': self.name,
+            'step': self.outer_step,
+            'start': self.started,
+            'wallTime': round(time.time() - self.started, 3),
+            # CPU time of this script (all threads) while the span was open
+            'cpuTime': round(process_time() - self.cpu_started, 3),
+            'error': None if exc_value is None else str(exc_value),
+            'thread': threading.current_thread().name
+        }
+        span.update(self.fields)
+        self.trace.record(span)
+        return False
+
+
+class StepScheduler(object):
+    ''' Runs install steps as a dependency graph. A step starts as soon as all the steps it
+    depends on have finished, so independent steps run at the same time on worker threads.
+    Dependencies on steps that were not added are ignored. An installer subclasses it to trace
+    its steps, to describe them in a plan, and to choose how their threads are started. '''
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.steps = []
+        self.functions = {}
+        self.dependencies = {}
+        self.results = {}
+        self.started = {}
+        self.finished = {}
+        self.descriptions = {}
+
+    def add(self, name, function, args=(), depends_on=(), description=None):
+        self.steps.append(name)
+        self.functions[name] = (function, args)
+        self.dependencies[name] = list(depends_on)
+        self.descriptions[name] = description or self.describe(function, args)
+
+    def describe(self, function, args):
+        ''' A short description of what a step runs, shown in the plan '''
+        return getattr(function, '__name__', str(function)).replace('_', ' ')
+
+    def span(self, name):
+        ''' A context manager around the run of a step, such as a span of the install trace '''
+        return NoSpan()
+
+    def start_thread(self, target, args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        ''' Runs all steps. If a step fails, no new steps are started, and the first
+        error is raised once the running steps have finished. '''
+        condition = threading.Condition()
+        pending = [name for name in self.steps]
+        done = set()
+        errors = []
+        running = [0]
+
+        def is_ready(name):
+            return all(dependency in done or dependency not in self.functions for dependency in self.dependencies[name])
+
+        def run_step(name):
+            function, args = self.functions[name]
+            try:
+                with self.span(name):
+                    self.results[name] = function(*args)
+            except Exception as ex:
+                with condition:
+                    errors.append(ex)
+            finally:
+                with condition:
+                    self.finished[name] = time.time()
+                    done.add(name)
+                    running[0] -= 1
+                    condition.notify_all()
+
+        with condition:
+            while True:
+                for name in [name for name in pending if is_ready(name)]:
+                    if errors or running[0] >= self.max_workers:
+                        break
+                    pending.remove(name)
+                    running[0] += 1
+                    self.started[name] = time.time()
+                    self.start_thread(run_step, (name,))
+                if running[0] == 0:
+                    break
+                condition.wait()
+
+        if errors:
+            raise errors[0]
+        if pending:
+            raise ValueError('Steps with unsatisfiable dependencies: ' + ', '.join(pending))
+
+    def plan(self, estimates):
+        ''' Estimates when each step would start and finish, without running anything. Steps are
+        started in the order they were added once their dependencies are done, on at most
+        max_workers threads. Returns (name, dependencies, start, finish) tuples in start order. '''
+        worker_free = [0.0] * self.max_workers
+        finish = {}
+        planned = []
+        pending = [name for name in self.steps]
+        while pending:
+            ready = [name for name in pending if all(dependency in finish or dependency not in self.functions for dependency in self.dependencies[name])]
+            if not ready:
+                raise ValueError('Steps with unsatisfiable dependencies: ' + ', '.join(pending))
+            name = min(ready, key=lambda candidate: max([finish[dependency] for dependency in self.dependencies[candidate] if dependency in finish] or [0.0]))
+            pending.remove(name)
+            dependencies = [dependency for dependency in self.dependencies[name] if dependency in self.functions]
+            worker = worker_free.index(min(worker_free))
+            start = max([finish[dependency] for dependency in dependencies] + [worker_free[worker]])
+            finish[name] = worker_free[worker] = start + estimates.get(name, 0.0)
+            planned.append((name, dependencies, start, finish[name]))
+        return sorted(planned, key=lambda step: step[2])
+
+    def critical_path(self):
+        ''' The chain of steps that determined the total run time: starting from the step that
+        finished last, repeatedly follow the dependency that finished last. '''
+        path = []
+        candidates = [name for name in self.steps if name in self.finished]
+        while candidates:
+            name = max(candidates, key=lambda candidate: self.finished[candidate])
+            path.insert(0, name)
+            candidates = [dependency for dependency in self.dependencies[name] if dependency in self.finished]
+        return path
+
+    def print_critical_path(self):
+        path = self.critical_path()
+        if not path:
+            return
+        total = self.finished[path[-1]] - min(self.started.values())
+        print('Critical path (%.1fs):' % total)
+        for name in path:
+            print('    %s: %.1fs' % (name, self.finished[name] - self.started[name]))
+
+class NoSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def load_step_estimates(trace_files, defaults):
+    ''' The median wall time of each step in earlier install traces, or its estimate in
+    defaults. Returns the estimates and the names of the steps that have timing history. '''
+
+    durations = {}
+    for trace_file in trace_files:
+        try:
+            with open(trace_file) as trace:
+                for line in trace:
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(span, dict) and span.get('kind') == 'step' and not span.get('error'):
+                        durations.setdefault(span['name'], []).append(span['wallTime'])
+        except (IOError, OSError) as ex:
+            print('Could not read timing history %s: %s' % (trace_file, str(ex)), file=sys.stderr)
+    estimates = dict(defaults)
+    for name, values in durations.items():
+        values.sort()
+        estimates[name] = values[len(values) // 2]
+    return estimates, set(durations)
+
+
+def share_estimate(estimates, measured, names, source):
+    ''' Gives the named steps that have no timing history of their own the estimate of the step
+    source, for a step that is repeated under other names, such as once per host '''
+
+    for name in names:
+        if name not in measured:
+            estimates[name] = estimates[source]
+            if source in measured:
+                measured.add(name)
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def print_plan(scheduler, estimates, measured):
+    ''' Prints the steps with their estimated start time, duration and dependencies. Returns
+    the estimated total. '''
+
+    planned = scheduler.plan(estimates)
+    print('Plan (start, duration, step, command):')
+    for name, dependencies, start, finish in planned:
+        source = '' if name in measured else ' (default estimate)'
+        print('    %s  %s%s  %s: %s' % (format_duration(start), format_duration(finish - start), source, name, scheduler.descriptions[name]))
+        if dependencies:
+            print('        after ' + ', '.join(dependencies))
+    total = max([finish for name, dependencies, start, finish in planned] or [0])
+    print('Estimated total: %s' % format_duration(total))
+    return total
@@ -0,0 +1,185 @@
+''' A local stand-in for the remote source of installer artifacts, e.g. an S3 bucket.
+
+Serves the files of a directory with the range requests, ETag and Accept-Ranges of S3, so that
+the artifact cache of SilentInstaller can be exercised without network access:
+
+    python artifact_server.py --directory installers --port 8000 --bandwidth 50 --failAfter 300
+
+--bandwidth limits every connection, so that fetching chunks in parallel pays off as it does
+against S3. --failAfter drops connections after a number of megabytes in total, to exercise the
+resume of an interrupted download. '''
+
+from __future__ import print_function
+import argparse
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+BLOCK_SIZE = 64 * 1024
+
+
+class ArtifactHandler(BaseHTTPRequestHandler):
+    ''' GET and HEAD of the files in the served directory '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body):
+        server = self.server
+        server.requests.append((self.command, self.path, self.headers.get('Range')))
+        path = os.path.join(server.directory, os.path.basename(self.path.split('?')[0]))
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"%s"' % server.etag(path))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not send_body:
+            return
+
+        with open(path, 'rb') as artifact:
+            artifact.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = artifact.read(min(BLOCK_SIZE, remaining))
+                if not server.take(len(block)):
+                    # drop the connection in the middle of the response
+                    self.close_connection = True
+                    return
+                self.wfile.write(block)
+                remaining -= len(block)
+                if server.bandwidth:
+                    time.sleep(len(block) / server.bandwidth)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ArtifactServer(object):
+    ''' Runs the server on a background thread. Port 0 picks a free port. bandwidth is in bytes
+    per second and connection; after fail_after bytes in total, connections are dropped until
+    fail_after is cleared. '''
+
+    def __init__(self, directory, bandwidth=None, fail_after=None, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), ArtifactHandler)
+        self.server.directory = os.path.abspath(directory)
+        self.server.bandwidth = bandwidth
+        self.server.fail_after = fail_after
+        self.server.sent = 0
+        self.server.requests = []
+        self.server.etags = {}
+        self.server.lock = threading.Lock()
+        self.server.take = self.take
+        self.server.etag = self.etag
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_port
+
+    def url(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.port, name)
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    @property
+    def fail_after(self):
+        return self.server.fail_after
+
+    @fail_after.setter
+    def fail_after(self, value):
+        self.server.fail_after = value
+
+    def take(self, length):
+        ''' Counts bytes about to be sent; False once more than fail_after bytes were sent '''
+        with self.server.lock:
+            if self.server.fail_after is not None and self.server.sent + length > self.server.fail_after:
+                return False
+            self.server.sent += length
+            return True
+
+    def etag(self, path):
+        ''' An ETag from the size and modification time, like a changed object in S3 gets a new one '''
+        stat = os.stat(path)
+        return hashlib.md5(('%s-%d-%d' % (path, stat.st_size, int(stat.st_mtime))).encode('utf-8')).hexdigest()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the remote source of installer artifacts')
+    parser.add_argument('--directory', default='.', help='Directory of the served files')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Megabytes per second and connection')
+    parser.add_argument('--failAfter', type=float, default=None, help='Drop connections after this many megabytes were sent in total')
+    args = parser.parse_args()
+
+    server = ArtifactServer(args.directory,
+        bandwidth=args.bandwidth * 1048576 if args.bandwidth else None,
+        fail_after=int(args.failAfter * 1048576) if args.failAfter is not None else None,
+        port=args.port)
+    print('Serving %s on http://127.0.0.1:%d/' % (server.server.directory, server.port))
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
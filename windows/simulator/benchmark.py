@@ -0,0 +1,218 @@
+''' End-to-end benchmark of the installer scripts against the simulator.
+
+Runs each flow several times, each time against a new simulation, and reports how long the script
+took (wall), how long the fake tools were busy (tools) and the difference, which is the time spent
+in the script itself: starting processes, polling and waiting between commands.
+
+    python benchmark.py --runs 5 --latency 0.2
+    python benchmark.py --flows install,updateTopology --output json > results.json
+
+The upgrade flow runs ScriptedInstaller.py, which needs a Python 2.7 interpreter with PyYAML;
+pass it with --python2. '''
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import simulator
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SILENT_INSTALLER = os.path.join(SCRIPTS_DIR, 'tsm', 'SilentInstaller', 'SilentInstaller.py')
+SCRIPTED_INSTALLER = os.path.join(SCRIPTS_DIR, 'tabadmin', 'ScriptedInstaller.py')
+
+SECRETS = {
+    'local_admin_user': 'admin',
+    'local_admin_pass': 'admin',
+    'content_admin_user': 'admin',
+    'content_admin_pass': 'admin',
+    'product_keys': ['trial']
+}
+
+REGISTRATION = {
+    'first_name': 'Bench',
+    'last_name': 'Mark',
+    'email': 'benchmark@example.com',
+    'company': 'Example',
+    'title': 'Administrator',
+    'department': 'IT',
+    'industry': 'Software',
+    'phone': '5555555555',
+    'city': 'Seattle',
+    'state': 'WA',
+    'zip': '98103',
+    'country': 'United States',
+    'eula': 'yes'
+}
+
+TOPOLOGY = {
+    'node1': {'services': {'backgrounder': simulator.instances(2), 'vizqlserver': simulator.instances(2)}},
+    'node2': {'services': {'backgrounder': simulator.instances(1), 'vizqlserver': simulator.instances(2)}}
+}
+
+
+def write_json(path, content):
+    with open(path, 'w') as json_file:
+        json.dump(content, json_file, indent=4)
+    return path
+
+
+def prepare_install(sim, work_dir):
+    ''' A fresh machine, installed as the initial node '''
+    return [SILENT_INSTALLER, '--bootstrapFile', write_json(os.path.join(work_dir, 'bootstrap.json'), {
+        'secretsFile': write_json(os.path.join(work_dir, 'secrets.json'), SECRETS),
+        'registrationFile': write_json(os.path.join(work_dir, 'registration.json'), REGISTRATION),
+        'configFile': write_json(os.path.join(work_dir, 'config.json'), {'configEntities': {}, 'topologyVersion': {'nodes': {'node1': TOPOLOGY['node1']}}}),
+        'installer': sim.installer('tsm-installer'),
+        'installDir': os.path.join(work_dir, 'install'),
+        'dataDir': os.path.join(work_dir, 'data'),
+        'nodeConfigurationDirectory': os.path.join(work_dir, 'nodeConfiguration.json'),
+        'minimumFreeDiskSpaceGB': 0
+    })]
+
+
+def prepare_install_worker(sim, work_dir):
+    ''' A fresh machine joining a running single node cluster '''
+    sim.seed_tsm_cluster(os.path.join(work_dir, 'controller'), ['node1'], {'node1': TOPOLOGY['node1']}, local=False)
+    return [SILENT_INSTALLER, '--bootstrapFile', write_json(os.path.join(work_dir, 'bootstrap.json'), {
+        'type': 'installWorker',
+        'secretsFile': write_json(os.path.join(work_dir, 'secrets.json'), SECRETS),
+        'nodeConfigurationFile': write_json(os.path.join(work_dir, 'nodeConfiguration.json'), {'initialNodeId': 'node1'}),
+        'installer': sim.installer('worker-installer'),
+        'installDir': os.path.join(work_dir, 'install'),
+        'dataDir': os.path.join(work_dir, 'data'),
+        'minimumFreeDiskSpaceGB': 0
+    })]
+
+
+def prepare_update_topology(sim, work_dir):
+    ''' A running two node cluster, with the second node still empty '''
+    install_dir = os.path.join(work_dir, 'install')
+    sim.seed_tsm_cluster(install_dir, ['node1', 'node2'], {'node1': TOPOLOGY['node1'], 'node2': {'services': {}}})
+    return [SILENT_INSTALLER, '--bootstrapFile', write_json(os.path.join(work_dir, 'bootstrap.json'), {
+        'type': 'updateTopology',
+        'secretsFile': write_json(os.path.join(work_dir, 'secrets.json'), SECRETS),
+        'configFile': write_json(os.path.join(work_dir, 'config.json'), {'topologyVersion': {'nodes': TOPOLOGY}}),
+        'installDir': install_dir,
+        'nodeWaitTimeout': 0
+    })]
+
+
+def prepare_upgrade(sim, work_dir):
+    ''' A single node tabadmin installation of an older version '''
+    install_dir = os.path.join(work_dir, 'install')
+    sim.seed_tabadmin_installation(install_dir, '10.3')
+    return [SCRIPTED_INSTALLER, 'upgrade', '--installDir', install_dir, sim.installer('tabadmin-installer')]
+
+
+# Each flow: the interpreter that runs the script, and the function that seeds the simulation and
+# returns the arguments of simulator.py run
+FLOWS = {
+    'install': ('python3', prepare_install),
+    'installWorker': ('python3', prepare_install_worker),
+    'updateTopology': ('python3', prepare_update_topology),
+    'upgrade': ('python2', prepare_upgrade)
+}
+
+
+def busy_time(calls):
+    ''' The time during which at least one fake tool was running '''
+    busy = 0.0
+    end = None
+    for call in sorted(calls, key=lambda call: call['start']):
+        if end is None or call['start'] > end:
+            busy += call['end'] - call['start']
+            end = call['end']
+        elif call['end'] > end:
+            busy += call['end'] - end
+            end = call['end']
+    return busy
+
+
+def run_flow(flow, args):
+    ''' Runs one flow against a new simulation. Returns the measurements of the run. '''
+    interpreter_name, prepare = FLOWS[flow]
+    interpreter = args.python2 if interpreter_name == 'python2' else sys.executable
+    work_dir = tempfile.mkdtemp(prefix='simulator_%s_' % flow)
+    try:
+        sim = simulator.Simulation(os.path.join(work_dir, 'simulation')).create({'default': args.latency}, python=interpreter)
+        script_args = prepare(sim, work_dir)
+        started = time.time()
+        result = subprocess.run([interpreter, simulator.__file__, 'run', sim.root] + script_args,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        wall = time.time() - started
+        calls = sim.calls()
+        busy = busy_time(calls)
+        return {
+            'flow': flow,
+            'exitCode': result.returncode,
+            'wall': wall,
+            'tools': busy,
+            'overhead': wall - busy,
+            'calls': len(calls),
+            'output': result.stdout if result.returncode else ''
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def summarize(results):
+    ''' Median measurements of every flow '''
+    summary = []
+    for flow in sorted(set(result['flow'] for result in results)):
+        runs = [result for result in results if result['flow'] == flow]
+        summary.append({
+            'flow': flow,
+            'runs': len(runs),
+            'failed': len([run for run in runs if run['exitCode']]),
+            'calls': int(statistics.median(run['calls'] for run in runs)),
+            'wall': statistics.median(run['wall'] for run in runs),
+            'tools': statistics.median(run['tools'] for run in runs),
+            'overhead': statistics.median(run['overhead'] for run in runs)
+        })
+    return summary
+
+
+def print_summary(summary, latency):
+    print('Median of each flow, with %.3fs latency per tool call:' % latency)
+    print('    %-16s %5s %7s %6s %9s %9s %9s' % ('flow', 'runs', 'failed', 'calls', 'wall', 'tools', 'overhead'))
+    for row in summary:
+        print('    %-16s %5d %7d %6d %8.2fs %8.2fs %8.2fs' % (row['flow'], row['runs'], row['failed'], row['calls'], row['wall'], row['tools'], row['overhead']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the installer scripts against the simulator')
+    parser.add_argument('--flows', default='install,installWorker,updateTopology', help='Comma separated flows to run, out of ' + ', '.join(sorted(FLOWS)))
+    parser.add_argument('--runs', type=int, default=3, help='Number of runs of every flow')
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds every call of a fake tool takes')
+    parser.add_argument('--python2', default='python2', help='Python 2.7 interpreter with PyYAML, used by the upgrade flow')
+    parser.add_argument('--output', choices=['table', 'json'], default='table', help='Print a table, or json with every run')
+    parser.add_argument('--keep', action='store_true', help='Keep the simulation directories of the runs')
+    args = parser.parse_args()
+
+    flows = [flow.strip() for flow in args.flows.split(',') if flow.strip()]
+    unknown = [flow for flow in flows if flow not in FLOWS]
+    if unknown:
+        parser.error('Unknown flows: ' + ', '.join(unknown))
+
+    results = [run_flow(flow, args) for flow in flows for _ in range(args.runs)]
+    summary = summarize(results)
+    if args.output == 'json':
+        print(json.dumps({'latency': args.latency, 'summary': summary, 'runs': results}, indent=4))
+    else:
+        print_summary(summary, args.latency)
+        for result in results:
+            if result['exitCode']:
+                print('\n%s failed with exit code %d:\n%s' % (result['flow'], result['exitCode'], result['output']), file=sys.stderr)
+    return 1 if any(result['exitCode'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+''' A local stand-in for the gateway of Tableau Server, for the gateway probe of SilentInstaller.
+
+Answers every GET after a configurable latency, and fails a share of the requests with 503, so
+that the thresholds and baseline of the probe can be exercised without a Tableau Server:
+
+    python gateway_server.py --port 8080 --latency 20 --jitter 10 --errorRate 0.02
+
+Latencies are in milliseconds. Connections are kept alive, like the gateway keeps them. '''
+
+from __future__ import print_function
+import argparse
+import random
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+BODY = b'<html><body>Tableau Server</body></html>'
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    ''' GET of any path '''
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately; without this every keep-alive response waits for
+    # a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+        latency = max(0.0, server.latency + random.uniform(-server.jitter, server.jitter))
+        time.sleep(latency / 1000.0)
+        status = 503 if random.random() < server.error_rate else 200
+        body = BODY if status == 200 else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class GatewayServer(object):
+    ''' Runs the server on a background thread. Port 0 picks a free port. latency and jitter are
+    in milliseconds; error_rate is the share of requests answered with 503. '''
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), GatewayHandler)
+        self.server.latency = latency
+        self.server.jitter = jitter
+        self.server.error_rate = error_rate
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_port
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the gateway of Tableau Server')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=20.0, help='Milliseconds every request takes')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Milliseconds the latency varies by, up or down')
+    parser.add_argument('--errorRate', type=float, default=0.0, help='Share of the requests answered with 503')
+    args = parser.parse_args()
+
+    server = GatewayServer(args.latency, args.jitter, args.errorRate, port=args.port)
+    print('Serving a gateway on http://127.0.0.1:%d/' % server.port)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
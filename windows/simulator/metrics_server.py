@@ -0,0 +1,130 @@
+''' A local stand-in for the metrics collector read by topology_rebalancer.py --collector.
+
+Every GET returns one sample of every node and service, varied around the values of a scenario
+file by up to --jitter (as a share of each value), so that rebalancing can be exercised without
+a loaded cluster:
+
+    {
+        "nodes": {
+            "node1": {"cores": 16, "ramGB": 64, "cpu": 0.95, "memory": 0.7},
+            "node2": {"cores": 16, "ramGB": 64, "cpu": 0.2, "memory": 0.3}
+        },
+        "services": {
+            "backgrounder": {"queue": 40},
+            "vizqlserver": {"latencyMs": 600}
+        }
+    }
+
+    python metrics_server.py --scenario scenario.json --port 9100 --jitter 0.05 '''
+
+from __future__ import print_function
+import argparse
+import json
+import random
+import sys
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    ''' GET of any path returns a sample '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = json.dumps(self.server.sample()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    ''' Runs the server on a background thread. Port 0 picks a free port. The scenario can be
+    replaced while the server runs. '''
+
+    def __init__(self, scenario, jitter=0.0, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.sample = self.sample
+        self.scenario = scenario
+        self.jitter = jitter
+        self.samples = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_port
+
+    def url(self):
+        return 'http://127.0.0.1:%d/metrics' % self.port
+
+    def vary(self, value, upper=None):
+        value = value * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return min(value, upper) if upper is not None else value
+
+    def sample(self):
+        with self.lock:
+            self.samples += 1
+            scenario = self.scenario
+        nodes = {}
+        for node_id, node in scenario.get('nodes', {}).items():
+            nodes[node_id] = {'cores': node['cores'], 'ramGB': node['ramGB'],
+                'cpu': self.vary(node['cpu'], 1.0), 'memory': self.vary(node['memory'], 1.0)}
+        services = {}
+        for service, metrics in scenario.get('services', {}).items():
+            services[service] = dict((name, self.vary(value)) for name, value in metrics.items())
+        return {'nodes': nodes, 'services': services}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the metrics collector of the topology rebalancer')
+    parser.add_argument('--scenario', required=True, help='Json file with the cores, ramGB, cpu and memory of each node and the queue or latency of the services')
+    parser.add_argument('--port', type=int, default=9100, help='Port to listen on')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Share by which every sampled value varies, up or down')
+    args = parser.parse_args()
+
+    with open(args.scenario) as scenario_file:
+        scenario = json.load(scenario_file)
+    server = MetricsServer(scenario, args.jitter, port=args.port)
+    print('Serving metrics on %s' % server.url())
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
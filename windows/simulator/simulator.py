@@ -0,0 +1,536 @@
+''' A stand-in for a Windows machine with Tableau Server, for running the installer scripts where
+neither Windows nor Tableau Server is available, e.g. on Linux CI.
+
+A simulation is a state directory. It holds fake installer, tsm, tabcmd and tabadmin executables,
+whose latency and failures are configurable, and the simulated registry, services, cluster state
+and a log of every call. The installers run with their SYSTEM replaced by SimulatedSystem, which
+answers registry reads and service queries from the same state:
+
+    python simulator.py create /tmp/sim --latency 0.05 --fail "tsm register=2"
+    python simulator.py run /tmp/sim ../tsm/SilentInstaller/SilentInstaller.py install ... /tmp/sim/installers/TableauServer-Setup.exe
+
+The fake executables are shell scripts, so they only run on POSIX systems. This module runs with
+Python 2.7 (ScriptedInstaller) as well as Python 3 (SilentInstaller). '''
+
+from __future__ import print_function
+import argparse
+import contextlib
+import json
+import os
+import stat
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_TSM_VERSION = '20201.20.0101.1200'
+DEFAULT_TABADMIN_VERSION = '10.5'
+ENVIRONMENT_KEY = 'SYSTEM\\CurrentControlSet\\Control\\Session Manager\\Environment'
+
+# The fake installers created by a simulation, by tool name
+INSTALLERS = {
+    'tsm-installer': 'TableauServer-Setup.exe',
+    'worker-installer': 'TableauServerWorker-Setup.exe',
+    'tabadmin-installer': 'TableauServer-Inno-Setup.exe'
+}
+
+# The configuration that ScriptedInstaller reads from workgroup.yml after an installation
+DEFAULT_WORKGROUP = {
+    'worker.hosts': 'localhost',
+    'worker0.gateway.port': '80',
+    'install.firewall.gatewayhole': 'false',
+    'ssl.enabled': 'false',
+    'ssl.port': '443'
+}
+
+# Output of a tool that failed because of an injected failure. The installers treat it as transient.
+INJECTED_FAILURE_OUTPUT = 'Could not connect to the server (injected failure)'
+
+
+class ToolError(Exception):
+    ''' A fake tool failed; the message is printed and the tool exits with exit_code '''
+
+    def __init__(self, message, exit_code=1):
+        super(ToolError, self).__init__(message)
+        self.exit_code = exit_code
+
+
+def quote(value):
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def option_value(args, *flags):
+    ''' The value following the first of the flags, or of a FLAG=value argument '''
+    for index, arg in enumerate(args):
+        for flag in flags:
+            if arg == flag and index + 1 < len(args):
+                return args[index + 1]
+            if arg.upper().startswith(flag.upper() + '='):
+                return arg[len(flag) + 1:].strip('"')
+    return None
+
+
+def command_words(args, count=2):
+    ''' The leading words of a command line up to the first option '''
+    words = []
+    for arg in args[:count]:
+        if arg.startswith('-') or arg.startswith('/'):
+            break
+        words.append(arg)
+    return words
+
+
+def read_workgroup(path):
+    values = {}
+    if os.path.isfile(path):
+        with open(path) as workgroup_file:
+            for line in workgroup_file:
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    values[key.strip()] = value.strip()
+    return values
+
+
+def write_workgroup(path, values):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as workgroup_file:
+        for key in sorted(values):
+            workgroup_file.write('%s: %s\n' % (key, values[key]))
+
+
+def workgroup_path(install_dir):
+    return os.path.join(install_dir, 'data', 'tabsvc', 'config', 'workgroup.yml')
+
+
+def instances(count):
+    return {'instances': [{'instanceId': str(index)} for index in range(count)]}
+
+
+class Simulation(object):
+    ''' The state directory of a simulated machine. latency maps "default", a tool, or a tool and its
+    command (e.g. "tsm initialize") to the seconds a call takes. failures maps the same keys to the
+    number of calls that fail before the calls succeed. '''
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.state_path = os.path.join(self.root, 'state.json')
+        self.config_path = os.path.join(self.root, 'config.json')
+        self.lock_path = os.path.join(self.root, 'state.lock')
+
+    def create(self, latency=None, failures=None, tsm_version=DEFAULT_TSM_VERSION, tabadmin_version=DEFAULT_TABADMIN_VERSION, python=None):
+        ''' Writes the configuration, an empty machine state and the fake installers '''
+        for directory in [self.root, os.path.join(self.root, 'installers')]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        config = {
+            'latency': latency or {},
+            'failures': failures or {},
+            'tsmVersion': tsm_version,
+            'tabadminVersion': tabadmin_version,
+            'python': python or sys.executable
+        }
+        with open(self.config_path, 'w') as config_file:
+            json.dump(config, config_file, indent=4)
+        self.save_state(self.empty_state())
+        for tool, name in INSTALLERS.items():
+            self.write_executable(tool, self.installer(tool))
+        return self
+
+    def empty_state(self):
+        return {
+            'registry': {},
+            'services': [],
+            'licenses': [],
+            'registered': False,
+            'settings': {},
+            'initialized': False,
+            'running': False,
+            'nodes': [],
+            'topology': {},
+            'failed': {},
+            'calls': []
+        }
+
+    def installer(self, tool):
+        return os.path.join(self.root, 'installers', INSTALLERS[tool])
+
+    @property
+    def config(self):
+        with open(self.config_path) as config_file:
+            return json.load(config_file)
+
+    def write_executable(self, tool, path, context=''):
+        ''' Writes a fake executable that runs the tool of this module against this simulation '''
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as executable:
+            executable.write('#!/bin/sh\nexec %s %s tool %s %s %s "$@"\n' % (
+                quote(self.config['python']), quote(os.path.abspath(__file__).replace('.pyc', '.py')), tool, quote(self.root), quote(context)))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    def load_state(self):
+        with open(self.state_path) as state_file:
+            return json.load(state_file)
+
+    def save_state(self, state):
+        temporary_path = self.state_path + '.tmp%d' % os.getpid()
+        with open(temporary_path, 'w') as state_file:
+            json.dump(state, state_file, indent=1)
+        os.rename(temporary_path, self.state_path)
+
+    @contextlib.contextmanager
+    def update(self):
+        ''' Loads the state for a change, and saves it afterwards. Tools running at the same time
+        are serialized with a lock file. '''
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = self.load_state()
+                yield state
+                self.save_state(state)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def calls(self):
+        return self.load_state()['calls']
+
+    def install_tsm(self, install_dir, version=None):
+        ''' Creates the binaries of a TSM installation, as the tsm installer does '''
+        version = version or self.config['tsmVersion']
+        bin_dir = os.path.join(install_dir, 'packages', 'bin.' + version)
+        self.write_executable('tsm', os.path.join(bin_dir, 'tsm.cmd'), install_dir)
+        self.write_executable('tabcmd', os.path.join(bin_dir, 'tabcmd.exe'), install_dir)
+        return version
+
+    def install_tabadmin(self, install_dir, version=None):
+        ''' Creates the binaries and workgroup.yml of a tabadmin installation, as the Inno Setup
+        installer does. An upgrade keeps the existing configuration. '''
+        version = version or self.config['tabadminVersion']
+        bin_dir = os.path.join(install_dir, version, 'bin')
+        self.write_executable('tabadmin', os.path.join(bin_dir, 'tabadmin.exe'), install_dir)
+        self.write_executable('tabcmd', os.path.join(bin_dir, 'tabcmd.exe'), install_dir)
+        workgroup = dict(DEFAULT_WORKGROUP)
+        workgroup.update(read_workgroup(workgroup_path(install_dir)))
+        workgroup['version.current'] = version
+        write_workgroup(workgroup_path(install_dir), workgroup)
+        return version
+
+    def seed_tsm_cluster(self, install_dir, nodes, topology, running=True, local=True):
+        ''' An initialized TSM cluster with the given nodes and topology. When local is False the
+        cluster runs on other machines, and this machine is a fresh one that can join it as a worker. '''
+        version = self.install_tsm(install_dir) if local else None
+        with self.update() as state:
+            if local:
+                state['registry'][ENVIRONMENT_KEY + '\\TABLEAU_SERVER_DATA_DIR_VERSION'] = version
+                state['services'] = ['Tableau Server Administration Agent 0']
+            state['initialized'] = True
+            state['running'] = running
+            state['nodes'] = list(nodes)
+            state['topology'] = topology
+        return version
+
+    def seed_tabadmin_installation(self, install_dir, version):
+        ''' An existing tabadmin installation of the given version, with its service installed '''
+        self.install_tabadmin(install_dir, version)
+        with self.update() as state:
+            state['services'] = ['Tableau Server %s (tabsvc)' % version]
+
+
+class SimulatedSystem(object):
+    ''' Answers the registry reads and service queries of the installers from the simulation state '''
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+
+    def read_registry_value(self, key_path, name):
+        registry = self.simulation.load_state()['registry']
+        if key_path + '\\' + name not in registry:
+            raise OSError('Registry value %s\\%s not found' % (key_path, name))
+        return registry[key_path + '\\' + name]
+
+    def list_services(self):
+        lines = []
+        for index, service in enumerate(self.simulation.load_state()['services']):
+            lines.extend(['SERVICE_NAME: tableau_%d' % index, 'DISPLAY_NAME: %s' % service, '        STATE              : 4  RUNNING', ''])
+        return '\n'.join(lines)
+
+    def query_service_config(self, host, service):
+        ''' Every host shares the services of this machine. The executable of a tabadmin service
+        is in the directory of its version, like the tabadmin installer puts it. '''
+        for name in self.simulation.load_state()['services']:
+            if name.endswith('(%s)' % service):
+                version = name[len('Tableau Server '):-len(' (%s)' % service)]
+                return ('SERVICE_NAME: %s\n        BINARY_PATH_NAME   : "C:\\Program Files\\Tableau\\Tableau Server\\%s\\bin\\%s.exe"\n'
+                    '        DISPLAY_NAME       : %s' % (service, version, service, name))
+        return 'The specified service does not exist as an installed service.'
+
+
+# Fake tools. Each gets the simulation state to change, the installation directory it belongs to,
+# and its arguments, and returns its output.
+
+def tsm_installer(state, simulation, context, args):
+    install_dir = option_value(args, 'INSTALLDIR')
+    if not install_dir or '/INSTALL' not in args:
+        raise ToolError('Usage: /INSTALL /SILENT INSTALLDIR=<dir> DATADIR=<dir>', 2)
+    version = simulation.install_tsm(install_dir)
+    state['registry'][ENVIRONMENT_KEY + '\\TABLEAU_SERVER_DATA_DIR_VERSION'] = version
+    state['services'] = ['Tableau Server Administration Agent 0']
+    state['nodes'] = ['node1']
+    return 'Installed Tableau Server %s to %s' % (version, install_dir)
+
+
+def worker_installer(state, simulation, context, args):
+    install_dir = option_value(args, 'INSTALLDIR')
+    bootstrap_file = option_value(args, 'BOOTSTRAPFILE')
+    if not install_dir or not bootstrap_file or not os.path.isfile(bootstrap_file):
+        raise ToolError('Usage: /INSTALL /SILENT INSTALLDIR=<dir> BOOTSTRAPFILE=<file>', 2)
+    if not os.environ.get('TableauAdminUser'):
+        raise ToolError('TableauAdminUser is not set', 2)
+    simulation.install_tsm(install_dir)
+    node_id = 'node%d' % (len(state['nodes']) + 1)
+    state['nodes'].append(node_id)
+    state['services'] = ['Tableau Server Administration Agent 0']
+    return 'Installed worker %s to %s' % (node_id, install_dir)
+
+
+def tabadmin_installer(state, simulation, context, args):
+    install_dir = option_value(args, '/DIR')
+    if not install_dir:
+        raise ToolError('Usage: /VERYSILENT /DIR=<dir>', 2)
+    log_file = option_value(args, '/LOG')
+    version = simulation.install_tabadmin(install_dir)
+    if log_file:
+        with open(log_file, 'w') as log:
+            log.write('Installed Tableau Server %s to %s\n' % (version, install_dir))
+    state['running'] = False
+    return ''
+
+
+def format_status(state):
+    lines = ['Status: ' + ('RUNNING' if state['running'] else 'STOPPED')]
+    for node_id in state['nodes']:
+        lines.append('%s: localhost' % node_id)
+        for service, settings in sorted(state['topology'].get(node_id, {}).get('services', {}).items()):
+            for instance in settings.get('instances', []):
+                lines.append("    '%s %s' status is %s." % (service, instance['instanceId'], 'running' if state['running'] else 'stopped'))
+    return '\n'.join(lines)
+
+
+def tsm(state, simulation, context, args):
+    words = command_words(args)
+    command = ' '.join(words)
+    if command in ('login', 'logout', 'pending-changes apply', 'licenses list') or words[:1] == ['register']:
+        if command == 'licenses list':
+            return '\n'.join(state['licenses'])
+        if words[:1] == ['register']:
+            state['registered'] = True
+        return ''
+    if command == 'licenses activate':
+        state['licenses'].append('trial' if '--trial' in args else option_value(args, '-k', '--license-key'))
+        return ''
+    if command == 'settings import':
+        with open(option_value(args, '-f', '--import-config-file')) as config_file:
+            config = json.load(config_file)
+        if '--config-only' not in args and 'topologyVersion' in config:
+            state['topology'] = config['topologyVersion'].get('nodes', {})
+        if '--topology-only' not in args:
+            state['settings'].update(config.get('configEntities', {}))
+        return ''
+    if command == 'settings export':
+        with open(option_value(args, '--output-config-file', '-f'), 'w') as export_file:
+            json.dump({'configEntities': state['settings'], 'topologyVersion': {'nodes': state['topology']}}, export_file, indent=4)
+        return ''
+    if words[:1] == ['initialize']:
+        state['initialized'] = True
+        state['running'] = state['running'] or '--start-server' in args
+        return ''
+    if words[:1] in (['start'], ['restart']):
+        if not state['initialized']:
+            raise ToolError('The server is not initialized')
+        state['running'] = True
+        return ''
+    if words[:1] == ['stop']:
+        state['running'] = False
+        return ''
+    if words[:1] == ['status']:
+        return format_status(state)
+    if command == 'topology list-nodes':
+        return '\n'.join(state['nodes'])
+    if args[:3] == ['topology', 'nodes', 'get-bootstrap-file']:
+        with open(option_value(args, '--file', '-f'), 'w') as bootstrap_file:
+            json.dump({'initialNodeId': 'node1', 'controllerPort': 8850}, bootstrap_file, indent=4)
+        return ''
+    if command == 'topology set-process':
+        node_id = option_value(args, '-n', '--node')
+        service = option_value(args, '-pr', '--process')
+        services = state['topology'].setdefault(node_id, {}).setdefault('services', {})
+        services[service] = instances(int(option_value(args, '-c', '--count')))
+        return ''
+    if command == 'topology remove-nodes':
+        removed = option_value(args, '-n', '--node-names').split(',')
+        state['nodes'] = [node_id for node_id in state['nodes'] if node_id not in removed]
+        for node_id in removed:
+            state['topology'].pop(node_id, None)
+        return ''
+    raise ToolError('Unknown tsm command: ' + ' '.join(args))
+
+
+def tabcmd(state, simulation, context, args):
+    if command_words(args) == ['initialuser'] and option_value(args, '--username'):
+        return 'Created initial user ' + option_value(args, '--username')
+    raise ToolError('Unknown tabcmd command: ' + ' '.join(args))
+
+
+def tabadmin(state, simulation, context, args):
+    command = ' '.join(command_words(args, 1))
+    path = workgroup_path(context)
+    workgroup = read_workgroup(path)
+    if command == 'get':
+        return 'The value of %s is: %s' % (args[1], workgroup.get(args[1], ''))
+    if command == 'set':
+        workgroup[args[1]] = args[2]
+        write_workgroup(path, workgroup)
+        return ''
+    if command == 'install':
+        state['services'] = ['Tableau Server %s (tabsvc)' % workgroup.get('version.current', '')]
+        return ''
+    if command in ('configure', 'activate', 'register'):
+        return ''
+    if command in ('start', 'stop'):
+        state['running'] = command == 'start'
+        return ''
+    if command == 'status':
+        return 'Status: ' + ('RUNNING' if state['running'] else 'STOPPED')
+    raise ToolError('Unknown tabadmin command: ' + ' '.join(args))
+
+
+TOOLS = {
+    'tsm': tsm,
+    'tabcmd': tabcmd,
+    'tabadmin': tabadmin,
+    'tsm-installer': tsm_installer,
+    'worker-installer': worker_installer,
+    'tabadmin-installer': tabadmin_installer
+}
+
+
+def lookup(table, keys, default=None):
+    for key in keys:
+        if key in table:
+            return table[key]
+    return default
+
+
+def run_tool(simulation, tool, context, args):
+    ''' Runs one call of a fake tool: waits its latency, fails if a failure is still to be injected,
+    otherwise changes the state. Every call is logged with its start and end time. Returns the
+    exit code. '''
+    started = time.time()
+    config = simulation.config
+    words = command_words(args) if tool in ('tsm', 'tabcmd', 'tabadmin') else []
+    keys = [' '.join([tool] + words[:count]) for count in range(len(words), -1, -1)]
+    time.sleep(lookup(config['latency'], keys + ['default'], 0.0))
+
+    exit_code = 0
+    output = ''
+    with simulation.update() as state:
+        injected = lookup(config['failures'], keys, 0)
+        failure_key = next((key for key in keys if key in config['failures']), None)
+        try:
+            if failure_key and state['failed'].get(failure_key, 0) < injected:
+                state['failed'][failure_key] = state['failed'].get(failure_key, 0) + 1
+                raise ToolError(INJECTED_FAILURE_OUTPUT)
+            output = TOOLS[tool](state, simulation, context, args)
+        except ToolError as ex:
+            output = str(ex)
+            exit_code = ex.exit_code
+        state['calls'].append({'tool': tool, 'command': keys[0], 'start': started, 'end': time.time(), 'exitCode': exit_code})
+    if output:
+        print(output)
+    sys.stdout.flush()
+    return exit_code
+
+
+def load_script(script):
+    ''' Imports an installer script as a module, without running its main '''
+    name = os.path.splitext(os.path.basename(script))[0]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    if sys.version_info[0] < 3:
+        import imp
+        return imp.load_source(name, script)
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(name, script)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_script(simulation, script, args):
+    ''' Runs the main of an installer script with its SYSTEM answered by the simulation '''
+    # ScriptedInstaller checks the installer extension against PathExt, and finds sc.exe under SystemRoot
+    os.environ.setdefault('PathExt', '.COM;.EXE;.BAT;.CMD')
+    os.environ.setdefault('SystemRoot', simulation.root)
+    module = load_script(script)
+    module.SYSTEM = SimulatedSystem(simulation)
+    sys.argv = [os.path.abspath(script)] + list(args)
+    return module.main()
+
+
+def parse_settings(values, value_type):
+    ''' Parses KEY=VALUE arguments, where a KEY is "default", a tool, or a tool and its command '''
+    settings = {}
+    for value in values or []:
+        key, separator, number = value.rpartition('=')
+        if not separator:
+            raise SystemExit('Expected KEY=VALUE, got ' + value)
+        settings[key] = value_type(number)
+    return settings
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'tool':
+        # called by a fake executable: tool <name> <root> <installation directory> [arguments]
+        return run_tool(Simulation(sys.argv[3]), sys.argv[2], sys.argv[4], sys.argv[5:])
+
+    parser = argparse.ArgumentParser(description='Simulated Tableau Server machine for running the installer scripts')
+    subparsers = parser.add_subparsers(dest='action')
+    create_parser = subparsers.add_parser('create', help='Create a simulation')
+    create_parser.add_argument('root', help='State directory of the simulation')
+    create_parser.add_argument('--latency', action='append', help='Seconds a call takes, as KEY=SECONDS where KEY is default, a tool or a tool and its command, e.g. "tsm initialize=2". A bare number sets the default', default=[])
+    create_parser.add_argument('--fail', action='append', help='Number of calls that fail before calls succeed, as KEY=COUNT, e.g. "tsm register=2"', default=[])
+    create_parser.add_argument('--tsmVersion', default=DEFAULT_TSM_VERSION, help='Version installed by the tsm installer')
+    create_parser.add_argument('--tabadminVersion', default=DEFAULT_TABADMIN_VERSION, help='Version installed by the tabadmin installer')
+    create_parser.add_argument('--python', default=sys.executable, help='Python interpreter running the fake executables')
+    run_parser = subparsers.add_parser('run', help='Run an installer script against a simulation')
+    run_parser.add_argument('root', help='State directory of the simulation')
+    run_parser.add_argument('script', help='Installer script, e.g. SilentInstaller.py')
+    run_parser.add_argument('arguments', nargs=argparse.REMAINDER, help='Arguments of the installer script')
+    calls_parser = subparsers.add_parser('calls', help='Print the calls made to the fake executables')
+    calls_parser.add_argument('root', help='State directory of the simulation')
+    args = parser.parse_args()
+
+    if args.action == 'create':
+        latency = parse_settings(['default=' + value if '=' not in value else value for value in args.latency], float)
+        simulation = Simulation(args.root).create(latency, parse_settings(args.fail, int), args.tsmVersion, args.tabadminVersion, args.python)
+        for tool in sorted(INSTALLERS):
+            print('%s: %s' % (tool, simulation.installer(tool)))
+        return 0
+    if args.action == 'run':
+        return run_script(Simulation(args.root), args.script, args.arguments)
+    if args.action == 'calls':
+        for call in Simulation(args.root).calls():
+            print('%8.3fs  exit %d  %s' % (call['end'] - call['start'], call['exitCode'], call['command']))
+        return 0
+    parser.print_usage()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
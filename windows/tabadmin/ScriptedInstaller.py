@@ -3,12 +3,24 @@ import sys
 import os
 import re
 import argparse
+import collections
+import locale
+import logging
+import logging.handlers
 import subprocess
 import tempfile
 import json
 import shutil
+import threading
+import time
 import yaml
 
+# the step scheduler, install trace, plan and version helpers are shared with SilentInstaller.
+# install_common.py is found next to this script or in windows/common.
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.extend([SCRIPT_DIR, os.path.join(SCRIPT_DIR, os.pardir, 'common')])
+import install_common
+
 # If one of the entries in KNOWN_GOOD_PYTHON_VERSIONS matches a prefix if the current version, we're good.
 # That is to say, 2.7 matches 2.7.x where x is anything. 2.8.1 only would match 2.8.1, and so on.
 # A very strange set of good versions, for example, could be : [ (2,7,5), (2,8), (11,) ]
@@ -16,7 +28,7 @@ KNOWN_GOOD_PYTHON_VERSIONS = [(2,7) ]
 # Default installation dir.
 TABLEAU_DEFAULT_INSTALL_DIR = r'C:\Program Files\Tableau\Tableau Server'
 TABLEAU_DEFAULT_DATA_DIR = r'C:\ProgramData\Tableau\Tableau Server'
-RELATIVE_WORKGROUP_YML_PATH = r'data\tabsvc\config\workgroup.yml'
+RELATIVE_WORKGROUP_YML_PATH = os.path.join('data', 'tabsvc', 'config', 'workgroup.yml')
 # Minimum version that can be upgraded with this.
 MINIMUM_UPGRADEABLE_VERSION = 9.0
 # Minimum version that can be upgraded with this if this is a cluster
@@ -26,6 +38,9 @@ MINIMUM_CLUSTER_UPGRADEABLE_VERSION = 9.3
 # to a terrible hacky version.
 TABADMIN_HAS_GET_COMMAND = True
 
+# Use the C accelerated YAML loader when PyYAML was built with libyaml; workgroup.yml is large.
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 INNO_SETUP_EXIT_CODES = {
     1: 'Inno Setup: Setup failed to initialize.',
     2: 'Inno Setup: The user clicked Cancel in the wizard before the actual installation started, or chose "No" on the opening "This will install..." message box.',
@@ -55,6 +70,10 @@ class ExistingInstallationError(Exception):
 class ValidationError(Exception):
     pass
 
+# The worker installer couldn't be staged on a worker host, or upgraded workers didn't become healthy
+class WorkerUpgradeError(Exception):
+    pass
+
 # An external command exited with a non-success exit code
 class ExitCodeError(Exception):
     def __init__(self, binary, exit_code):
@@ -84,6 +103,10 @@ def make_cmd_line_parser():
     optional_flags.add_argument('--installDir', dest='installDir', help='installation directory', default=TABLEAU_DEFAULT_INSTALL_DIR)
     optional_flags.add_argument('--configFile', dest='configFile', help='Configuration and topology yml file', default=None)
     optional_flags.add_argument('--installerLog', dest='installerLog', help='Installer logfile; a default will be created if unspecified', default=None)
+    optional_flags.add_argument('--traceFile', dest='traceFile', help='Json lines file to write the timing of every step and command to. A Chrome trace event file is written next to it', default=None)
+    optional_flags.add_argument('--commandLog', dest='commandLog', help='Rotating log file that receives the output of every external command', default=None)
+    optional_flags.add_argument('--plan', dest='plan', action='store_true', help='Only print the steps that would run, with estimated durations. Nothing is installed or changed')
+    optional_flags.add_argument('--planHistory', dest='planHistory', help='Comma separated --traceFile traces of earlier runs, used for the estimates of --plan', default=None)
     optional_flags.add_argument('--enablePublicFwRule', dest='enablePublicFwRule', action='store_true', help='If configured to add firewall rules to connect to gateway, also enable firewall rule to connect "public" Windows profile')
 
     # Required flags (no reasonable defaults)
@@ -104,7 +127,19 @@ def make_cmd_line_parser():
     optional_flags.add_argument('--installDir', dest='installDir', help='installation directory', default=TABLEAU_DEFAULT_INSTALL_DIR)
     optional_flags.add_argument('--secretsFile', dest='secretsFile', help='User credentials json file; required if you use non-default runas username', default=None)
     optional_flags.add_argument('--installerLog', dest='installerLog', help='Installer logfile; a default will be created if unspecified', default=None)
+    optional_flags.add_argument('--traceFile', dest='traceFile', help='Json lines file to write the timing of every step and command to. A Chrome trace event file is written next to it', default=None)
+    optional_flags.add_argument('--commandLog', dest='commandLog', help='Rotating log file that receives the output of every external command', default=None)
+    optional_flags.add_argument('--plan', dest='plan', action='store_true', help='Only print the steps that would run, with estimated durations. Nothing is installed or changed')
+    optional_flags.add_argument('--planHistory', dest='planHistory', help='Comma separated --traceFile traces of earlier runs, used for the estimates of --plan', default=None)
     optional_flags.add_argument('--fastuninstall', dest='fastuninstall', action='store_true', help='Use the optional \'fastuninstall\' functionality of the installer to skip making a backup before upgrading')
+    cluster_flags = upgrade_parser.add_argument_group('Cluster upgrade arguments')
+    cluster_flags.add_argument('--cluster', dest='cluster', action='store_true', help='Also upgrade the worker hosts listed in worker.hosts, in batches')
+    cluster_flags.add_argument('--workerInstaller', dest='workerInstaller', help='Worker installer path, e.g: Setup-Worker-x64.exe. Required with --cluster', default=None)
+    cluster_flags.add_argument('--workerUpgradeCommand', dest='workerUpgradeCommand', help='Command line that runs the worker installer on a worker host, with the placeholders {host}, {installer} and {installDir}. Required with --cluster', default=None)
+    cluster_flags.add_argument('--workerBatchSize', dest='workerBatchSize', type=int, help='Number of worker hosts upgraded at the same time', default=1)
+    cluster_flags.add_argument('--stagingDir', dest='stagingDir', help='Directory on each worker host, with the placeholder {host}, to which the worker installer is copied before the upgrade. Not used with --fastuninstall', default=r'\\{host}\C$\Windows\Temp')
+    cluster_flags.add_argument('--workerHealthCommand', dest='workerHealthCommand', help='Command line, with the placeholder {host}, that exits with 0 once an upgraded worker is healthy. By default the tabsvc service of the host must be installed from the version the primary was upgraded to', default=None)
+    cluster_flags.add_argument('--workerHealthTimeout', dest='workerHealthTimeout', type=int, help='Seconds to wait for the workers of a batch to become healthy', default=900)
     required_flags = upgrade_parser.add_argument_group('required flags')
     required_flags.add_argument('installer', help='installer path, e.g: Tableau-Server-64bit-9-3-1.exe')
 
@@ -138,8 +173,20 @@ def validate_upgrade_inputs(options):
     secrets = {}
     if options.secretsFile:
         secrets = validate_secrets_file(options, require_initialuser=False)
+    if options.cluster:
+        validate_cluster_upgrade_inputs(options)
     return secrets
 
+# Be sure the cluster upgrade has a worker installer and a way to run it
+def validate_cluster_upgrade_inputs(options):
+    if not options.workerInstaller or not os.path.isfile(options.workerInstaller):
+        raise ValidationError('A cluster upgrade needs --workerInstaller pointing to the worker installer executable')
+    if not options.workerUpgradeCommand:
+        raise ValidationError('A cluster upgrade needs --workerUpgradeCommand to run the worker installer on the worker hosts')
+    if options.workerBatchSize < 1:
+        raise ValidationError('--workerBatchSize must be at least 1')
+    return True
+
 def validate_python_version():
     current_version_tuple = (sys.version_info.major, sys.version_info.minor, sys.version_info.micro)
     for good_version_tuple in KNOWN_GOOD_PYTHON_VERSIONS:
@@ -163,7 +210,7 @@ def validate_config_file(options):
     if options.configFile:
         try:
             with open(options.configFile) as yaml_file:
-                yaml_doc = yaml.safe_load(yaml_file)
+                yaml_doc = yaml.load(yaml_file, Loader=YAML_LOADER)
                 if not 'config.version' in yaml_doc:
                     raise ValidationError('Config YAML file "%s" must have, at minimum, config.version' % options.configFile)
         except IOError as ex:
@@ -255,24 +302,97 @@ def read_json_file(file_path):
     with open(file_path) as json_file:
         return json.loads(json_file.read())
 
+# Queries the services of this machine and of the worker hosts through the service control manager.
+# Replace SYSTEM with an object with the same methods to run the installer elsewhere, as the simulator does.
+class WindowsSystem(object):
+    # The output of sc query for all services of this machine
+    def list_services(self):
+        return subprocess.check_output(['sc', 'query', 'type=', 'service', 'state=', 'all'])
+
+    # The output of sc qc, the configuration of one service of a host, which includes its executable
+    def query_service_config(self, host, service):
+        sc_path = os.path.join(os.environ['SystemRoot'], 'system32', 'sc.exe')
+        return run_command(sc_path, ['\\\\' + host, 'qc', service])
+
+SYSTEM = WindowsSystem()
+
 # Checks if there is an existing installation of Tableau Server
 def is_server_installed():
-    out = subprocess.check_output(['sc', 'query', 'type=', 'service', 'state=', 'all'])
-    return ('Tableau Server' in out)
+    return ('Tableau Server' in SYSTEM.list_services())
 
 #### General methods to place configs, run utilities, whatever.
 ####
 
+# Timing spans of the installation steps and external commands, see install_common.InstallTrace
+TRACE = install_common.InstallTrace()
+
+# The resource usage of all waited-for children, on platforms that report it
+def get_rusage_children():
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_CHILDREN)
+    except ImportError:
+        return None
+
+# Return the CPU time in seconds and the peak memory in bytes of a finished child process.
+# On Windows these are read from the process handle. Elsewhere the CPU time is the growth of the
+# children resource usage, and the peak memory is the largest of any child so far.
+def get_child_usage(proc, rusage_before):
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                [(field, ctypes.c_size_t) for field in ['PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                    'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+
+        handle = wintypes.HANDLE(int(proc._handle))
+        cpu_time = None
+        peak_rss = None
+        creation, exit, kernel, user = [wintypes.FILETIME() for i in range(4)]
+        if ctypes.windll.kernel32.GetProcessTimes(handle, ctypes.byref(creation), ctypes.byref(exit), ctypes.byref(kernel), ctypes.byref(user)):
+            cpu_time = sum((t.dwHighDateTime << 32) + t.dwLowDateTime for t in (kernel, user)) / 1e7
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            peak_rss = counters.PeakWorkingSetSize
+        return cpu_time, peak_rss
+
+    rusage_after = get_rusage_children()
+    if rusage_before is None or rusage_after is None:
+        return None, None
+    cpu_time = (rusage_after.ru_utime + rusage_after.ru_stime) - (rusage_before.ru_utime + rusage_before.ru_stime)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    peak_rss = rusage_after.ru_maxrss if sys.platform == 'darwin' else rusage_after.ru_maxrss * 1024
+    return cpu_time, peak_rss
+
+# The binary and its leading arguments up to the first option, e.g. "tabadmin.exe get". The trace
+# records commands this way, since their options may contain credentials.
+def get_command_name(binary_path, arguments):
+    words = [binary_path]
+    for arg in arguments:
+        if arg.startswith('-') or arg.startswith('/'):
+            break
+        words.append(arg)
+    return ' '.join(words)
+
+# The step scheduler shared with SilentInstaller, tracing its steps in the install trace
+class StepScheduler(install_common.StepScheduler):
+    def span(self, name):
+        return TRACE.span(name)
+
+
 # We allow the user to specify the runas parameters in the secrets file to keep it seperate from the general config file.
 # However, we need to use 'set' to get the server to recognize this.
 # Note that 'tabadmin install' is needed for this to have any effect.
 def configure_runas_secrets(tabadmin_path, secrets):
     had_runas_secret = False
     if must_set_value_for_parameter(secrets, 'runas_user'):
-        run_command(tabadmin_path, ['set', 'service.runas.username', secrets['runas_user']])
+        set_config_parameter(tabadmin_path, 'service.runas.username', secrets['runas_user'])
         had_runas_secret = True
     if must_set_value_for_parameter(secrets, 'runas_pass'):
-        run_command(tabadmin_path, ['set', 'service.runas.password', secrets['runas_pass']], False)
+        set_config_parameter(tabadmin_path, 'service.runas.password', secrets['runas_pass'], False)
         had_runas_secret = True
     return had_runas_secret
 
@@ -288,6 +408,24 @@ def install_service(tabadmin_path, options, secrets):
         
     run_command(tabadmin_path, tabadmin_args)
 
+# If they're using the 'trial' option, activate with that. Otherwise, use the license key given on the cmdline
+def activate_product(tabadmin_path, options):
+    if options.trial:
+        print('Activating product using trial option')
+        run_command(tabadmin_path, ['activate', '--trial'])
+    else:
+        print('Activating product')
+        run_command(tabadmin_path, ['activate', '--key', options.licenseKey])
+
+def register_product(tabadmin_path, options):
+    print('Registering product set')
+    run_command(tabadmin_path, ['register', '--file', options.registrationFile])
+
+# Start it up!
+def start_server(tabadmin_path):
+    print('Server is starting')
+    run_command(tabadmin_path, ['start'])
+
 # Runs the installer.exe, and checks for the exit code
 def run_inno_installer(inno_installer_args, options):
     if not options.installerLog:
@@ -298,7 +436,7 @@ def run_inno_installer(inno_installer_args, options):
     inno_installer_args.append('/LOG=' + options.installerLog)
 
     try:
-        run_command(options.installer, inno_installer_args)
+        run_command(options.installer, inno_installer_args, capture_output=False)
     except ExitCodeError as ex:
         if(ex.exit_code >= 1 and ex.exit_code <= 8):
             print_error(INNO_SETUP_EXIT_CODES[ex.exit_code])
@@ -307,19 +445,19 @@ def run_inno_installer(inno_installer_args, options):
 
         # print the last 5 lines from the Inno Setup log
         print_error('For more details see log file %s' % options.installerLog)
-        with open(options.installerLog) as inno_log_file:
-            content = inno_log_file.readlines()
-            for line in content[-5:]:
-                print_error(line)
+        for line in tail_file(options.installerLog, 5):
+            print_error(line)
         raise
 
-# Where are tabadmin.exe, tabcmd.exe, etc located? Somewhere under our install path. Go find it!
-def get_tab_binaries_path(options):
+# Where the binaries of each installation directory were found, so that a non-standard layout only has to be
+# searched once
+BINARIES_INDEX_PATH = os.path.join(tempfile.gettempdir(), 'ScriptedInstallerBinaries.json')
+
+# Where are tabadmin.exe, tabcmd.exe, etc located? Somewhere under our install path, see
+# install_common.find_binaries_directory. A plan leaves the binaries index unchanged.
+def get_tab_binaries_path(options, binary_name='tabadmin.exe'):
     print('Getting binaries path')
-    for root, dirs, files in os.walk(options.installDir):
-        if "tabadmin.exe" in files:
-            return root
-    return None
+    return install_common.find_binaries_directory(options.installDir, binary_name, BINARIES_INDEX_PATH, write_index=not options.plan)
 
 # Where is Windows' netsh.exe located? Probably under C:\Windows , but we can't guarantee that.
 # Go find it under wherever Windows is actually installed.
@@ -330,43 +468,116 @@ def get_netsh_path():
         raise MissingExecutableError('The executable file %s does not exist' % netsh_exe)
     return netsh_exe
 
+def get_workgroup_yml_path(options):
+    workgroup_yml_base_dir = options.installDir if (options.installDir != TABLEAU_DEFAULT_INSTALL_DIR) else TABLEAU_DEFAULT_DATA_DIR
+    return os.path.join(workgroup_yml_base_dir, RELATIVE_WORKGROUP_YML_PATH)
+
 def get_workgroup_yml(options):
     print("get_workgroup_yml with installDir set to: %s" % options.installDir)
-    workgroup_yml_base_dir = options.installDir if (options.installDir != TABLEAU_DEFAULT_INSTALL_DIR) else TABLEAU_DEFAULT_DATA_DIR
-    workgroup_yml_path = os.path.join(workgroup_yml_base_dir, RELATIVE_WORKGROUP_YML_PATH)
-    with open(workgroup_yml_path) as yaml_file:
-        return yaml.safe_load(yaml_file)
+    with open(get_workgroup_yml_path(options)) as yaml_file:
+        return yaml.load(yaml_file, Loader=YAML_LOADER)
+
+# An in-memory snapshot of the server configuration. workgroup.yml is parsed once and every lookup is
+# served from the parsed document; it is parsed again when the file's modification time or size changes,
+# or after the snapshot was invalidated by 'tabadmin set' or 'tabadmin configure'.
+# If workgroup.yml can't be read, values are looked up with "tabadmin get" and remembered.
+class ConfigSnapshot(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file_stamp = None
+        self.values = None
+        self.tabadmin_values = {}
+
+    # Forget everything that has been read so far
+    def invalidate(self):
+        with self.lock:
+            self.file_stamp = None
+            self.values = None
+            self.tabadmin_values = {}
+
+    # Look up several configuration parameters at once. Returns a dict from parameter to value, with None
+    # for parameters that aren't set.
+    def get_many(self, options, tabadmin_path, config_parameters):
+        with self.lock:
+            values = self.load(options)
+            if values is not None:
+                return dict((parameter, str(values[parameter]) if parameter in values else None) for parameter in config_parameters)
+            for parameter in config_parameters:
+                if parameter not in self.tabadmin_values:
+                    self.tabadmin_values[parameter] = get_config_parameter_from_tabadmin(tabadmin_path, parameter)
+            return dict((parameter, self.tabadmin_values[parameter]) for parameter in config_parameters)
+
+    def get(self, options, tabadmin_path, config_parameter):
+        return self.get_many(options, tabadmin_path, [config_parameter])[config_parameter]
+
+    # Return the parsed workgroup.yml, parsing it again only if it changed since it was last loaded.
+    # Returns None if it can't be read. Must be called with the lock held.
+    def load(self, options):
+        path = get_workgroup_yml_path(options)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        stamp = (path, stat.st_mtime, stat.st_size)
+        if self.values is None or stamp != self.file_stamp:
+            try:
+                self.values = get_workgroup_yml(options) or {}
+            except (IOError, yaml.YAMLError) as ex:
+                print_error('Could not read %s, falling back to "tabadmin get": %s' % (path, str(ex)))
+                self.values = None
+                return None
+            self.file_stamp = stamp
+        return self.values
+
+CONFIG_SNAPSHOT = ConfigSnapshot()
 
 # Get a configuration parameter using tabadmin get. The output contains some preceding text, so we have
 # to ignore that that to get the actual value. The return value from tabadmin get is 0 whether that config parameter
 # is actually set or not.
-# Some older versions of the server don't have "tabadmin get". In that case, hack our way to it; find the
-# workgroup.yml file, load it, and read the file directly from it.
-# If we detect that "tabadmin get" isn't available, set a global flag so we don't waste time on further calls
-# trying to call it.
-def get_config_parameter(options, tabadmin_path, config_parameter):
+# Some older versions of the server don't have "tabadmin get". If we detect that "tabadmin get" isn't available,
+# set a global flag so we don't waste time on further calls trying to call it.
+def get_config_parameter_from_tabadmin(tabadmin_path, config_parameter):
     global TABADMIN_HAS_GET_COMMAND
-    if TABADMIN_HAS_GET_COMMAND:
-        try:
-            tabadmin_output = run_command(tabadmin_path, ['get', config_parameter])
-            # Filter out extraneous stuff from output; all we want is the value.
-            match = re.search('(?<=is:)[\s\w]+', tabadmin_output)
-            if match:
-                value = match.group(0)
-                if value:
-                    return value.strip()
-        except ExitCodeError as ex:
-            pass
-        # If we get here, running the command failed for some reason. fallback to trying to read the value directly.
-        print("\"tabadmin get %s\" failed; falling back to manual parsing." % config_parameter)
-        TABADMIN_HAS_GET_COMMAND = False
-        return get_config_parameter(options, tabadmin_path, config_parameter)
-    else:
-        workgroup_yml = get_workgroup_yml(options)
-        if config_parameter in workgroup_yml:
-            if config_parameter in workgroup_yml:
-                return str(workgroup_yml[config_parameter])
+    if not TABADMIN_HAS_GET_COMMAND:
         return None
+    try:
+        tabadmin_output = run_command(tabadmin_path, ['get', config_parameter])
+        # Filter out extraneous stuff from output; all we want is the value.
+        match = re.search('(?<=is:)[\s\w]+', tabadmin_output)
+        if match:
+            value = match.group(0)
+            if value:
+                return value.strip()
+    except ExitCodeError as ex:
+        pass
+    print("\"tabadmin get %s\" failed." % config_parameter)
+    TABADMIN_HAS_GET_COMMAND = False
+    return None
+
+# Get a configuration parameter. Values come from a snapshot of workgroup.yml, so repeated lookups don't start
+# a tabadmin process each.
+def get_config_parameter(options, tabadmin_path, config_parameter):
+    return CONFIG_SNAPSHOT.get(options, tabadmin_path, config_parameter)
+
+# Get several configuration parameters in one lookup. config_defaults maps each parameter to the value
+# used if it isn't set.
+def get_config_parameters(options, tabadmin_path, config_defaults):
+    values = CONFIG_SNAPSHOT.get_many(options, tabadmin_path, list(config_defaults.keys()))
+    return dict((parameter, values[parameter] or default) for parameter, default in config_defaults.items())
+
+# Set a configuration parameter, and drop the configuration snapshot
+def set_config_parameter(tabadmin_path, config_parameter, value, show_value=True):
+    try:
+        run_command(tabadmin_path, ['set', config_parameter, value], show_value)
+    finally:
+        CONFIG_SNAPSHOT.invalidate()
+
+# Run 'tabadmin configure', which rewrites workgroup.yml, and drop the configuration snapshot
+def configure_server(tabadmin_path):
+    try:
+        run_command(tabadmin_path, ['configure'])
+    finally:
+        CONFIG_SNAPSHOT.invalidate()
 
 # Open the firewall on a given port.
 def open_firewall_for_gateway(tabadmin_path, gateway_port, options):
@@ -385,50 +596,174 @@ def open_firewall_for_gateway(tabadmin_path, gateway_port, options):
         print_error('attempt to modify firewall using advfirewall exited with code %d' % ex.exit_code)
         raise ex
 
+# Configuration parameters that decide which firewall rules are added, and their defaults
+FIREWALL_CONFIG_DEFAULTS = {
+    'install.firewall.gatewayhole': 'false',
+    'ssl.enabled': 'false',
+    'ssl.port': '443',
+}
+
 # If we need any firewall rules added, add them. If we have any, we'll always have one for the non-SSL port; if
 # we have SSL enabled, open a hole for that, too.
 def handle_firewalls(tabadmin_path, gateway_port, options):
-    open_firewall = get_config_parameter(options, tabadmin_path, 'install.firewall.gatewayhole') or 'false'
+    config = get_config_parameters(options, tabadmin_path, FIREWALL_CONFIG_DEFAULTS)
+    open_firewalls(tabadmin_path, gateway_port, config['install.firewall.gatewayhole'], config['ssl.enabled'], config['ssl.port'], options)
+
+# Add the firewall rules, given the already looked up configuration values
+def open_firewalls(tabadmin_path, gateway_port, open_firewall, open_ssl_port, ssl_gateway_port, options):
     if open_firewall.lower() == 'true':
         print('Opening firewall for connections to the gateway')
         open_firewall_for_gateway(tabadmin_path, gateway_port, options)
-        open_ssl_port = get_config_parameter(options, tabadmin_path, 'ssl.enabled') or 'false'
         if open_ssl_port.lower() == 'true':
             print('Opening firewall for connections to the gateway')
-            ssl_gateway_port = get_config_parameter(options, tabadmin_path, 'ssl.port') or '443'
             open_firewall_for_gateway(tabadmin_path, ssl_gateway_port, options)
     else:
         print('Not opening firewall for connections to the gateway')
 
+# Output of external commands is copied to this logger. It has no handlers until
+# open_command_log() is called.
+COMMAND_LOG = logging.getLogger('ScriptedInstaller.commands')
+COMMAND_LOG.propagate = False
+COMMAND_LOG.setLevel(logging.INFO)
+# Python 2 complains about loggers without handlers
+COMMAND_LOG.addHandler(logging.NullHandler())
+
+# Number of output lines of a command kept for error reporting
+OUTPUT_TAIL_LINES = 100
+
+# Start copying the output of external commands to a rotating log file
+def open_command_log(path, max_bytes=10 * 1024 * 1024, backup_count=5):
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    COMMAND_LOG.addHandler(handler)
+
+# Read the output of a child process line by line as it is produced. Each line is echoed to
+# the console and copied to the command log. Only the last OUTPUT_TAIL_LINES lines are kept for
+# error reporting, unless the full output is captured. Returns the captured output and the tail.
+def stream_output(proc, command, capture=False):
+    encoding = locale.getpreferredencoding(False)
+    tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    captured = [] if capture else None
+    for raw_line in iter(proc.stdout.readline, b''):
+        line = raw_line.decode(encoding, 'replace').rstrip(u'\r\n')
+        tail.append(line)
+        if captured is not None:
+            captured.append(line + u'\n')
+        print(line)
+        COMMAND_LOG.info(u'%s: %s', command, line)
+    proc.stdout.close()
+    proc.wait()
+    return (u''.join(captured) if captured is not None else None), list(tail)
+
+# Return the last line_count lines of a file, reading blocks backwards from its end,
+# so that large log files are not read completely
+def tail_file(file_path, line_count, block_size=64 * 1024):
+    with open(file_path, 'rb') as log_file:
+        # installer logs may be written in UTF-16
+        byte_order_mark = log_file.read(2)
+        encoding = {b'\xff\xfe': 'utf-16-le', b'\xfe\xff': 'utf-16-be'}.get(byte_order_mark, locale.getpreferredencoding(False))
+        newline = u'\n'.encode(encoding)
+        log_file.seek(0, os.SEEK_END)
+        position = log_file.tell()
+        data = b''
+        while position > 0 and data.count(newline) <= line_count:
+            read_size = min(block_size, position)
+            position -= read_size
+            log_file.seek(position)
+            data = log_file.read(read_size) + data
+    if encoding.startswith('utf-16'):
+        # skip the byte order mark, or keep the code units aligned with the start of the file
+        data = data[2:] if position == 0 else data[position % 2:]
+    text = data.decode(encoding, 'replace')
+    return text.splitlines()[-line_count:]
+
 # Run a command. If the exit code isn't zero, it'll throw an exception.
 # If exit code is zero, return the output from running the command.
-def run_command(binary_path, arguments, show_args=True):
+def run_command(binary_path, arguments, show_args=True, capture_output=True):
     if not os.path.isfile(binary_path):
         raise MissingExecutableError('The executable file %s does not exist' % binary_path)
     print("Running: " + str(binary_path) + str(arguments if show_args else ''))
-    try:
-        output = subprocess.check_output([binary_path] + arguments, stderr=subprocess.STDOUT)
-        return output
-    except subprocess.CalledProcessError as ex:
-        print_error("Failed with output %s" % ex.output)
-        raise ExitCodeError(binary_path, ex.returncode)
+    return run_process([binary_path] + arguments, binary_path, get_command_name(binary_path, arguments), capture_output)
+
+# Run a command line given by the user, such as a remote execution template, through the shell.
+def run_shell_command(command_line, command_name, capture_output=True):
+    print("Running: " + command_line)
+    return run_process(command_line, command_name, command_name, capture_output, shell=True)
+
+def run_process(args, binary, command, capture_output, shell=False):
+    rusage_before = get_rusage_children()
+    started = time.time()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=shell)
+    output, tail = stream_output(proc, command, capture_output)
+    cpu_time, peak_rss = get_child_usage(proc, rusage_before)
+    TRACE.command(command, proc.returncode, started, time.time() - started, cpu_time, peak_rss)
+    if proc.returncode != 0:
+        print_error("Failed with output:")
+        for line in tail:
+            print_error(line)
+        raise ExitCodeError(binary, proc.returncode)
+    return output
 
 # Install the server; run installer, install services, activate, register, open firewall ports, whatever.
-def run_install(options, secrets):
-    # Run the installer. This unpacks the binaries and does initial boostrapping. After this is done, we have
-    # a runnable server.
-    print('Running installer executable')
-
+# The arguments of the installer executable for an install or an upgrade
+def get_inno_installer_args(options):
     inno_installer_args = [
         '/VERYSILENT',          # No progress GUI, message boxes still possible
         '/SUPPRESSMSGBOXES',    # No message boxes. Only has an effect when combined with '/SILENT' or '/VERYSILENT'.
         '/ACCEPTEULA',
         '/DIR=' + options.installDir
     ]
-    if options.configFile:
+    if options.installer_action == 'install' and options.configFile:
         inno_installer_args.append('/CUSTOMCONFIG=' + options.configFile)
+    if options.installer_action == 'upgrade' and options.fastuninstall:
+        inno_installer_args.append('/FASTUNINSTALL')
+    return inno_installer_args
+
+# Add the install steps that run after the installer and 'tabadmin configure' to the scheduler.
+# Service installation, activation, registration and start depend on each other, but the
+# configuration lookup and the firewall rules don't depend on them.
+def add_install_steps(scheduler, options, secrets, tabadmin_path, tabcmd_path):
+    # Install the Windows service
+    scheduler.add('install service', install_service, (tabadmin_path, options, secrets), description='tabadmin install --auto')
+    scheduler.add('activate', activate_product, (tabadmin_path, options), ['install service'],
+                  'tabadmin activate ' + ('--trial' if options.trial else '--key'))
+    scheduler.add('register', register_product, (tabadmin_path, options), ['activate'], 'tabadmin register --file ' + options.registrationFile)
+    scheduler.add('start', start_server, (tabadmin_path,), ['register'], 'tabadmin start')
+
+    config_defaults = dict(FIREWALL_CONFIG_DEFAULTS)
+    config_defaults['worker0.gateway.port'] = '80'
+    scheduler.add('configuration', get_config_parameters, (options, tabadmin_path, config_defaults),
+                  description='read ' + ', '.join(sorted(config_defaults)))
+
+    # Open any firewall holes, if desired.
+    def firewalls():
+        config = scheduler.results['configuration']
+        open_firewalls(tabadmin_path, config['worker0.gateway.port'], config['install.firewall.gatewayhole'],
+                       config['ssl.enabled'], config['ssl.port'], options)
+    scheduler.add('firewall', firewalls, (), ['configuration'], 'netsh advfirewall firewall add rule, if install.firewall.gatewayhole is set')
+
+    # Register our initial user
+    def initial_user():
+        print('Server is installed and running')
+        gateway_port = scheduler.results['configuration']['worker0.gateway.port']
+        # Just in case we're using SSL, we'll be redirected, so using the non-ssl port will be fine.
+        # However, skip checking the cert in case it's self-signed.
+        run_command(tabcmd_path, ['initialuser', '--server', 'localhost:' + gateway_port,
+                    '--no-certcheck', '--no-prompt',
+                    '--username', secrets['content_admin_user'], '--password', secrets['content_admin_pass']]
+                    , False)
+        print('Initial admin created')
+    scheduler.add('initial user', initial_user, (), ['start', 'configuration'], 'tabcmd initialuser --server localhost:<gateway port>')
+
+def run_install(options, secrets):
+    # Run the installer. This unpacks the binaries and does initial boostrapping. After this is done, we have
+    # a runnable server.
+    print('Running installer executable')
+
+    inno_installer_args = get_inno_installer_args(options)
 
-    run_inno_installer(inno_installer_args, options)
+    with TRACE.span('installer'):
+        run_inno_installer(inno_installer_args, options)
 
     # Get path to relevant binaries
     binaries_path = get_tab_binaries_path(options)
@@ -442,41 +777,138 @@ def run_install(options, secrets):
         print('Runas credentials not specified; using defaults')
 
     # Run configure to be sure any credential changes are properly distributed. This also works around AWS-related configuration quirks.
-    run_command(tabadmin_path, ['configure'])
+    configure_server(tabadmin_path)
 
-        # Install the Windows service
-    install_service(tabadmin_path, options, secrets)
+    # The remaining steps run as a dependency graph
+    scheduler = StepScheduler()
+    add_install_steps(scheduler, options, secrets, tabadmin_path, tabcmd_path)
+    try:
+        scheduler.run()
+    finally:
+        scheduler.print_critical_path()
 
-    # If they're using the 'trial' option, activate with that. Otherwise, use the license key given on the cmdline
-    if options.trial:
-        print('Activating product using trial option')
-        run_command(tabadmin_path, ['activate', '--trial'])
-    else:
-        print('Activating product')
-        run_command(tabadmin_path, ['activate', '--key', options.licenseKey])
+    print('Installation complete')
 
-    print('Registering product set')
-    run_command(tabadmin_path, ['register', '--file', options.registrationFile])
+# The hosts of the cluster from worker.hosts. The first one is the primary.
+def get_cluster_hosts(options, tabadmin_path):
+    worker_hosts = get_config_parameter(options, tabadmin_path, 'worker.hosts') or ''
+    return [host.strip() for host in worker_hosts.split(',') if host.strip()]
+
+# Copy the worker installer to a worker host before the upgrade starts, so that the batches don't
+# wait for the copy. Returns the path of the copy.
+def stage_worker_installer(options, host):
+    staging_dir = options.stagingDir.format(host=host)
+    staged_installer = os.path.join(staging_dir, os.path.basename(options.workerInstaller))
+    print('Copying %s to %s' % (options.workerInstaller, staged_installer))
+    try:
+        shutil.copyfile(options.workerInstaller, staged_installer)
+    except (IOError, OSError) as ex:
+        raise WorkerUpgradeError('Could not copy the worker installer to %s: %s' % (host, str(ex)))
+    return staged_installer
+
+# Run the worker installer on one worker host through the workerUpgradeCommand template
+def upgrade_worker(options, host, installer):
+    command_line = options.workerUpgradeCommand.format(host=host, installer=installer, installDir=options.installDir)
+    run_shell_command(command_line, 'worker upgrade ' + host, capture_output=False)
+
+# The version directory of the executable of a service, from the output of sc qc: 10.5 for
+# "C:\Program Files\Tableau\Tableau Server\10.5\bin\tabsvc.exe". None if there is no such service.
+def get_service_version(service_config):
+    match = re.search(r'BINARY_PATH_NAME\s*:\s*"?([^"\r\n]+)', service_config)
+    if not match:
+        return None
+    return install_common.binaries_version(os.path.dirname(match.group(1).strip().replace('\\', os.sep)))
+
+# Is a worker host upgraded? Uses workerHealthCommand if it was given, which must exit with 0 when the
+# worker is healthy. Otherwise the host's service control manager must have the tabsvc service of the new
+# version installed; the service isn't running yet, since the cluster is only started after all batches.
+def is_worker_healthy(options, host, version):
+    try:
+        if options.workerHealthCommand:
+            run_shell_command(options.workerHealthCommand.format(host=host), 'worker health ' + host)
+            return True
+        return get_service_version(SYSTEM.query_service_config(host, 'tabsvc')) == version
+    except ExitCodeError:
+        return False
+
+# Wait until every host of an upgraded batch is healthy, or raise once workerHealthTimeout has passed
+def wait_for_healthy_workers(options, hosts, version, poll_interval=10):
+    deadline = time.time() + options.workerHealthTimeout
+    unhealthy = list(hosts)
+    while True:
+        unhealthy = [host for host in unhealthy if not is_worker_healthy(options, host, version)]
+        if not unhealthy:
+            return
+        if time.time() + poll_interval > deadline:
+            raise WorkerUpgradeError('Workers not healthy after the upgrade: ' + ', '.join(unhealthy))
+        print('Waiting for upgraded workers: ' + ', '.join(unhealthy))
+        time.sleep(poll_interval)
+
+# Upgrade the worker hosts in batches of workerBatchSize. The hosts of a batch are upgraded at the same
+# time, and the next batch only starts once all of them are healthy. If a batch fails, the remaining
+# batches aren't started.
+def upgrade_workers(options, workers, installers, version):
+    batches = [workers[i:i + options.workerBatchSize] for i in range(0, len(workers), options.workerBatchSize)]
+    for number, batch in enumerate(batches, 1):
+        print('Upgrading batch %d of %d: %s' % (number, len(batches), ', '.join(batch)))
+        scheduler = StepScheduler(max_workers=len(batch))
+        for host in batch:
+            scheduler.add('upgrade ' + host, upgrade_worker, (options, host, installers[host]))
+        with TRACE.span('batch %d' % number):
+            scheduler.run()
+            wait_for_healthy_workers(options, batch, version)
+        print('Batch %d upgraded' % number)
+
+# Upgrade a cluster: the primary is upgraded with the server installer while the worker installer is copied
+# to every worker host, then the workers are upgraded batch by batch, and the server is started once at the end.
+def run_cluster_upgrade(options, secrets, tabadmin_path, inno_installer_args):
+    workers = get_cluster_hosts(options, tabadmin_path)[1:]
+    print('Upgrading the primary and %d workers: %s' % (len(workers), ', '.join(workers)))
+
+    scheduler = StepScheduler(max_workers=len(workers) + 1)
+    scheduler.add('primary', upgrade_primary, (options, secrets, inno_installer_args))
+    if not options.fastuninstall:
+        for host in workers:
+            scheduler.add('stage ' + host, stage_worker_installer, (options, host))
+    try:
+        scheduler.run()
+    finally:
+        scheduler.print_critical_path()
+    tabadmin_path = scheduler.results['primary']
+
+    installers = dict((host, scheduler.results.get('stage ' + host, options.workerInstaller)) for host in workers)
+    # the version the primary was upgraded to, which the workers must have once they are upgraded
+    version = install_common.binaries_version(os.path.dirname(tabadmin_path))
+    upgrade_workers(options, workers, installers, version)
 
-    # Start it up!
     print('Server is starting')
     run_command(tabadmin_path, ['start'])
+    print('Cluster upgrade complete.')
 
-    # Register our initial user
-    print('Server is installed and running')
-    gateway_port = get_config_parameter(options, tabadmin_path, 'worker0.gateway.port') or '80'
-    # Just in case we're using SSL, we'll be redirected, so using the non-ssl port will be fine.
-    # However, skip checking the cert in case it's self-signed.
-    run_command(tabcmd_path, ['initialuser', '--server', 'localhost:' + gateway_port,
-                '--no-certcheck', '--no-prompt',
-                '--username', secrets['content_admin_user'], '--password', secrets['content_admin_pass']]
-                , False)
-    print('Initial admin created')
+# Run the installer on this machine and re-install the service, without starting the server.
+# Returns the path of the new tabadmin.exe.
+def upgrade_primary(options, secrets, inno_installer_args):
+    with TRACE.span('installer'):
+        run_inno_installer(inno_installer_args, options)
 
-    # Open any firewall holes, if desired.
-    handle_firewalls(tabadmin_path, gateway_port, options)
+    # So, our paths likely have changed after the upgrade. Find them again.
+    binaries_path = get_tab_binaries_path(options)
+    if not binaries_path:
+        raise ExistingInstallationError("Could not find newly installed binaries")
+    tabadmin_path = os.path.join(binaries_path, 'tabadmin.exe')
 
-    print('Installation complete')
+    # If a secrets file was specified (which is required if they're not using the default runas username 
+    # and password), set the values.
+    if configure_runas_secrets(tabadmin_path, secrets):
+        print('Set runas credentials into configuration for performing upgrade')
+        # Run configure to be sure any credential changes are properly distributed.
+        configure_server(tabadmin_path)
+    else:
+        print('Runas credentials not specified; username will be unchanged, password assumed to be blank')
+
+    # Re-install the Windows service (just in case the runas user changed)
+    install_service(tabadmin_path, options, secrets)
+    return tabadmin_path
 
 def run_upgrade(options, secrets):
     print('Running installer executable to perform update')
@@ -492,59 +924,126 @@ def run_upgrade(options, secrets):
     print("Checking to see if this is a cluster, which would require a minimum version to upgrade from")
     validate_multi_node_upgrade_versions(server_version, tabadmin_path, options)
 
-    inno_installer_args = [
-        '/VERYSILENT',          # No progress GUI, message boxes still possible
-        '/SUPPRESSMSGBOXES',    # No message boxes. Only has an effect when combined with '/SILENT' or '/VERYSILENT'.
-        '/ACCEPTEULA',
-        '/DIR=' + options.installDir
-    ]
+    inno_installer_args = get_inno_installer_args(options)
     if options.fastuninstall:
         print("Using FASTUNINSTALL option")
-        inno_installer_args.append('/FASTUNINSTALL')
     else:
         print("Not using FASTUNINSTALL option")
 
-    run_inno_installer(inno_installer_args, options)
-
-    # So, our paths likely have changed after the upgrade. Find them again.
-    binaries_path = get_tab_binaries_path(options)
-    if not binaries_path:
-        raise ExistingInstallationError("Could not find newly installed binaries")
-    tabadmin_path = os.path.join(binaries_path, 'tabadmin.exe')
+    if options.cluster:
+        run_cluster_upgrade(options, secrets, tabadmin_path, inno_installer_args)
+        return
 
-    # If a secrets file was specified (which is required if they're not using the default runas username 
-    # and password), set the values.
-    if configure_runas_secrets(tabadmin_path, secrets):
-        print('Set runas credentials into configuration for performing upgrade')
-        # Run configure to be sure any credential changes are properly distributed.
-        run_command(tabadmin_path, ['configure'])
-    else:
-        print('Runas credentials not specified; username will be unchanged, password assumed to be blank')
+    tabadmin_path = upgrade_primary(options, secrets, inno_installer_args)
 
-    # Re-install the Windows service (just in case the runas user changed)
-    install_service(tabadmin_path, options, secrets)
-    
-    # Get path to relevant binaries
     # Start it up!
     print('Server is starting')
     run_command(tabadmin_path, ['start'])
     print('Upgrade complete.')
 
+# Rough durations in seconds, used by --plan for steps without timing history. Stage and batch
+# steps of a cluster upgrade use the 'stage' and 'batch' estimates.
+DEFAULT_STEP_ESTIMATES = {
+    'installer': 900,
+    'configure': 60,
+    'install service': 60,
+    'activate': 15,
+    'register': 15,
+    'start': 300,
+    'configuration': 5,
+    'firewall': 10,
+    'initial user': 30,
+    'stage': 60,
+    'batch': 1200
+}
+
+# Build the steps an install or upgrade would run as a scheduler that is never run
+def make_plan(options, secrets):
+    installer_command = ' '.join([options.installer] + get_inno_installer_args(options))
+    configure_command = 'tabadmin configure'
+    if must_set_value_for_parameter(secrets, 'runas_user') or must_set_value_for_parameter(secrets, 'runas_pass'):
+        configure_command = 'tabadmin set service.runas.*, tabadmin configure'
+    tabadmin_path = os.path.join(options.installDir, 'bin', 'tabadmin.exe')
+
+    if options.installer_action == 'install':
+        scheduler = StepScheduler()
+        scheduler.add('installer', run_inno_installer, (), description=installer_command)
+        scheduler.add('configure', configure_server, (), ['installer'], configure_command)
+        add_install_steps(scheduler, options, secrets, tabadmin_path, tabadmin_path)
+        for name in scheduler.steps[2:]:
+            if not [dependency for dependency in scheduler.dependencies[name] if dependency in scheduler.functions]:
+                scheduler.dependencies[name].append('configure')
+        return scheduler
+
+    workers = []
+    if options.cluster:
+        workers = get_cluster_hosts(options, tabadmin_path)[1:]
+        print('Workers: ' + (', '.join(workers) or 'none'))
+    scheduler = StepScheduler(max_workers=len(workers) + 1)
+    scheduler.add('installer', run_inno_installer, (), description=installer_command)
+    upgraded = 'installer'
+    if configure_command != 'tabadmin configure':
+        scheduler.add('configure', configure_server, (), ['installer'], configure_command)
+        upgraded = 'configure'
+    scheduler.add('install service', install_service, (), [upgraded], 'tabadmin install --auto')
+    upgraded = 'install service'
+    if workers and not options.fastuninstall:
+        for host in workers:
+            scheduler.add('stage ' + host, stage_worker_installer, (), description='copy %s to %s' % (options.workerInstaller, options.stagingDir.format(host=host)))
+    batches = [workers[i:i + options.workerBatchSize] for i in range(0, len(workers), options.workerBatchSize)]
+    for number, batch in enumerate(batches, 1):
+        depends_on = [upgraded] + ['stage ' + host for host in batch]
+        scheduler.add('batch %d' % number, upgrade_workers, (), depends_on,
+                      '; '.join(options.workerUpgradeCommand.format(host=host, installer=options.workerInstaller, installDir=options.installDir) for host in batch))
+        upgraded = 'batch %d' % number
+    scheduler.add('start', start_server, (), [upgraded], 'tabadmin start')
+    return scheduler
+
+# Validate the inputs and print the steps an install or upgrade would run with estimated durations,
+# without changing anything or starting any process
+def run_plan(options, secrets):
+    global TABADMIN_HAS_GET_COMMAND
+    print('Planning %s' % options.installer_action)
+    if options.installer_action == 'upgrade':
+        binaries_path = get_tab_binaries_path(options)
+        if not binaries_path:
+            raise ExistingInstallationError("No existing installation detected at %s; cannot upgrade" % options.installDir)
+        print('Existing installation: ' + binaries_path)
+        # Configuration values come from workgroup.yml only; tabadmin isn't started
+        TABADMIN_HAS_GET_COMMAND = False
+    trace_files = [path for path in (options.planHistory or '').split(',') if path]
+    estimates, measured = install_common.load_step_estimates(trace_files, DEFAULT_STEP_ESTIMATES)
+    scheduler = make_plan(options, secrets)
+    for prefix in ('stage', 'batch'):
+        install_common.share_estimate(estimates, measured, [name for name in scheduler.steps if name.startswith(prefix + ' ')], prefix)
+    install_common.print_plan(scheduler, estimates, measured)
+    return 0
+
 # Main entry point
 def main():
     # Make sure they're using a version of Python we're okay with
     try:
         validate_python_version()
         options = get_options()
+        if options.plan:
+            if options.installer_action == 'install':
+                return run_plan(options, validate_install_inputs(options))
+            return run_plan(options, validate_upgrade_inputs(options))
+        if options.traceFile:
+            TRACE.open(options.traceFile)
+        if options.commandLog:
+            open_command_log(options.commandLog)
         if options.installer_action == 'install':
             print("Trying to perform install")
             validate_no_existing_installation()
             secrets = validate_install_inputs(options)
-            run_install(options, secrets)
+            with TRACE.span('install'):
+                run_install(options, secrets)
         elif options.installer_action == 'upgrade':
             print("Trying to perform update")
             secrets = validate_upgrade_inputs(options)
-            run_upgrade(options, secrets)
+            with TRACE.span('upgrade'):
+                run_upgrade(options, secrets)
         else:
             raise OptionsError("Unknown action %s" % options.installer_action)
         return 0
@@ -560,6 +1059,11 @@ def main():
     except ValidationError as ve:
         print_error(ve)
         return 5
+    except WorkerUpgradeError as ex:
+        print_error(ex)
+        return 6
+    finally:
+        TRACE.close()
 
 if __name__ == '__main__':
     sys.exit(main())
\ No newline at end of file
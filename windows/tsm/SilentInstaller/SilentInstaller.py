@@ -5,13 +5,39 @@ import argparse
 import subprocess
 import tempfile
 import json
+import random
+import re
+import shutil
 import socket
+import ssl
+import threading
+import time
+import traceback
+import collections
+import concurrent.futures
+import http.client
+import locale
+import logging
+import logging.handlers
+import math
+import shlex
 import unicodedata
+import urllib.parse
 
 try:
     import winreg
 except ImportError:
-    import _winreg as winreg
+    try:
+        import _winreg as winreg
+    except ImportError:
+        # not on Windows; only usable with a replaced SYSTEM, e.g. the simulator
+        winreg = None
+
+# the step scheduler, install trace, plan and version helpers are shared with ScriptedInstaller.
+# install_common.py is found next to this script, as the AWS templates copy it, or in windows/common.
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.extend([SCRIPT_DIR, os.path.join(SCRIPT_DIR, os.pardir, os.pardir, 'common')])
+import install_common
 
 class Options(object):
     ''' Contains the user-configurable options for the installation,
@@ -32,6 +58,29 @@ class Options(object):
         'start': 'yes',
         'saveNodeConfiguration': 'yes',
         'nodeConfigurationDirectory': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nodeConfiguration.json'),
+        'transport': 'cli',
+        'licenseActivationWorkers': '4',
+        'workerExecutor': 'local',
+        'workerHosts': None,
+        'remoteCommand': None,
+        'parallelWorkerInstalls': None,
+        'nodeWaitTimeout': '3600',
+        'resume': False,
+        'traceFile': None,
+        'commandLog': None,
+        'minimumFreeDiskSpaceGB': '15',
+        'installerSha256': None,
+        'artifactCache': None,
+        'downloadConnections': '4',
+        'gatewayProbeRequests': '0',
+        'gatewayProbeConcurrency': '8',
+        'gatewayProbePaths': '/',
+        'gatewayProbeHosts': None,
+        'gatewayProbeThresholds': 'p95=1000,p99=3000,errorRate=0.01,regression=2',
+        'gatewayProbeAction': 'fail',
+        'gatewayProbeBaseline': None,
+        'plan': False,
+        'planHistory': None,
         'type': 'install'
     }
 
@@ -53,6 +102,13 @@ class Options(object):
         'installer'
     ]
 
+    installWorkersRequired = [
+        'secretsFile',
+        'configFile',
+        'nodeConfigurationFile',
+        'installer'
+    ]
+
 
     def __init__(self, user_options):
 
@@ -67,6 +123,8 @@ class Options(object):
         required_options = []
         if self.type == 'installWorker':
             required_options = Options.installWorkerRequired
+        elif self.type == 'installWorkers':
+            required_options = Options.installWorkersRequired
         elif self.type == 'updateTopology':
             required_options = Options.updateTopologyRequired
         else:
@@ -95,9 +153,15 @@ class ExistingInstallationError(Exception):
 class ExitCodeError(Exception):
     ''' An external command exited with a non-success exit code '''
 
-    def __init__(self, binary, exit_code):
+    def __init__(self, binary, exit_code, output_tail=None):
         super(ExitCodeError, self).__init__('%s execution exited with code: %d' % (str(binary), exit_code))
         self.exit_code = exit_code
+        # the last lines of output of the command, if it was captured
+        self.output_tail = output_tail or []
+
+class GatewayProbeError(Exception):
+    ''' The gateway answered the probe too slowly or with too many errors '''
+    pass
 
 def print_error(*args, **kwargs):
     '''  Prints an error string '''
@@ -115,6 +179,14 @@ def read_json_file(file_path):
     except ValueError as ex:
         raise OptionsError('The json file "%s" contains malformed json' % file_path)
 
+def read_json_object(file_path, name='json file'):
+    ''' Reads a json file that must contain an object '''
+
+    document = read_json_file(file_path)
+    if not isinstance(document, dict):
+        raise OptionsError('The %s "%s" must contain a json object' % (name, file_path))
+    return document
+
 def make_cmd_line_parser():
     ''' Creates a parser for the arguments passed on this script's command line '''
 
@@ -128,7 +200,7 @@ def make_cmd_line_parser():
     optional_flags.add_argument('--bootstrapFile', help='A json file containing all options listed here. When using this option, no other options can be specified on the command line.')
 
     # Required arguments
-    subparsers = parser.add_subparsers(help='Install Server, Install Worker or Update Topology')
+    subparsers = parser.add_subparsers(help='Install Server, Install Worker, Install Workers or Update Topology')
 
     ### INSTALL ARGS
     install_parser = subparsers.add_parser('install')
@@ -136,8 +208,16 @@ def make_cmd_line_parser():
 
     # Optional flags (have reasonable defaults)
     optional_flags = install_parser.add_argument_group('optional flags')
+    optional_flags.add_argument('--traceFile', help='Json lines file to write the timing of every step and command to. A Chrome trace event file is written next to it', default=Options.defaults['traceFile'])
+    optional_flags.add_argument('--commandLog', help='Rotating log file that receives the output of every external command', default=Options.defaults['commandLog'])
+    optional_flags.add_argument('--plan', help='Only print the steps that would run, with estimated durations. Nothing is installed or changed', action='store_true', default=Options.defaults['plan'])
+    optional_flags.add_argument('--planHistory', help='Comma separated --traceFile traces of earlier runs, used for the estimates of --plan', default=Options.defaults['planHistory'])
     optional_flags.add_argument('--installDir', help='Installation directory', default=Options.defaults['installDir'])
     optional_flags.add_argument('--dataDir', help='Data directory', default=Options.defaults['dataDir'])
+    optional_flags.add_argument('--minimumFreeDiskSpaceGB', help='Free disk space needed for the data directory, checked before the installer runs', default=Options.defaults['minimumFreeDiskSpaceGB'])
+    optional_flags.add_argument('--installerSha256', help='Expected SHA-256 of the installer. A cached installer with this digest is used without downloading or hashing it again', default=Options.defaults['installerSha256'])
+    optional_flags.add_argument('--artifactCache', help='Directory of the installer cache. An installer URL is always fetched into a cache; with this flag a local or share path is cached too', default=Options.defaults['artifactCache'])
+    optional_flags.add_argument('--downloadConnections', help='Number of chunks of the installer fetched at the same time', default=Options.defaults['downloadConnections'])
     optional_flags.add_argument('--controllerPort', help='TSM conroller port', default=Options.defaults['controllerPort'])
     optional_flags.add_argument('--coordinationserviceClientPort', help='ZooKeeper client port', default=Options.defaults['coordinationserviceClientPort'])
     optional_flags.add_argument('--coordinationservicePeerPort', help='ZooKeeper peer port', default=Options.defaults['coordinationservicePeerPort'])
@@ -150,13 +230,23 @@ def make_cmd_line_parser():
     optional_flags.add_argument('--start', help='Should Tableau Server start at the end of the installation?', choices=['yes', 'no'], default=Options.defaults['start'])
     optional_flags.add_argument('--saveNodeConfiguration', help='Should Tableau Server save the node configuration file for worker installation?', choices=['yes', 'no'], default=Options.defaults['saveNodeConfiguration'])
     optional_flags.add_argument('--nodeConfigurationDirectory', help='Directory to save the node setup file for worker installation if you choose YES for --saveNodeConfigurationFile option', default=Options.defaults['nodeConfigurationDirectory'])
+    optional_flags.add_argument('--transport', help='Run setup steps through the tsm command line, or directly against the TSM controller REST API', choices=['cli', 'rest'], default=Options.defaults['transport'])
+    optional_flags.add_argument('--resume', help='Resume a failed installation, skipping the steps recorded as completed in the checkpoint journal', action='store_true', default=Options.defaults['resume'])
+    optional_flags.add_argument('--licenseActivationWorkers', help='Number of product keys to activate at the same time', default=Options.defaults['licenseActivationWorkers'])
+    optional_flags.add_argument('--gatewayProbeRequests', help='Number of requests sent to the gateway once the server runs, to measure its latency. 0 skips the probe', default=Options.defaults['gatewayProbeRequests'])
+    optional_flags.add_argument('--gatewayProbeConcurrency', help='Number of gateway probe requests in flight at the same time', default=Options.defaults['gatewayProbeConcurrency'])
+    optional_flags.add_argument('--gatewayProbePaths', help='Comma separated paths requested by the gateway probe, in turn', default=Options.defaults['gatewayProbePaths'])
+    optional_flags.add_argument('--gatewayProbeHosts', help='Comma separated gateways to probe, as host, host:port or URL. Defaults to the gateway of this machine', default=Options.defaults['gatewayProbeHosts'])
+    optional_flags.add_argument('--gatewayProbeThresholds', help='Comma separated limits of the gateway probe: p50, p95 and p99 in milliseconds, errorRate as a fraction, and regression as a factor of the p95 of the baseline', default=Options.defaults['gatewayProbeThresholds'])
+    optional_flags.add_argument('--gatewayProbeAction', help='Whether a gateway probe over its thresholds fails the run or only warns', choices=['fail', 'warn'], default=Options.defaults['gatewayProbeAction'])
+    optional_flags.add_argument('--gatewayProbeBaseline', help='Json file keeping the gateway probe baseline of each gateway. Defaults to GatewayBaseline.json next to the node configuration file', default=Options.defaults['gatewayProbeBaseline'])
 
     # Required flags (no reasonable defaults)
     required_flags = install_parser.add_argument_group('required flags')
     required_flags.add_argument('--secretsFile', required=True, help='User credentials json file')
     required_flags.add_argument('--configFile', help='Configuration and topology json file')
     required_flags.add_argument('--registrationFile', help='User registration file')
-    required_flags.add_argument('installer', help='Installer path, e.g: Tableau-Server-64bit-9-3-1.exe')
+    required_flags.add_argument('installer', help='Installer path or http(s) URL, e.g: Tableau-Server-64bit-9-3-1.exe')
 
     ### INSTALL WORKER ARGS
     install_worker_parser = subparsers.add_parser('installWorker')
@@ -164,14 +254,52 @@ def make_cmd_line_parser():
 
     # Optional flags (no reasonable defaults)
     optional_flags = install_worker_parser.add_argument_group('optional flags')
+    optional_flags.add_argument('--traceFile', help='Json lines file to write the timing of every step and command to. A Chrome trace event file is written next to it', default=Options.defaults['traceFile'])
+    optional_flags.add_argument('--commandLog', help='Rotating log file that receives the output of every external command', default=Options.defaults['commandLog'])
+    optional_flags.add_argument('--plan', help='Only print the steps that would run, with estimated durations. Nothing is installed or changed', action='store_true', default=Options.defaults['plan'])
+    optional_flags.add_argument('--planHistory', help='Comma separated --traceFile traces of earlier runs, used for the estimates of --plan', default=Options.defaults['planHistory'])
     optional_flags.add_argument('--installDir', help='Installation directory', default=Options.defaults['installDir'])
     optional_flags.add_argument('--dataDir', help='Data directory', default=Options.defaults['dataDir'])
+    optional_flags.add_argument('--minimumFreeDiskSpaceGB', help='Free disk space needed for the data directory, checked before the installer runs', default=Options.defaults['minimumFreeDiskSpaceGB'])
+    optional_flags.add_argument('--installerSha256', help='Expected SHA-256 of the installer. A cached installer with this digest is used without downloading or hashing it again', default=Options.defaults['installerSha256'])
+    optional_flags.add_argument('--artifactCache', help='Directory of the installer cache. An installer URL is always fetched into a cache; with this flag a local or share path is cached too', default=Options.defaults['artifactCache'])
+    optional_flags.add_argument('--downloadConnections', help='Number of chunks of the installer fetched at the same time', default=Options.defaults['downloadConnections'])
 
     # Required flags (no reasonable defaults)
     required_flags = install_worker_parser.add_argument_group('required flags')
     required_flags.add_argument('--nodeConfigurationFile', help='Node configuration json file')
     required_flags.add_argument('--secretsFile', required=True, help='User credentials json file')
-    required_flags.add_argument('installer', help='Worker Installer path, e.g: Tableau-Worker-64bit-9-3-1.exe')
+    required_flags.add_argument('installer', help='Worker Installer path or http(s) URL, e.g: Tableau-Worker-64bit-9-3-1.exe')
+
+    ### INSTALL WORKERS ARGS
+    install_workers_parser = subparsers.add_parser('installWorkers')
+    install_workers_parser.set_defaults(type='installWorkers')
+
+    # Optional flags (have reasonable defaults)
+    optional_flags = install_workers_parser.add_argument_group('optional flags')
+    optional_flags.add_argument('--traceFile', help='Json lines file to write the timing of every step and command to. A Chrome trace event file is written next to it', default=Options.defaults['traceFile'])
+    optional_flags.add_argument('--commandLog', help='Rotating log file that receives the output of every external command', default=Options.defaults['commandLog'])
+    optional_flags.add_argument('--plan', help='Only print the steps that would run, with estimated durations. Nothing is installed or changed', action='store_true', default=Options.defaults['plan'])
+    optional_flags.add_argument('--planHistory', help='Comma separated --traceFile traces of earlier runs, used for the estimates of --plan', default=Options.defaults['planHistory'])
+    optional_flags.add_argument('--installDir', help='Installation directory', default=Options.defaults['installDir'])
+    optional_flags.add_argument('--dataDir', help='Data directory', default=Options.defaults['dataDir'])
+    optional_flags.add_argument('--controllerPort', help='TSM conroller port', default=Options.defaults['controllerPort'])
+    optional_flags.add_argument('--transport', help='Run setup steps through the tsm command line, or directly against the TSM controller REST API', choices=['cli', 'rest'], default=Options.defaults['transport'])
+    optional_flags.add_argument('--workerExecutor', help='How the worker installer is run for each node', choices=sorted(WORKER_EXECUTORS.keys()), default=Options.defaults['workerExecutor'])
+    optional_flags.add_argument('--workerHosts', help='Comma separated nodeId=host pairs. Nodes that are not listed use the nodeId as host name', default=Options.defaults['workerHosts'])
+    optional_flags.add_argument('--remoteCommand', help='Command that runs installWorker on a remote host when --workerExecutor is remote. May use {host}, {nodeId}, {installer}, {installDir}, {dataDir}, {secretsFile} and {nodeConfigurationFile}', default=Options.defaults['remoteCommand'])
+    optional_flags.add_argument('--parallelWorkerInstalls', help='Number of worker nodes installed at the same time. Defaults to all of them', default=Options.defaults['parallelWorkerInstalls'])
+    optional_flags.add_argument('--nodeWaitTimeout', help='Seconds to wait for all installed nodes to join the cluster', default=Options.defaults['nodeWaitTimeout'])
+    optional_flags.add_argument('--installerSha256', help='Expected SHA-256 of the installer. A cached installer with this digest is used without downloading or hashing it again', default=Options.defaults['installerSha256'])
+    optional_flags.add_argument('--artifactCache', help='Directory of the installer cache. An installer URL is always fetched into a cache; with this flag a local or share path is cached too', default=Options.defaults['artifactCache'])
+    optional_flags.add_argument('--downloadConnections', help='Number of chunks of the installer fetched at the same time', default=Options.defaults['downloadConnections'])
+
+    # Required flags (no reasonable defaults)
+    required_flags = install_workers_parser.add_argument_group('required flags')
+    required_flags.add_argument('--secretsFile', required=True, help='User credentials json file')
+    required_flags.add_argument('--configFile', help='Topology json file listing the nodes to install')
+    required_flags.add_argument('--nodeConfigurationFile', help='Node configuration json file')
+    required_flags.add_argument('installer', help='Worker Installer path or http(s) URL, e.g: Tableau-Worker-64bit-9-3-1.exe')
 
     ### UPDATE Topology ARGS
     update_topology_parser = subparsers.add_parser('updateTopology')
@@ -179,8 +307,21 @@ def make_cmd_line_parser():
 
     # Optional flags (have reasonable defaults)
     optional_flags = update_topology_parser.add_argument_group('optional flags')
+    optional_flags.add_argument('--traceFile', help='Json lines file to write the timing of every step and command to. A Chrome trace event file is written next to it', default=Options.defaults['traceFile'])
+    optional_flags.add_argument('--commandLog', help='Rotating log file that receives the output of every external command', default=Options.defaults['commandLog'])
+    optional_flags.add_argument('--plan', help='Only print the steps that would run, with estimated durations. Nothing is installed or changed', action='store_true', default=Options.defaults['plan'])
+    optional_flags.add_argument('--planHistory', help='Comma separated --traceFile traces of earlier runs, used for the estimates of --plan', default=Options.defaults['planHistory'])
     optional_flags.add_argument('--installDir', help='Installation directory', default=Options.defaults['installDir'])
     optional_flags.add_argument('--controllerPort', help='TSM conroller port', default=Options.defaults['controllerPort'])
+    optional_flags.add_argument('--transport', help='Run setup steps through the tsm command line, or directly against the TSM controller REST API', choices=['cli', 'rest'], default=Options.defaults['transport'])
+    optional_flags.add_argument('--nodeWaitTimeout', help='Seconds to wait for all nodes of the topology to join the cluster', default=Options.defaults['nodeWaitTimeout'])
+    optional_flags.add_argument('--gatewayProbeRequests', help='Number of requests sent to the gateway once the server runs, to measure its latency. 0 skips the probe', default=Options.defaults['gatewayProbeRequests'])
+    optional_flags.add_argument('--gatewayProbeConcurrency', help='Number of gateway probe requests in flight at the same time', default=Options.defaults['gatewayProbeConcurrency'])
+    optional_flags.add_argument('--gatewayProbePaths', help='Comma separated paths requested by the gateway probe, in turn', default=Options.defaults['gatewayProbePaths'])
+    optional_flags.add_argument('--gatewayProbeHosts', help='Comma separated gateways to probe, as host, host:port or URL. Defaults to the gateway of this machine', default=Options.defaults['gatewayProbeHosts'])
+    optional_flags.add_argument('--gatewayProbeThresholds', help='Comma separated limits of the gateway probe: p50, p95 and p99 in milliseconds, errorRate as a fraction, and regression as a factor of the p95 of the baseline', default=Options.defaults['gatewayProbeThresholds'])
+    optional_flags.add_argument('--gatewayProbeAction', help='Whether a gateway probe over its thresholds fails the run or only warns', choices=['fail', 'warn'], default=Options.defaults['gatewayProbeAction'])
+    optional_flags.add_argument('--gatewayProbeBaseline', help='Json file keeping the gateway probe baseline of each gateway. Defaults to GatewayBaseline.json next to the node configuration file', default=Options.defaults['gatewayProbeBaseline'])
 
     # Required flags (no reasonable defaults)
     required_flags = update_topology_parser.add_argument_group('required flags')
@@ -197,55 +338,323 @@ def make_bootstrap_cmd_line_parser():
     # parser.print_usage = lambda x: print_error('When using the --bootstrapFile flag, no other flags are allowed')
     return parser
 
+def make_batch_cmd_line_parser():
+    parser = argparse.ArgumentParser(description='Tableau Server silent installation script, running several bootstrap files')
+    required_flags = parser.add_argument_group('required flags')
+    required_flags.add_argument('--batch', help='A directory of bootstrap files, or a json manifest listing bootstrap file paths relative to it', required=True)
+    optional_flags = parser.add_argument_group('optional flags')
+    optional_flags.add_argument('--batchWorkers', help='Number of bootstrap files run at the same time', type=int, default=1)
+    optional_flags.add_argument('--batchLogDir', help='Directory for the log of each bootstrap file. By default each log is written next to its bootstrap file', default=None)
+    optional_flags.add_argument('--stopOnError', help='Do not start further bootstrap files once one has failed', action='store_true', default=False)
+    return parser
+
+
+class CurrentTrace(object):
+    ''' The install trace of the run the calling thread works for, see JobContext '''
+
+    def __getattr__(self, name):
+        return getattr(JobContext.current().trace, name)
+
+TRACE = CurrentTrace()
+
+def get_rusage_children():
+    ''' The resource usage of all waited-for children, on platforms that report it '''
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_CHILDREN)
+    except ImportError:
+        return None
+
+def get_child_usage(proc, rusage_before):
+    ''' Returns the CPU time in seconds and the peak memory in bytes of a finished child process.
+    On Windows these are read from the process handle. Elsewhere the CPU time is the growth of the
+    children resource usage, and the peak memory is the largest of any child so far. '''
+
+    if os.name == 'nt':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + \
+                [(field, ctypes.c_size_t) for field in ['PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                    'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+
+        handle = wintypes.HANDLE(int(proc._handle))
+        cpu_time = None
+        peak_rss = None
+        creation, exit, kernel, user = [wintypes.FILETIME() for i in range(4)]
+        if ctypes.windll.kernel32.GetProcessTimes(handle, ctypes.byref(creation), ctypes.byref(exit), ctypes.byref(kernel), ctypes.byref(user)):
+            cpu_time = sum((t.dwHighDateTime << 32) + t.dwLowDateTime for t in (kernel, user)) / 1e7
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            peak_rss = counters.PeakWorkingSetSize
+        return cpu_time, peak_rss
+
+    rusage_after = get_rusage_children()
+    if rusage_before is None or rusage_after is None:
+        return None, None
+    cpu_time = (rusage_after.ru_utime + rusage_after.ru_stime) - (rusage_before.ru_utime + rusage_before.ru_stime)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    peak_rss = rusage_after.ru_maxrss if sys.platform == 'darwin' else rusage_after.ru_maxrss * 1024
+    return cpu_time, peak_rss
+
+def get_command_name(binary_path, arguments):
+    ''' The binary and its leading arguments up to the first option, e.g. "tsm.cmd settings import" '''
+
+    words = [binary_path]
+    for arg in arguments:
+        if arg.startswith('-'):
+            break
+        words.append(arg)
+    return ' '.join(words)
+
+# Output of external commands is copied to this logger. It has no handlers until
+# open_command_log() is called.
+COMMAND_LOG = logging.getLogger('SilentInstaller.commands')
+COMMAND_LOG.propagate = False
+COMMAND_LOG.setLevel(logging.INFO)
+
+# number of output lines of a command kept for error reporting
+OUTPUT_TAIL_LINES = 100
+
+def open_command_log(path, max_bytes=10 * 1024 * 1024, backup_count=5):
+    ''' Starts copying the output of external commands to a rotating log file '''
+
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    JobContext.current().command_log.addHandler(handler)
+
+class JobContext(object):
+    ''' The console output, install trace and command log of one run. A batch runs its bootstrap
+    files at the same time in this process, each on a thread with its own context, and threads
+    started for a run are given its context with JobContext.wrap. Outside of a batch every thread
+    uses the default context, which writes to the console. '''
+
+    local = threading.local()
+    default = None
+
+    def __init__(self, name=None, output=None):
+        # a file that replaces the console, or None
+        self.output = output
+        self.trace = install_common.InstallTrace()
+        self.command_log = logging.getLogger(COMMAND_LOG.name + '.' + name) if name else COMMAND_LOG
+        self.command_log.propagate = False
+        self.command_log.setLevel(logging.INFO)
+
+    @classmethod
+    def current(cls):
+        return getattr(cls.local, 'context', None) or cls.default
+
+    def run(self, function, *args, **kwargs):
+        ''' Calls the function on this thread within the context '''
+        outer = getattr(JobContext.local, 'context', None)
+        JobContext.local.context = self
+        try:
+            return function(*args, **kwargs)
+        finally:
+            JobContext.local.context = outer
+
+    @staticmethod
+    def wrap(function):
+        ''' The function, to be called on another thread within the context of the calling thread '''
+        context = JobContext.current()
+        return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+    def close(self):
+        ''' Closes the command log of a batch job '''
+        if self.command_log is not COMMAND_LOG:
+            for handler in list(self.command_log.handlers):
+                self.command_log.removeHandler(handler)
+                handler.close()
+
+JobContext.default = JobContext()
+
+class JobOutput(object):
+    ''' Stands in for sys.stdout or sys.stderr while a batch runs, writing to the output of the
+    context of the calling thread, or to the console '''
+
+    def __init__(self, console):
+        self.console = console
+
+    def stream(self):
+        return JobContext.current().output or self.console
+
+    def write(self, text):
+        return self.stream().write(text)
+
+    def flush(self):
+        self.stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.console, name)
+
+def stream_output(proc, command, echo=True, capture=False):
+    ''' Reads the output of a child process line by line as it is produced. Each line is echoed to
+    the console and copied to the command log. Only the last OUTPUT_TAIL_LINES lines are kept for
+    error reporting, unless the full output is captured. Returns the captured output and the tail. '''
+
+    encoding = locale.getpreferredencoding(False)
+    command_log = JobContext.current().command_log
+    tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    captured = [] if capture else None
+    for raw_line in iter(proc.stdout.readline, b''):
+        line = raw_line.decode(encoding, 'replace').rstrip('\r\n')
+        tail.append(line)
+        if captured is not None:
+            captured.append(line + '\n')
+        if echo:
+            print(line)
+        command_log.info('%s: %s', command, line)
+    proc.stdout.close()
+    proc.wait()
+    return (''.join(captured) if captured is not None else None), list(tail)
+
+def wait_for_process(proc, binary_path, command, rusage_before, started, return_result):
+    ''' Waits for a child process while streaming its output, records it in the install trace,
+    and raises ExitCodeError on failure '''
+
+    # captured output is returned to the caller rather than echoed
+    result, tail = stream_output(proc, command, echo=not return_result, capture=return_result)
+    wall_time = time.time() - started
+    cpu_time, peak_rss = get_child_usage(proc, rusage_before)
+    TRACE.command(command, proc.returncode, started, wall_time, cpu_time, peak_rss)
+    if proc.returncode != 0:
+        if return_result:
+            for line in tail:
+                print_error(line)
+        raise ExitCodeError(binary_path, proc.returncode, tail)
+    return result
+
+class ChildProcesses(object):
+    ''' The external command each thread is waiting for, so that another thread can stop it. A
+    thread that was stopped has every command it starts afterwards stopped too, so that a retry
+    does not run the command again. '''
+
+    running = {}
+    stopped = set()
+    lock = threading.Lock()
+
+    @classmethod
+    def add(cls, proc):
+        with cls.lock:
+            thread_id = threading.current_thread().ident
+            cls.running[thread_id] = proc
+            if thread_id in cls.stopped:
+                ChildProcesses.kill(proc)
+
+    @classmethod
+    def remove(cls, proc):
+        with cls.lock:
+            thread_id = threading.current_thread().ident
+            if cls.running.get(thread_id) is proc:
+                del cls.running[thread_id]
+
+    @classmethod
+    def stop(cls, thread):
+        ''' Stops the command the thread is running, and any it starts later '''
+        with cls.lock:
+            cls.stopped.add(thread.ident)
+            proc = cls.running.get(thread.ident)
+            if proc is not None:
+                ChildProcesses.kill(proc)
+
+    @classmethod
+    def forget(cls, thread):
+        ''' Called once the thread finished, since thread ids are reused '''
+        with cls.lock:
+            cls.stopped.discard(thread.ident)
+
+    @staticmethod
+    def kill(proc):
+        if proc.poll() is not None:
+            return
+        if os.name == 'nt':
+            # tsm.cmd runs the tsm client in a child of cmd.exe, so stop the whole process tree
+            subprocess.call(['taskkill', '/F', '/T', '/PID', str(proc.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            # the command may be a script whose children hold on to its output
+            subprocess.call(['pkill', '-KILL', '-P', str(proc.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            proc.kill()
 
 def run_command(binary_path, arguments, environment={}, show_args=False, return_result=False):
     ''' Run an external command in a subprocess and wait for it to finish '''
 
-    result = None
     if not os.path.isfile(binary_path):
         raise OptionsError('The executable file %s does not exist' %binary_path)
 
     print("Running: " + str(binary_path) + str(arguments if show_args else ''))
-    if return_result:
-        if environment:
-            proc = subprocess.Popen([binary_path] + arguments, env=environment, universal_newlines=True, stdout=subprocess.PIPE)
-        else:
-            proc = subprocess.Popen([binary_path] + arguments, universal_newlines=True, stdout=subprocess.PIPE)
-    else:
-        if environment:
-            proc = subprocess.Popen([binary_path] + arguments, env=environment)
-        else:
-            proc = subprocess.Popen([binary_path] + arguments)
-    result = proc.communicate()[0]
-    exit_code = proc.returncode
-    if exit_code != 0:
-        raise ExitCodeError(binary_path, exit_code)
-    return result
+    rusage_before = get_rusage_children()
+    started = time.time()
+    # when the result is returned, stderr is left on the console, or the log of a batch job, so
+    # that it does not mix with the result
+    stderr = JobContext.current().output if return_result else subprocess.STDOUT
+    proc = subprocess.Popen([binary_path] + arguments, env=environment or None, stdout=subprocess.PIPE, stderr=stderr)
+    ChildProcesses.add(proc)
+    try:
+        # the trace records the command without its options, which may contain credentials
+        return wait_for_process(proc, binary_path, get_command_name(binary_path, arguments), rusage_before, started, return_result)
+    finally:
+        ChildProcesses.remove(proc)
 
 def run_installer(binary_path, arguments, environment={}, show_args=False, return_result=False):
     ''' Run an external command in a subprocess and wait for it to finish '''
 
-    result = None
     if not os.path.isfile(binary_path):
         raise OptionsError('The executable file %s does not exist' %binary_path)
 
     print("Running: " + str(binary_path) + str(arguments if show_args else ''))
-    if return_result:
-        if environment:
-            proc = subprocess.Popen(binary_path + arguments, env=environment, universal_newlines=True, stdout=subprocess.PIPE)
-        else:
-            proc = subprocess.Popen(binary_path + arguments, universal_newlines=True, stdout=subprocess.PIPE)
-    else:
-        if environment:
-            proc = subprocess.Popen(binary_path + arguments, env=environment)
-        else:
-            proc = subprocess.Popen(binary_path + arguments)
-    result = proc.communicate()[0]
-    exit_code = proc.returncode
-    if exit_code != 0:
-        raise ExitCodeError(binary_path, exit_code)
-    return result
-
+    rusage_before = get_rusage_children()
+    started = time.time()
+    stderr = JobContext.current().output if return_result else subprocess.STDOUT
+    # Windows passes the command line to the installer as is; elsewhere it is split like a shell would
+    command_line = binary_path + arguments if os.name == 'nt' else [binary_path] + shlex.split(arguments)
+    proc = subprocess.Popen(command_line, env=environment or None, stdout=subprocess.PIPE, stderr=stderr)
+    return wait_for_process(proc, binary_path, binary_path, rusage_before, started, return_result)
+
+def tail_file(file_path, line_count, block_size=64 * 1024):
+    ''' Returns the last line_count lines of a file, reading blocks backwards from its end,
+    so that large log files are not read completely '''
+
+    with open(file_path, 'rb') as log_file:
+        # installer logs may be written in UTF-16
+        byte_order_mark = log_file.read(2)
+        encoding = {b'\xff\xfe': 'utf-16-le', b'\xfe\xff': 'utf-16-be'}.get(byte_order_mark, locale.getpreferredencoding(False))
+        newline = '\n'.encode(encoding)
+        log_file.seek(0, os.SEEK_END)
+        position = log_file.tell()
+        data = b''
+        while position > 0 and data.count(newline) <= line_count:
+            read_size = min(block_size, position)
+            position -= read_size
+            log_file.seek(position)
+            data = log_file.read(read_size) + data
+    if encoding.startswith('utf-16'):
+        # skip the byte order mark, or keep the code units aligned with the start of the file
+        data = data[2:] if position == 0 else data[position % 2:]
+    text = data.decode(encoding, 'replace')
+    return text.splitlines()[-line_count:]
+
+
+class WindowsSystem(object):
+    ''' Reads the registry and queries the services of this machine. Replace SYSTEM with an object
+    with the same methods to run the installer elsewhere, as the simulator does. '''
+
+    def read_registry_value(self, key_path, name):
+        ''' Reads a value under HKEY_LOCAL_MACHINE. Raises OSError if it can't be read. '''
+        if winreg is None:
+            raise OSError('The registry is only available on Windows')
+        key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, key_path)
+        try:
+            return winreg.QueryValueEx(key, name)[0]
+        finally:
+            winreg.CloseKey(key)
+
+    def list_services(self):
+        ''' The output of sc query for all services '''
+        return str(subprocess.check_output(['sc', 'query', 'type=', 'service', 'state=', 'all']))
+
+SYSTEM = WindowsSystem()
 
 def run_wix_installer(options):
     ''' Runs the installer.exe, and checks for the exit code. Return the installer version. '''
@@ -294,11 +703,7 @@ def run_wix_installer(options):
         os.environ["TABLEAU_SERVER_INSTALL_DIR"] = options.installDir if isinstance(options.installDir, str) else options.installDir.encode('utf-8')
 
         # read the version of the installer we just run
-        hKey = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, "SYSTEM\CurrentControlSet\Control\Session Manager\Environment")                  
-        result = winreg.QueryValueEx(hKey, "TABLEAU_SERVER_DATA_DIR_VERSION")
-        winreg.CloseKey(hKey)
-        # Return the read result
-        return result[0]
+        return SYSTEM.read_registry_value("SYSTEM\CurrentControlSet\Control\Session Manager\Environment", "TABLEAU_SERVER_DATA_DIR_VERSION")
 
     except ExitCodeError as ex:
         print_error('Error exit code from the Setup installer: %d' % ex.exit_code)
@@ -337,26 +742,708 @@ def run_worker_installer(options, secrets):
         print_error_lines(worker_log_file_full_path)
 
 
+class LocalProcessExecutor(object):
+    ''' Runs the worker installation for a node as a local SilentInstaller installWorker process.
+    Used to exercise the orchestration on a single machine. '''
+
+    def __init__(self, options):
+        self.options = options
+
+    def command(self, node_id, host):
+        return [sys.executable, os.path.abspath(__file__), 'installWorker',
+            '--installDir', self.options.installDir, '--dataDir', self.options.dataDir,
+            '--secretsFile', self.options.secretsFile, '--nodeConfigurationFile', self.options.nodeConfigurationFile,
+            self.options.installer]
+
+    def run(self, node_id, host):
+        ''' Runs the worker installation for one node, with its output going to a log file '''
+        command = self.command(node_id, host)
+        log_file = tempfile.NamedTemporaryFile(prefix='TableauWorkerInstall_%s_' % node_id, suffix='.log', delete=False)
+        # print a single string so that lines from concurrent installations do not interleave
+        print('Installing %s on %s, log file %s\n' % (node_id, host, log_file.name), end='')
+        with log_file:
+            exit_code = subprocess.call(command, stdout=log_file, stderr=subprocess.STDOUT, shell=not isinstance(command, list))
+        if exit_code != 0:
+            raise ExitCodeError('worker installation of %s' % node_id, exit_code)
+
+class RemoteCommandExecutor(LocalProcessExecutor):
+    ''' Runs the worker installation for a node on its host, through the command given in
+    the remoteCommand option (for example a PowerShell remoting or psexec invocation) '''
+
+    def __init__(self, options):
+        super(RemoteCommandExecutor, self).__init__(options)
+        if not options.remoteCommand:
+            raise OptionsError('"remoteCommand" must be specified when workerExecutor is remote')
+
+    def command(self, node_id, host):
+        values = {
+            'host': host,
+            'nodeId': node_id,
+            'installer': self.options.installer,
+            'installDir': self.options.installDir,
+            'dataDir': self.options.dataDir,
+            'secretsFile': self.options.secretsFile,
+            'nodeConfigurationFile': self.options.nodeConfigurationFile
+        }
+        command = self.options.remoteCommand
+        if isinstance(command, list):
+            return [part.format(**values) for part in command]
+        return command.format(**values)
+
+WORKER_EXECUTORS = {
+    'local': LocalProcessExecutor,
+    'remote': RemoteCommandExecutor
+}
+
+def get_worker_hosts(options):
+    ''' Returns the nodeId to host mapping from the workerHosts option. It is either a
+    dictionary (in a bootstrap file) or a string of comma separated nodeId=host pairs. '''
+
+    worker_hosts = options.workerHosts or {}
+    if isinstance(worker_hosts, dict):
+        return worker_hosts
+    result = {}
+    for pair in worker_hosts.split(','):
+        if not pair.strip():
+            continue
+        if '=' not in pair:
+            raise OptionsError('Invalid workerHosts entry "%s", expected nodeId=host' % pair)
+        node_id, host = pair.split('=', 1)
+        result[node_id.strip()] = host.strip()
+    return result
+
+def install_workers(options, secrets, executor, node_hosts):
+    ''' Runs the worker installation for every node through the executor, at most
+    parallelWorkerInstalls at the same time. Raises the first error once all nodes are done. '''
+
+    max_workers = int(options.parallelWorkerInstalls) if options.parallelWorkerInstalls else len(node_hosts)
+    results = {}
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = dict((pool.submit(JobContext.wrap(executor.run), node_id, host), node_id) for node_id, host in node_hosts.items())
+        for future in concurrent.futures.as_completed(futures):
+            node_id = futures[future]
+            try:
+                future.result()
+                results[node_id] = 'installed'
+            except (ExitCodeError, OptionsError, OSError) as ex:
+                results[node_id] = 'failed: ' + str(ex)
+                errors[node_id] = ex
+
+    print('Worker installation summary:')
+    for node_id in sorted(results):
+        print('    %s (%s): %s' % (node_id, node_hosts[node_id], results[node_id]))
+    if errors:
+        first_error = errors[sorted(errors)[0]]
+        if isinstance(first_error, OSError):
+            raise OptionsError(str(first_error))
+        raise first_error
+
+def wait_for_nodes(tsm, expected_nodes, timeout, initial_interval=2, max_interval=60, jitter=0.25):
+    ''' Polls tsm topology list-nodes until every expected node has joined the cluster, or the
+    timeout expires. The polling interval doubles up to max_interval, with random jitter so that
+    many installers do not poll the controller in lockstep. Returns the reported nodes and
+    whether all expected nodes have joined. '''
+
+    started = time.time()
+    deadline = started + timeout
+    interval = initial_interval
+    join_latency = {}
+    while True:
+        actual_nodes = set(tsm.run(['topology', 'list-nodes'], return_result=True).splitlines())
+        for node in expected_nodes & actual_nodes:
+            join_latency.setdefault(node, time.time() - started)
+        missing_nodes = expected_nodes - actual_nodes
+        remaining = deadline - time.time()
+        if not missing_nodes or remaining <= 0:
+            break
+        print('Waiting for nodes to join: ' + ', '.join(sorted(missing_nodes)))
+        time.sleep(min(remaining, interval * random.uniform(1 - jitter, 1 + jitter)))
+        interval = min(interval * 2, max_interval)
+
+    if timeout > 0:
+        print('Node join latency:')
+        for node in sorted(expected_nodes):
+            if node in join_latency:
+                print('    %s: %.1fs' % (node, join_latency[node]))
+            else:
+                print('    %s: not joined after %ds' % (node, timeout))
+    return actual_nodes, not missing_nodes
+
+def run_install_workers(options, secrets):
+    ''' Installs every worker node listed in the topology of the config file in parallel,
+    waits for them to join the cluster, and applies the topology once '''
+
+    expected_nodes = ServerConfiguration.load(options.configFile).nodes
+    if not expected_nodes:
+        raise OptionsError('No nodes found in topologyVersion of the config file "%s"' % options.configFile)
+    worker_hosts = get_worker_hosts(options)
+    executor = WORKER_EXECUTORS[options.workerExecutor](options)
+
+    tsm_path = get_tsm_path(options)
+    with make_tsm_session(tsm_path, secrets, options) as tsm:
+        existing_nodes = set(tsm.run(['topology', 'list-nodes'], return_result=True).splitlines())
+        node_hosts = dict((node_id, worker_hosts.get(node_id, node_id)) for node_id in expected_nodes - existing_nodes)
+        if node_hosts:
+            install_workers(options, secrets, executor, node_hosts)
+        else:
+            print('All nodes in the topology are already installed')
+
+        if not get_nodes_and_apply_topology(options.configFile, tsm, apply_and_restart=True, wait_timeout=int(options.nodeWaitTimeout)):
+            raise OptionsError('Not all nodes joined the cluster within %s seconds. Please check the worker installation logs '
+                'then rerun SilentInstaller with updateTopology option.' % options.nodeWaitTimeout)
+
 def print_error_lines(log_file_full_path):
     # print the last 100 lines from the log file
     print_error('For more details see log file %s' % log_file_full_path)
-    with open(log_file_full_path) as log_file:
-        content = log_file.readlines()
-        for line in content[-100:]:
-            print_error(line)
+    for line in tail_file(log_file_full_path, 100):
+        print_error(line)
     raise
 
 
-def run_tsm_command(tsm_path, secrets, args, port=8850, return_tsm_result=False):
-    ''' Runs the tsm command to perform setup actions '''
-    if port != 8850:
-        args.extend(['--server', str.format('https://{}:{}',socket.gethostname(),port)])
-    user_and_pass = ['-u', secrets['local_admin_user'], '-p', secrets['local_admin_pass']]
-    try:
-        return run_command(tsm_path, args + user_and_pass, return_result=return_tsm_result)
-    except ExitCodeError as ex:
-        print_error('Tabadmin exited with code %d' % ex.exit_code)
-        raise ex
+# Output of a tsm command, or error of a REST request, showing that the controller was not reached or
+# was briefly unable to handle the request
+UNREACHABLE_PATTERNS = ['Could not connect', 'Connection refused', 'Unable to connect', 'failed: [Errno']
+TRANSIENT_PATTERNS = UNREACHABLE_PATTERNS + ['timed out', 'Service Unavailable', 'HTTP 502', 'HTTP 503', 'HTTP 504',
+                                             'server is busy', 'Another operation is in progress']
+
+class RetryPolicy(object):
+    ''' When a failed tsm command is run again. A failure is transient if the command exited with one
+    of transient_exit_codes or its output matches one of transient_patterns. Commands that are not
+    idempotent are only retried when the controller was not reached, since running them twice
+    could change the outcome. Retries wait initial_delay seconds, doubling up to max_delay. '''
+
+    def __init__(self, max_attempts=1, idempotent=True, transient_exit_codes=(), transient_patterns=TRANSIENT_PATTERNS,
+                 initial_delay=5, max_delay=60, jitter=0.25):
+        self.max_attempts = max_attempts
+        self.idempotent = idempotent
+        self.transient_exit_codes = transient_exit_codes
+        self.transient_patterns = transient_patterns
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def retry_reason(self, error):
+        ''' Why the failure is transient, or None if the command must not be retried '''
+        output = '\n'.join(error.output_tail)
+        patterns = self.transient_patterns if self.idempotent else [pattern for pattern in self.transient_patterns if pattern in UNREACHABLE_PATTERNS]
+        matched = next((pattern for pattern in patterns if pattern in output), None)
+        if matched:
+            return 'output: ' + matched
+        if self.idempotent and error.exit_code in self.transient_exit_codes:
+            return 'exit code %d' % error.exit_code
+        return None
+
+    def delay(self, attempt):
+        return min(self.initial_delay * 2 ** (attempt - 1), self.max_delay) * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+# The retry policy of each tsm command, by its leading words. Commands not listed are not retried.
+RETRY_POLICIES = collections.OrderedDict([
+    ('login', RetryPolicy(4)),
+    ('licenses activate', RetryPolicy(4, idempotent=False)),
+    ('licenses list', RetryPolicy(4)),
+    ('register', RetryPolicy(4)),
+    ('settings import', RetryPolicy(4)),
+    ('settings export', RetryPolicy(4)),
+    ('pending-changes apply', RetryPolicy(3, initial_delay=15)),
+    ('initialize', RetryPolicy(3, idempotent=False, initial_delay=15)),
+    ('start', RetryPolicy(3, initial_delay=15)),
+    ('stop', RetryPolicy(3, initial_delay=15)),
+    ('restart', RetryPolicy(3, idempotent=False, initial_delay=15)),
+    ('topology list-nodes', RetryPolicy(4)),
+    ('topology set-process', RetryPolicy(4)),
+    ('topology remove-nodes', RetryPolicy(3, idempotent=False)),
+    ('topology nodes get-bootstrap-file', RetryPolicy(4))
+])
+
+def get_retry_policy(args):
+    ''' The retry policy of a tsm command line '''
+
+    command = get_command_name('', args).strip()
+    for prefix, policy in RETRY_POLICIES.items():
+        if command == prefix or command.startswith(prefix + ' '):
+            return policy
+    return RetryPolicy()
+
+def run_with_retries(args, run):
+    ''' Calls run until it succeeds, retrying the ExitCodeErrors that the retry policy of the tsm
+    command considers transient. Every retry is recorded in the install trace. '''
+
+    policy = get_retry_policy(args)
+    command_name = get_command_name('tsm', args)
+    attempt = 1
+    while True:
+        try:
+            return run()
+        except ExitCodeError as ex:
+            reason = policy.retry_reason(ex)
+            if reason is None or attempt >= policy.max_attempts:
+                raise
+            delay = policy.delay(attempt)
+            print_error('%s failed (%s), retrying in %.0fs (attempt %d of %d)' % (command_name, reason, delay, attempt + 1, policy.max_attempts))
+            TRACE.retry(command_name, attempt, ex.exit_code, reason, delay)
+            time.sleep(delay)
+            attempt += 1
+
+class TsmSession(object):
+    ''' An authenticated tsm session. Logs in to the TSM controller once and reuses the
+    session for every following tsm command instead of passing -u/-p to each of them. '''
+
+    # tsm sessions expire after a period of inactivity on the controller; log in again
+    # before running a command if the session has been idle for longer than this.
+    idle_timeout = 1800
+
+    def __init__(self, tsm_path, secrets, port=8850):
+        self.tsm_path = tsm_path
+        self.secrets = secrets
+        self.port = port
+        self.logged_in = False
+        self.last_activity = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.login()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.logout()
+        return False
+
+    def server_args(self):
+        if int(self.port) != 8850:
+            return ['--server', str.format('https://{}:{}', socket.gethostname(), self.port)]
+        return []
+
+    def login(self):
+        ''' Runs tsm login with the credentials from the secrets file '''
+        user_and_pass = ['-u', self.secrets['local_admin_user'], '-p', self.secrets['local_admin_pass']]
+        try:
+            run_with_retries(['login'], lambda: run_command(self.tsm_path, ['login'] + self.server_args() + user_and_pass))
+        except ExitCodeError as ex:
+            print_error('tsm login exited with code %d' % ex.exit_code)
+            raise ex
+        self.logged_in = True
+        self.last_activity = time.time()
+
+    def logout(self):
+        ''' Ends the session. A failed logout is not fatal, the session will expire on its own. '''
+        if not self.logged_in:
+            return
+        self.logged_in = False
+        try:
+            run_command(self.tsm_path, ['logout'] + self.server_args())
+        except (ExitCodeError, OptionsError) as ex:
+            print_error('Warning: tsm logout failed: %s' % str(ex))
+
+    def run(self, args, return_result=False):
+        ''' Runs a tsm command within the session '''
+        with self.lock:
+            if not self.logged_in or time.time() - self.last_activity > TsmSession.idle_timeout:
+                self.login()
+        try:
+            result = run_with_retries(args, lambda: run_command(self.tsm_path, args + self.server_args(), return_result=return_result))
+        except ExitCodeError as ex:
+            print_error('Tabadmin exited with code %d' % ex.exit_code)
+            raise ex
+        self.last_activity = time.time()
+        return result
+
+class TsmRestTransport(object):
+    ''' Runs tsm commands through the TSM controller REST API instead of tsm.cmd.
+    Commands without a REST equivalent are passed on to the fallback tsm session. '''
+
+    # returned by dispatch for commands without a REST equivalent
+    unsupported = object()
+
+    def __init__(self, client, fallback):
+        self.client = client
+        self.fallback = fallback
+
+    def __enter__(self):
+        import tsm_rest
+        try:
+            self.client.login()
+        except tsm_rest.TsmRestError as ex:
+            print_error('Login to the TSM controller failed: %s' % str(ex))
+            raise ExitCodeError('tsm login', 1, [str(ex)])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.client.logout()
+        self.fallback.logout()
+        return False
+
+    @staticmethod
+    def arg_value(args, *flags):
+        for flag in flags:
+            if flag in args and args.index(flag) + 1 < len(args):
+                return args[args.index(flag) + 1]
+        return None
+
+    def timeout(self, args):
+        value = TsmRestTransport.arg_value(args, '--request-timeout')
+        return int(value) if value else None
+
+    def dispatch(self, args):
+        ''' Returns the result of the REST call for a tsm command line '''
+        command = ' '.join(args[:2])
+        if command == 'licenses activate':
+            if '--trial' in args:
+                return self.client.activate_trial()
+            return self.client.activate_license(TsmRestTransport.arg_value(args, '--license-key', '-k'))
+        if command == 'licenses list':
+            return '\n'.join(key.get('key', '') for key in self.client.list_licenses())
+        if args[0] == 'register':
+            return self.client.register(read_json_object(TsmRestTransport.arg_value(args, '--file', '-f'), 'registration file'))
+        if command == 'settings import':
+            config = read_json_object(TsmRestTransport.arg_value(args, '-f', '--import-config-file'), 'config file')
+            if '--topology-only' in args:
+                config = {'topologyVersion': config.get('topologyVersion', {})}
+            elif '--config-only' in args:
+                config = dict((key, value) for key, value in config.items() if key != 'topologyVersion')
+            return self.client.import_settings(config)
+        if command == 'pending-changes apply':
+            return self.client.apply_pending_changes(self.timeout(args))
+        if args[0] == 'initialize':
+            return self.client.initialize(self.timeout(args))
+        if args[0] == 'start':
+            return self.client.start(self.timeout(args))
+        if args[0] == 'stop':
+            return self.client.stop(self.timeout(args))
+        if args[0] == 'restart':
+            self.client.stop(self.timeout(args))
+            return self.client.start(self.timeout(args))
+        if args[0] == 'status':
+            return self.client.status()
+        if command == 'topology list-nodes':
+            return '\n'.join(self.client.list_nodes())
+        if command == 'topology remove-nodes':
+            return self.client.remove_nodes(TsmRestTransport.arg_value(args, '-n', '--node-names').split(','), self.timeout(args))
+        if args[:3] == ['topology', 'nodes', 'get-bootstrap-file']:
+            with open(TsmRestTransport.arg_value(args, '--file', '-f'), 'w') as bootstrap_file:
+                json.dump(self.client.get_bootstrap_file(), bootstrap_file, indent=4)
+            return None
+        return TsmRestTransport.unsupported
+
+    def run(self, args, return_result=False):
+        ''' Runs a tsm command, through the REST API if possible '''
+        import tsm_rest
+        command_name = get_command_name('tsm', args)
+        def request():
+            try:
+                print('Requesting: ' + command_name)
+                with TRACE.span(command_name, 'request'):
+                    return self.dispatch(args)
+            except tsm_rest.TsmRestError as ex:
+                print_error(str(ex))
+                raise ExitCodeError(command_name, 1, [str(ex)])
+        result = run_with_retries(args, request)
+        if result is TsmRestTransport.unsupported:
+            return self.fallback.run(args, return_result=return_result)
+        return result if return_result else None
+
+def make_tsm_session(tsm_path, secrets, options):
+    ''' Creates the tsm session for the transport selected in the options '''
+
+    session = TsmSession(tsm_path, secrets, options.controllerPort)
+    if getattr(options, 'transport', 'cli') != 'rest':
+        return session
+    # the REST client is only needed for the rest transport, so only import it here
+    import tsm_rest
+    client = tsm_rest.TsmRestClient(socket.gethostname(), options.controllerPort, secrets['local_admin_user'], secrets['local_admin_pass'])
+    return TsmRestTransport(client, session)
+
+# A service line of tsm status -v, e.g. "    'Tableau Server Gateway 0' status is running." or, in older
+# versions, "    'Tableau Server Gateway 0' (1234) is running."
+SERVICE_STATUS_PATTERN = re.compile(r"^\s*'(?P<service>[^']+)'(?: \(\d+\))? (?:status )?is (?P<state>.+?)\.?$")
+
+# The instance id at the end of a service name of tsm status -v, e.g. "Tableau Server Gateway 0"
+SERVICE_INSTANCE_PATTERN = re.compile(r'^(?P<service>.*?)(?: (?P<instance>\d+))?$')
+
+# How long the services may take to settle after a topology change
+HEALTH_CHECK_TIMEOUT = 1800
+
+def classify_service_state(state):
+    ''' Maps the state of a service instance, as tsm status -v ("running", "in an error state")
+    or the controller ("Active", "Down") reports it, to running, stopped, error or changing '''
+
+    state = state.lower()
+    if 'error' in state or state in ('down', 'failed'):
+        return 'error'
+    if state.startswith(('running', 'active', 'passive', 'busy', 'readonly', 'read only')):
+        return 'running'
+    if state.startswith(('stopped', 'disabled', 'decommissioned')):
+        return 'stopped'
+    # starting, stopping, synchronizing, unavailable, ...
+    return 'changing'
+
+class ServiceInstance(object):
+    ''' The state of one instance of a service on one node '''
+
+    def __init__(self, node, service, instance, state):
+        self.node = node
+        self.service = service
+        self.instance = instance
+        self.state = state
+
+    @property
+    def key(self):
+        return (self.node, self.service, self.instance)
+
+    @property
+    def name(self):
+        ''' e.g. "node1 Tableau Server Gateway 0" '''
+        return ' '.join(part for part in self.key if part)
+
+    @property
+    def condition(self):
+        return classify_service_state(self.state)
+
+class ServerStatus(object):
+    ''' A snapshot of the server status: the overall status and the state of every service
+    instance, by node. Parsed from tsm status -v, or from the status of the controller REST API. '''
+
+    def __init__(self, status, instances, taken=None):
+        self.status = status
+        self.instances = collections.OrderedDict((instance.key, instance) for instance in instances)
+        self.taken = taken or time.time()
+
+    @classmethod
+    def parse(cls, output):
+        ''' Parses tsm status -v output '''
+
+        status = None
+        instances = []
+        node = ''
+        for line in (output or '').splitlines():
+            if line.startswith('Status:'):
+                status = line.split(':', 1)[1].strip()
+                continue
+            node_match = re.match(r'^(node\d+):', line)
+            if node_match:
+                node = node_match.group(1)
+                continue
+            service_match = SERVICE_STATUS_PATTERN.match(line)
+            if service_match:
+                name_match = SERVICE_INSTANCE_PATTERN.match(service_match.group('service'))
+                instances.append(ServiceInstance(node, name_match.group('service'), name_match.group('instance') or '', service_match.group('state')))
+        return cls(status, instances)
+
+    @classmethod
+    def from_controller(cls, document):
+        ''' Reads the clusterStatus document of the controller status endpoint '''
+
+        cluster = (document or {}).get('clusterStatus', {})
+        instances = []
+        for node in cluster.get('nodes', []):
+            for service in node.get('services', []):
+                for instance in service.get('instances', []):
+                    instances.append(ServiceInstance(node.get('nodeId', ''), service.get('serviceName', ''), str(instance.get('instanceId', '')), (instance.get('processStatus') or 'unknown').lower()))
+        status = cluster.get('rollupStatus')
+        return cls(status.upper() if status else None, instances)
+
+    @classmethod
+    def from_result(cls, result):
+        ''' The status from the result of tsm status -v, through tsm.cmd or the REST transport '''
+        return cls.from_controller(result) if isinstance(result, dict) else cls.parse(result)
+
+    @property
+    def nodes(self):
+        return list(collections.OrderedDict((node, None) for node, service, instance in self.instances))
+
+    def services(self, node):
+        ''' The instances of every service on the node '''
+
+        services = collections.OrderedDict()
+        for instance in self.instances.values():
+            if instance.node == node:
+                services.setdefault(instance.service, []).append(instance)
+        return services
+
+    def in_condition(self, *conditions):
+        return [instance for instance in self.instances.values() if instance.condition in conditions]
+
+    @property
+    def failed(self):
+        return self.in_condition('error')
+
+    def is_healthy(self):
+        ''' The server is running and no service instance is in an error state '''
+        return self.status == 'RUNNING' and not self.failed
+
+    def diff(self, previous):
+        return StatusDiff(previous, self)
+
+class StatusDiff(object):
+    ''' The changes between two snapshots of the server status. A service instance that appeared
+    has no state before, one that disappeared has no state after. '''
+
+    def __init__(self, before, after):
+        self.before = before
+        self.after = after
+        before_instances = before.instances if before else {}
+        self.status_changed = (before.status if before else None) != after.status
+        self.changes = []
+        for key, instance in after.instances.items():
+            previous = before_instances.get(key)
+            if previous is None or previous.state != instance.state:
+                self.changes.append((instance, previous.state if previous else None, instance.state))
+        for key, instance in before_instances.items():
+            if key not in after.instances:
+                self.changes.append((instance, instance.state, None))
+
+    def is_empty(self):
+        return not (self.status_changed or self.changes)
+
+    def print_changes(self):
+        if self.status_changed:
+            print('Server status: %s' % self.after.status)
+        for instance, before, after in self.changes:
+            if self.before is None:
+                # the first snapshot has nothing to compare with
+                print('    %s: %s' % (instance.name, after))
+            else:
+                print('    %s: %s -> %s' % (instance.name, before or 'added', after or 'removed'))
+
+class StatusMonitor(object):
+    ''' Keeps the latest snapshot of the server status for the waits and health checks of a
+    tsm session. refresh reads tsm status -v again, unless the latest snapshot is recent enough,
+    and returns what changed since the previous snapshot. '''
+
+    min_interval = 2
+    max_interval = 30
+    # consecutive ERROR polls before giving up, since services briefly report errors while starting
+    error_polls = 2
+
+    def __init__(self, tsm):
+        self.tsm = tsm
+        self.current = None
+        self.errors = 0
+
+    @property
+    def status(self):
+        return self.current.status if self.current else None
+
+    def refresh(self, max_age=0):
+        ''' Returns the changes since the previous snapshot, or None if the controller did not answer '''
+
+        if self.current and time.time() - self.current.taken < max_age:
+            return StatusDiff(self.current, self.current)
+        try:
+            result = self.tsm.run(['status', '-v'], return_result=True)
+        except (ExitCodeError, OptionsError):
+            # the controller may not answer while it is busy with an operation
+            return None
+        snapshot = ServerStatus.from_result(result)
+        changes = StatusDiff(self.current, snapshot)
+        self.current = snapshot
+        self.errors = self.errors + 1 if snapshot.status == 'ERROR' else 0
+        return changes
+
+    def raise_on_error(self, command_name):
+        ''' Raises ExitCodeError once the server reported ERROR on consecutive refreshes '''
+
+        if self.errors >= StatusMonitor.error_polls:
+            failed = [instance.name for instance in self.current.failed]
+            print_error('Server status is ERROR, failed services: ' + (', '.join(failed) or 'unknown'))
+            raise ExitCodeError(command_name, 1, ['Server status is ERROR: ' + ', '.join(failed)])
+
+    def wait_until(self, condition, timeout, command_name):
+        ''' Polls the status, printing every change, until condition holds for a snapshot, and
+        returns that snapshot. The interval doubles while nothing changes. Raises ExitCodeError
+        when the server reports ERROR on consecutive polls or the timeout expires. '''
+
+        deadline = time.time() + timeout
+        interval = StatusMonitor.min_interval
+        while True:
+            changes = self.refresh()
+            if changes is not None:
+                changes.print_changes()
+                if condition(self.current):
+                    return self.current
+            self.raise_on_error(command_name)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                print_error('%s timed out after %ds, server status is %s' % (command_name, timeout, self.status or 'unknown'))
+                raise ExitCodeError(command_name, 1, ['Timed out, server status is %s' % (self.status or 'unknown')])
+            changed = changes is not None and not changes.is_empty()
+            interval = StatusMonitor.min_interval if changed else min(interval * 2, StatusMonitor.max_interval)
+            time.sleep(min(remaining, interval))
+
+class OperationTracker(object):
+    ''' Runs a long tsm operation such as initialize, start or restart on a background thread and
+    polls the server status meanwhile, printing every service state change. The polling interval
+    doubles while nothing changes and drops back to the minimum when a service changes state.
+    Fails fast when the server reports ERROR on consecutive polls, stopping the command, and, with
+    a target status, stops polling as soon as the server reaches it. The command is always waited
+    for, up to its --request-timeout, so that it is never left running when this returns. '''
+
+    def __init__(self, tsm, target_status=None, monitor=None):
+        self.tsm = tsm
+        self.target_status = target_status
+        self.monitor = monitor or StatusMonitor(tsm)
+
+    @property
+    def status(self):
+        return self.monitor.status
+
+    def poll(self):
+        ''' Reads the status, prints the changes since the last poll, and returns whether anything changed '''
+        changes = self.monitor.refresh()
+        if changes is None:
+            return False
+        changes.print_changes()
+        return not changes.is_empty()
+
+    def finish(self, thread, command_name, timeout):
+        ''' Waits for the command to return, and stops it if it is still running after the timeout '''
+        thread.join(timeout)
+        if thread.is_alive():
+            print_error('%s did not return within %ds, stopping it' % (command_name, timeout))
+            ChildProcesses.stop(thread)
+            thread.join()
+        ChildProcesses.forget(thread)
+
+    def run(self, args, return_result=False):
+        ''' Runs the tsm command and tracks the server status until it finishes '''
+        command_name = get_command_name('tsm', args)
+        timeout = TsmRestTransport.arg_value(args, '--request-timeout')
+        timeout = int(timeout) if timeout else None
+        outcome = {}
+        def operation():
+            try:
+                outcome['result'] = self.tsm.run(args, return_result=return_result)
+            except Exception as ex:
+                outcome['error'] = ex
+        thread = threading.Thread(target=JobContext.wrap(operation))
+        thread.daemon = True
+        thread.start()
+
+        interval = StatusMonitor.min_interval
+        left_target = False
+        while True:
+            # returns early when the operation finishes, so no time is lost to a fixed sleep
+            thread.join(interval)
+            if not thread.is_alive():
+                break
+            changed = self.poll()
+            interval = StatusMonitor.min_interval if changed else min(interval * 2, StatusMonitor.max_interval)
+            try:
+                self.monitor.raise_on_error(command_name)
+            except ExitCodeError:
+                ChildProcesses.stop(thread)
+                self.finish(thread, command_name, timeout)
+                raise
+            if self.target_status and self.status != self.target_status:
+                left_target = True
+            elif self.target_status and left_target:
+                print('Server is %s, waiting for %s to return' % (self.status, command_name))
+                break
+        self.finish(thread, command_name, timeout)
+
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome.get('result')
 
 def run_tabcmd_command(tabcmd_path, args):
     ''' Runs a tabcmd command to perform setup actions '''
@@ -366,66 +1453,717 @@ def run_tabcmd_command(tabcmd_path, args):
         print_error('Tabadmin exited with code %d' % ex.exit_code)
         raise ex
 
+class ServerConfiguration(object):
+    ''' The configuration file, parsed once and shared by all steps. tsm imports the settings
+    and the topology of the file separately, so each part is written once to its own temporary
+    file, which is passed to tsm settings import. '''
+
+    # Parsed files by path, and a lock for loading and writing the fragments
+    loaded = {}
+    lock = threading.Lock()
+
+    def __init__(self, path, document):
+        self.path = path
+        self.document = document
+        self.fragment_paths = {}
+
+    @classmethod
+    def load(cls, path):
+        ''' Returns the parsed configuration file, reading and validating it only the first time '''
+        with cls.lock:
+            if path not in cls.loaded:
+                cls.loaded[path] = ServerConfiguration(path, ServerConfiguration.validate(path, read_json_file(path)))
+            return cls.loaded[path]
+
+    @staticmethod
+    def validate(path, document):
+        if not isinstance(document, dict):
+            raise OptionsError('The config file "%s" must contain a json object' % path)
+        for section in ['configEntities', 'configKeys', 'topologyVersion']:
+            if not isinstance(document.get(section, {}), dict):
+                raise OptionsError('%s in the config file "%s" must be a json object' % (section, path))
+        if not isinstance(document.get('topologyVersion', {}).get('nodes', {}), dict):
+            raise OptionsError('topologyVersion.nodes in the config file "%s" must be a json object' % path)
+        return document
+
+    @classmethod
+    def cleanup(cls):
+        ''' Removes the temporary fragment files of every loaded configuration '''
+        with cls.lock:
+            for configuration in cls.loaded.values():
+                for fragment_path in configuration.fragment_paths.values():
+                    try:
+                        os.remove(fragment_path)
+                    except OSError:
+                        pass
+                configuration.fragment_paths = {}
+
+    @property
+    def settings(self):
+        ''' The configuration without the topology, as imported by --config-only '''
+        return dict((key, value) for key, value in self.document.items() if key != 'topologyVersion')
+
+    @property
+    def topology(self):
+        ''' Only the topology, as imported by --topology-only '''
+        return {'topologyVersion': self.document.get('topologyVersion', {})}
+
+    @property
+    def nodes(self):
+        ''' The node ids of the topology '''
+        return set(self.document.get('topologyVersion', {}).get('nodes', {}).keys())
+
+    def fragment_file(self, fragment):
+        ''' The path of a temporary file containing the settings or the topology fragment,
+        written the first time it is needed '''
+        with ServerConfiguration.lock:
+            if fragment not in self.fragment_paths:
+                with tempfile.NamedTemporaryFile('w', prefix='TableauServer%s_' % fragment.capitalize(), suffix='.json', delete=False) as fragment_file:
+                    json.dump(getattr(self, fragment), fragment_file)
+                self.fragment_paths[fragment] = fragment_file.name
+            return self.fragment_paths[fragment]
+
+    def gateway_port(self, warn=True):
+        ''' The gateway port. A gateway.port key overrides the port of the gatewaySettings
+        entity. Without configKeys, the port defaults to 80. '''
+
+        # from entity
+        result = self.document.get('configEntities', {}).get('gatewaySettings',{}).get('port', None)
+
+        # from key. will overwrite entity port if found.
+        if 'configKeys' in self.document:
+            if 'gateway.port' in self.document['configKeys']:
+                key = self.document['configKeys']['gateway.port']
+                if result != None and warn:
+                    print('Warning: gateway.port key specified twice in the configuration template, using value of ' + str(key))
+                result = key
+
+        elif result == None:
+            result = 80
+            if warn:
+                print('Warning: No gateway port specified, defaulting to port 80.')
+
+        return result
+
 def getGatewayPort(configFile):
     ''' Retrieves the gateway port from the config file'''
-    config = read_json_file(configFile)
+    return ServerConfiguration.load(configFile).gateway_port()
 
-    # from entity
-    result = config.get('configEntities', {}).get('gatewaySettings',{}).get('port', None)
+class StepScheduler(install_common.StepScheduler):
+    ''' The step scheduler shared with ScriptedInstaller. Steps are traced in the install trace,
+    and run within the job context of the thread that runs the scheduler. '''
 
-    # from key. will overwrite entity port if found.
-    if 'configKeys' in config:
-        if 'gateway.port' in config['configKeys']:
-            key = config['configKeys']['gateway.port']
-            if result != None:
-                print('Warning: gateway.port key specified twice in the configuration template, using value of ' + key)
-            result = key
+    def describe(self, function, args):
+        return describe_step(function, args)
 
-    elif result == None:
-        result = 80
-        print('Warning: No gateway port specified, defaulting to port 80.')
+    def span(self, name):
+        return TRACE.span(name)
 
-    return result
+    def start_thread(self, target, args):
+        super(StepScheduler, self).start_thread(JobContext.wrap(target), args)
 
-def run_setup(options, secrets, package_version):
-    ''' Runs a sequence of tsm commands to perform setup '''
+class InstallCheckpoint(object):
+    ''' A journal of the completed installation steps, so that a failed installation can be
+    resumed. Each completed step is appended to the journal file as one json line and flushed
+    to disk before the next step starts. Without a path, the journal is only kept in memory.
+    Without resume, the journal file is left as it is until start() is called. '''
 
-    tsm_path = os.path.join(options.installDir, 'packages', 'bin.' + str(package_version), 'tsm.cmd')
-    tabcmd_path = os.path.join(options.installDir, 'packages', 'bin.' + str(package_version), 'tabcmd.exe')
-
-    port = options.controllerPort
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.steps = {}
+        self.lock = threading.Lock()
+        if path is None or not resume or not os.path.isfile(path):
+            return
+        with open(path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line that was only partially written when the previous run died
+                    continue
+                self.steps[entry['step']] = entry
+
+    def start(self):
+        ''' Empties the journal when a new installation starts. Until then the journal of an
+        earlier run is kept, so that a run that stops before, e.g. at a preflight check,
+        doesn't lose the steps a later --resume would skip. '''
+        with self.lock:
+            self.steps = {}
+            if self.path is not None:
+                open(self.path, 'w').close()
+
+    def is_complete(self, step):
+        return step in self.steps
+
+    def result(self, step):
+        return self.steps[step].get('result')
+
+    def record(self, step, result=None):
+        entry = {'step': step, 'completed': time.strftime('%Y-%m-%d %H:%M:%S'), 'result': result}
+        with self.lock:
+            self.steps[step] = entry
+            if self.path is None:
+                return
+            with open(self.path, 'a') as journal:
+                journal.write(json.dumps(entry) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    def run(self, step, message, function, *args):
+        ''' Runs an installation step unless the journal already has it as completed,
+        and prints the message once the step is done '''
+        if self.is_complete(step):
+            print('Skipping %s, completed at %s' % (step, self.steps[step]['completed']))
+            return self.result(step)
+        result = function(*args)
+        self.record(step, result)
+        if message:
+            print(message)
+        return result
+
+def get_checkpoint_path(options):
+    ''' The checkpoint journal is kept next to the saved node configuration file '''
+
+    return os.path.join(os.path.dirname(os.path.abspath(options.nodeConfigurationDirectory)), 'SilentInstallerCheckpoint.jsonl')
+
+def validate_resume_preconditions(options, tsm_path):
+    ''' Cheap checks that the inputs of a resumed installation are still usable '''
+
+    if not os.path.isfile(tsm_path):
+        raise OptionsError('Cannot resume: %s does not exist. Please rerun the installation without --resume' % tsm_path)
+    read_json_object(options.secretsFile, 'secrets file')
+    read_json_object(options.registrationFile, 'registration file')
+    ServerConfiguration.load(options.configFile)
+
+def activate_product_keys(tsm, product_keys, max_workers=4):
+    ''' Activates the product keys through a bounded pool of workers. Keys that tsm licenses list
+    already reports are skipped. Raises the first error once every key has been attempted. '''
+
+    if not product_keys:
+        return
+    try:
+        active_licenses = set((tsm.run(['licenses', 'list'], return_result=True) or '').split())
+    except ExitCodeError:
+        print('Warning: could not list the active licenses, activating all product keys')
+        active_licenses = set()
+
+    results = {}
+    pending_keys = []
+    for product_key in product_keys:
+        if product_key in results:
+            continue
+        if product_key in active_licenses:
+            results[product_key] = 'already active'
+        else:
+            results[product_key] = None
+            pending_keys.append(product_key)
+
+    errors = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = dict((executor.submit(JobContext.wrap(tsm.run), ['licenses', 'activate', '--license-key', key]), key) for key in pending_keys)
+        for future in concurrent.futures.as_completed(futures):
+            key = futures[future]
+            try:
+                future.result()
+                results[key] = 'activated'
+            except (ExitCodeError, OptionsError) as ex:
+                results[key] = 'failed: ' + str(ex)
+                errors[key] = ex
+
+    print('License activation summary:')
+    for product_key in product_keys:
+        if product_key in results:
+            print('    %s: %s' % (product_key, results.pop(product_key)))
+    if errors:
+        raise errors[next(key for key in product_keys if key in errors)]
+
+def import_configuration(tsm, config_file, fragment):
+    ''' Imports the settings or the topology fragment of the configuration file '''
+
+    only = '--config-only' if fragment == 'settings' else '--topology-only'
+    return tsm.run(['settings', 'import', only, '-f', ServerConfiguration.load(config_file).fragment_file(fragment)])
+
+def add_setup_steps(scheduler, options, secrets, tsm, checkpoint):
+    ''' Adds the setup steps after the installer to the scheduler. Steps that the checkpoint
+    journal has as completed are skipped when they run. '''
+
+    def add_step(step, message, depends_on, function, *args):
+        scheduler.add(step, checkpoint.run, (step, message, function) + args, depends_on, describe_step(function, args))
 
     # activate a trial and/or any license keys specified in the secrets file
     product_keys = secrets.get('product_keys')
     if (isinstance(product_keys, list)):
         if ('trial' in product_keys):
-            run_tsm_command(tsm_path, secrets, ['licenses','activate', '--trial'], port)
-            print('Activated trial')
-        for productKey in product_keys:
-            if (len(productKey) > 0 and productKey != 'trial'):
-                run_tsm_command(tsm_path, secrets, ['licenses','activate', '--license-key', productKey], port)
-                print('Activated license key: ' + productKey)
-
-    run_tsm_command(tsm_path, secrets, ['register', '--file', options.registrationFile], port)
+            add_step('activate trial', 'Activated trial', [], tsm.run, ['licenses','activate', '--trial'])
+        add_step('activate product keys', None, ['activate trial'], activate_product_keys, tsm, [key for key in product_keys if len(key) > 0 and key != 'trial'], int(options.licenseActivationWorkers))
+
+    # licensing, registration and saving the node configuration do not depend on each other
+    add_step('register', None, [], tsm.run, ['register', '--file', options.registrationFile])
     if options.saveNodeConfiguration == 'yes':
-        run_tsm_command(tsm_path, secrets, ['topology', 'nodes', 'get-bootstrap-file', '--file', options.nodeConfigurationDirectory], port)
-        print('Node configuration file saved.')
-    run_tsm_command(tsm_path, secrets, ['settings', 'import', '--config-only', '-f', options.configFile], port)
-    print('Configuration settings imported')
-    run_tsm_command(tsm_path, secrets, ['pending-changes', 'apply', '--ignore-prompt', '--ignore-warnings'], port)
-    print('Configuration applied')
-    run_tsm_command(tsm_path, secrets, ['initialize', '--request-timeout', '7200'], port)
-    print('Initialization completed')
-    get_nodes_and_apply_topology(options.configFile, tsm_path, secrets, port)
-    run_tsm_command(tsm_path, secrets, ['pending-changes', 'apply', '--ignore-prompt', '--ignore-warnings'], port)
-    print('Topology applied')
+        add_step('save node configuration', 'Node configuration file saved.', [], tsm.run, ['topology', 'nodes', 'get-bootstrap-file', '--file', options.nodeConfigurationDirectory])
+    add_step('import configuration', 'Configuration settings imported', ['activate trial', 'activate product keys', 'register'], import_configuration, tsm, options.configFile, 'settings')
+    add_step('apply configuration', 'Configuration applied', ['import configuration', 'save node configuration'], tsm.run, ['pending-changes', 'apply', '--ignore-prompt', '--ignore-warnings'])
+    add_step('initialize', 'Initialization completed', ['apply configuration'], OperationTracker(tsm).run, ['initialize', '--request-timeout', '7200'])
+    add_step('import topology', None, ['initialize'], get_nodes_and_apply_topology, options.configFile, tsm)
+    add_step('apply topology', 'Topology applied', ['import topology'], tsm.run, ['pending-changes', 'apply', '--ignore-prompt', '--ignore-warnings'])
     if options.start == 'yes':
-        run_tsm_command(tsm_path, secrets, ['start', '--request-timeout', '1800'], port)
-        print('Server is installed and running')
-        run_tabcmd_command(tabcmd_path, ['initialuser', '--server', 'localhost:'+str(getGatewayPort(options.configFile)), '--username', secrets['content_admin_user'], '--password', secrets['content_admin_pass']])
-        print('Initial admin created')
+        add_step('start', 'Server is installed and running', ['apply topology'], OperationTracker(tsm, 'RUNNING').run, ['start', '--request-timeout', '1800'])
+        scheduler.add('gateway port', getGatewayPort, (options.configFile,))
+
+# Limits of the gateway probe that --gatewayProbeThresholds can set: latencies in milliseconds,
+# errorRate as a fraction of the requests and regression as a factor of the baseline p95
+GATEWAY_PROBE_LIMITS = ['p50', 'p95', 'p99', 'errorRate', 'regression']
+
+# A p95 that grew by less than this many milliseconds is not reported as a regression, so that
+# a fast baseline doesn't turn scheduling noise into failures
+GATEWAY_PROBE_MIN_REGRESSION_MS = 50
+
+def parse_probe_thresholds(value):
+    ''' Returns the limits of a name=value,... string, or raises OptionsError '''
+
+    thresholds = {}
+    for item in [item.strip() for item in (value or '').split(',') if item.strip()]:
+        name, _, limit = item.partition('=')
+        name = name.strip()
+        if name not in GATEWAY_PROBE_LIMITS:
+            raise OptionsError('Unknown gateway probe threshold "%s", expected one of %s' % (name, ', '.join(GATEWAY_PROBE_LIMITS)))
+        try:
+            thresholds[name] = float(limit)
+        except ValueError:
+            raise OptionsError('Gateway probe threshold %s "%s" is not a number' % (name, limit.strip()))
+    return thresholds
+
+def get_probe_urls(options, gateway_port):
+    ''' The gateways to probe. A host without scheme or port is probed over http on the gateway port. '''
+
+    hosts = [host.strip() for host in (options.gatewayProbeHosts or '').split(',') if host.strip()] or ['localhost']
+    urls = []
+    for host in hosts:
+        if '://' not in host:
+            host = 'http://' + (host if ':' in host else '%s:%s' % (host, gateway_port))
+        url = urllib.parse.urlsplit(host)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise OptionsError('Gateway probe host "%s" is not a host name or http(s) URL' % host)
+        urls.append(url)
+    return urls
+
+def get_probe_baseline_path(options):
+    return options.gatewayProbeBaseline or os.path.join(os.path.dirname(os.path.abspath(options.nodeConfigurationDirectory)), 'GatewayBaseline.json')
+
+def percentile(values, fraction):
+    ''' The nearest rank percentile of sorted values '''
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
+
+class GatewayProbe(object):
+    ''' Sends a number of GET requests to one gateway, from concurrent keep-alive connections,
+    and measures the latency of each. Responses with a status below 400 count as successful. '''
+
+    def __init__(self, url, paths, requests, concurrency, timeout=30):
+        self.url = url
+        self.paths = paths
+        self.requests = requests
+        self.concurrency = max(1, min(concurrency, requests))
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sent = 0
+
+    def connect(self):
+        if self.url.scheme == 'https':
+            # the probe measures latency, a new node usually still has a self-signed certificate
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            return http.client.HTTPSConnection(self.url.hostname, self.url.port, timeout=self.timeout, context=context)
+        return http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=self.timeout)
+
+    def request(self, connection, path):
+        ''' Returns the latency in milliseconds and whether the request succeeded '''
+
+        started = time.time()
+        try:
+            connection.request('GET', path, headers={'User-Agent': 'SilentInstaller gateway probe'})
+            response = connection.getresponse()
+            response.read()
+            ok = response.status < 400
+            if response.will_close:
+                connection.close()
+        except (OSError, http.client.HTTPException):
+            # the connection is opened again by the next request
+            connection.close()
+            ok = False
+        return (time.time() - started) * 1000, ok
+
+    def next_path(self):
+        ''' The path of the next request, or None once all requests were sent '''
+
+        with self.lock:
+            if self.sent >= self.requests:
+                return None
+            self.sent += 1
+            return self.paths[(self.sent - 1) % len(self.paths)]
+
+    def worker(self, samples):
+        connection = self.connect()
+        try:
+            # the first request of a connection pays for connecting and is not measured
+            for path in self.paths:
+                self.request(connection, path)
+            path = self.next_path()
+            while path is not None:
+                samples.append(self.request(connection, path))
+                path = self.next_path()
+        finally:
+            connection.close()
+
+    def run(self):
+        ''' Sends all requests and returns the latency percentiles, error rate and throughput '''
+
+        samples = []
+        started = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for future in [pool.submit(JobContext.wrap(self.worker), samples) for _ in range(self.concurrency)]:
+                future.result()
+        elapsed = time.time() - started
+        latencies = sorted(latency for latency, ok in samples)
+        errors = len([ok for latency, ok in samples if not ok])
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'requests': len(samples),
+            'concurrency': self.concurrency,
+            'errors': errors,
+            'errorRate': errors / float(len(samples)),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1],
+            'throughput': len(samples) / elapsed if elapsed else 0.0
+        }
+
+def evaluate_probe(result, thresholds, baseline):
+    ''' Returns the thresholds that the probe result exceeds '''
+
+    problems = []
+    for name in ['p50', 'p95', 'p99']:
+        if name in thresholds and result[name] > thresholds[name]:
+            problems.append('%s latency %.0fms is over %.0fms' % (name, result[name], thresholds[name]))
+    if 'errorRate' in thresholds and result['errorRate'] > thresholds['errorRate']:
+        problems.append('%d of %d requests failed, error rate %.2f%% is over %.2f%%' % (result['errors'], result['requests'], result['errorRate'] * 100, thresholds['errorRate'] * 100))
+    if baseline and 'regression' in thresholds:
+        limit = max(baseline['p95'] * thresholds['regression'], baseline['p95'] + GATEWAY_PROBE_MIN_REGRESSION_MS)
+        if result['p95'] > limit:
+            problems.append('p95 latency %.0fms is over %g times the baseline of %.0fms from %s' % (result['p95'], thresholds['regression'], baseline['p95'], baseline['time']))
+    return problems
+
+def run_gateway_probe(options, gateway_port):
+    ''' Probes every gateway, prints the results and keeps them in the baseline file. The first
+    passing result of a gateway becomes its baseline, later results are compared to it. Raises
+    GatewayProbeError if a threshold is exceeded and --gatewayProbeAction is fail. '''
+
+    thresholds = parse_probe_thresholds(options.gatewayProbeThresholds)
+    paths = [path.strip() for path in options.gatewayProbePaths.split(',') if path.strip()] or ['/']
+    baseline_path = get_probe_baseline_path(options)
+    baselines = read_json_object(baseline_path, 'gateway baseline file') if os.path.isfile(baseline_path) else {}
+
+    failed = []
+    print('Gateway probe (%s requests, %s concurrent):' % (options.gatewayProbeRequests, options.gatewayProbeConcurrency))
+    print('    %-32s %8s %8s %8s %8s %7s %9s' % ('gateway', 'p50', 'p95', 'p99', 'max', 'errors', 'req/s'))
+    for url in get_probe_urls(options, gateway_port):
+        gateway = '%s://%s' % (url.scheme, url.netloc)
+        result = GatewayProbe(url, paths, int(options.gatewayProbeRequests), int(options.gatewayProbeConcurrency)).run()
+        entry = baselines.setdefault(gateway, {})
+        problems = evaluate_probe(result, thresholds, entry.get('baseline'))
+        print('    %-32s %6.0fms %6.0fms %6.0fms %6.0fms %6.1f%% %9.1f' % (gateway, result['p50'], result['p95'], result['p99'], result['max'], result['errorRate'] * 100, result['throughput']))
+        for problem in problems:
+            print('        ' + problem)
+        entry['last'] = result
+        if problems:
+            failed.append(gateway)
+        elif 'baseline' not in entry:
+            entry['baseline'] = result
+            print('        recorded as the baseline of ' + gateway)
+
+    with open(baseline_path, 'w') as baseline_file:
+        json.dump(baselines, baseline_file, indent=4, sort_keys=True)
+    if failed:
+        message = 'Gateway probe thresholds exceeded: ' + ', '.join(failed)
+        if options.gatewayProbeAction == 'fail':
+            raise GatewayProbeError(message)
+        print('Warning: ' + message)
+
+def run_setup(options, secrets, package_version, checkpoint=None):
+    ''' Runs a sequence of tsm commands to perform setup. Steps that the checkpoint journal
+    has as completed are skipped. '''
+
+    tsm_path = os.path.join(options.installDir, 'packages', 'bin.' + str(package_version), 'tsm.cmd')
+    tabcmd_path = os.path.join(options.installDir, 'packages', 'bin.' + str(package_version), 'tabcmd.exe')
+    checkpoint = checkpoint or InstallCheckpoint(None)
+    if checkpoint.steps:
+        validate_resume_preconditions(options, tsm_path)
+
+    with make_tsm_session(tsm_path, secrets, options) as tsm:
+        scheduler = StepScheduler()
+        add_setup_steps(scheduler, options, secrets, tsm, checkpoint)
+        try:
+            scheduler.run()
+        finally:
+            scheduler.print_critical_path()
+    if options.start == 'yes':
+        with TRACE.span('initial user'):
+            checkpoint.run('initial user', 'Initial admin created', run_tabcmd_command, tabcmd_path, ['initialuser', '--server', 'localhost:'+str(scheduler.results['gateway port']), '--username', secrets['content_admin_user'], '--password', secrets['content_admin_pass']])
+        if int(options.gatewayProbeRequests):
+            with TRACE.span('gateway probe'):
+                checkpoint.run('gateway probe', 'Gateway probe passed', run_gateway_probe, options, scheduler.results['gateway port'])
     print('Installation complete')
 
+# Rough durations in seconds, used by --plan for steps without timing history
+DEFAULT_STEP_ESTIMATES = {
+    'installer': 600,
+    'worker installer': 600,
+    'activate trial': 15,
+    'activate product keys': 20,
+    'register': 15,
+    'save node configuration': 15,
+    'import configuration': 20,
+    'apply configuration': 120,
+    'initialize': 1800,
+    'import topology': 30,
+    'apply topology': 300,
+    'start': 300,
+    'gateway port': 0,
+    'initial user': 30,
+    'gateway probe': 30,
+    'wait for nodes': 60,
+    'apply topology changes': 300
+}
+
+class PlannedSession(object):
+    ''' Stands in for the tsm session while planning. Steps only refer to it; nothing is run. '''
+
+    def run(self, args, return_result=False):
+        raise RuntimeError('No tsm commands are run while planning')
+
+def describe_step(function, args):
+    ''' A short description of what a step runs, shown in the plan '''
+
+    if function == InstallCheckpoint.run or getattr(function, '__func__', None) == InstallCheckpoint.run:
+        return describe_step(args[2], args[3:])
+    if getattr(function, '__name__', None) == 'run' and args and isinstance(args[0], list):
+        return 'tsm ' + ' '.join(args[0])
+    if function == import_configuration:
+        return 'tsm settings import (%s)' % args[2]
+    return getattr(function, '__name__', str(function)).replace('_', ' ')
+
+def make_plan(options, secrets):
+    ''' Builds the steps the mode would run as a scheduler that is never run '''
+
+    scheduler = StepScheduler()
+    if options.type == 'install':
+        scheduler.add('installer', run_wix_installer, (options,), description='%s /INSTALL /SILENT INSTALLDIR="%s" DATADIR="%s"' % (options.installer, options.installDir, options.dataDir))
+        add_setup_steps(scheduler, options, secrets, PlannedSession(), InstallCheckpoint(None))
+        for name in scheduler.steps[1:]:
+            if not [dependency for dependency in scheduler.dependencies[name] if dependency in scheduler.functions]:
+                scheduler.dependencies[name].append('installer')
+        if options.start == 'yes':
+            scheduler.add('initial user', run_tabcmd_command, (), ['start', 'gateway port'], 'tabcmd initialuser --server localhost:%s' % ServerConfiguration.load(options.configFile).gateway_port(warn=False))
+            if int(options.gatewayProbeRequests):
+                add_gateway_probe_plan(scheduler, options, ['initial user'])
+    elif options.type == 'installWorker':
+        scheduler.add('worker installer', run_worker_installer, (options, secrets), description='%s /INSTALL /SILENT BOOTSTRAPFILE="%s"' % (options.installer, options.nodeConfigurationFile))
+    elif options.type == 'installWorkers':
+        print('tsm: ' + get_tsm_path(options))
+        executor = WORKER_EXECUTORS[options.workerExecutor](options)
+        worker_hosts = get_worker_hosts(options)
+        scheduler = StepScheduler(int(options.parallelWorkerInstalls) if options.parallelWorkerInstalls else len(ServerConfiguration.load(options.configFile).nodes) or 1)
+        node_steps = []
+        for node_id in sorted(ServerConfiguration.load(options.configFile).nodes):
+            command = executor.command(node_id, worker_hosts.get(node_id, node_id))
+            scheduler.add('install ' + node_id, executor.run, (), description=' '.join(command) if isinstance(command, list) else command)
+            node_steps.append('install ' + node_id)
+        scheduler.add('wait for nodes', wait_for_nodes, (), node_steps, 'tsm topology list-nodes, until all nodes joined (up to %ss)' % options.nodeWaitTimeout)
+        scheduler.add('apply topology changes', apply_topology_changes, (), ['wait for nodes'])
+    else:
+        print('tsm: ' + get_tsm_path(options))
+        scheduler.add('wait for nodes', wait_for_nodes, (), description='tsm topology list-nodes, until all nodes joined (up to %ss)' % options.nodeWaitTimeout)
+        scheduler.add('apply topology changes', apply_topology_changes, (), ['wait for nodes'])
+        if int(options.gatewayProbeRequests):
+            add_gateway_probe_plan(scheduler, options, ['apply topology changes'])
+    return scheduler
+
+def add_gateway_probe_plan(scheduler, options, depends_on):
+    urls = get_probe_urls(options, ServerConfiguration.load(options.configFile).gateway_port(warn=False))
+    scheduler.add('gateway probe', run_gateway_probe, (), depends_on, '%s GET requests, %s concurrent, to %s' % (options.gatewayProbeRequests, options.gatewayProbeConcurrency, ', '.join('%s://%s' % (url.scheme, url.netloc) for url in urls)))
+
+def run_plan(options):
+    ''' Validates the inputs and prints the steps the mode would run with estimated durations,
+    without changing anything or starting any process '''
+
+    print('Planning %s' % options.type)
+    run_preflight(options, get_preflight_checks(options, before_install=False))
+    secrets = get_secrets(options)
+    print('Secrets: ' + ', '.join(sorted(key for key, value in secrets.items() if value)))
+    if getattr(options, 'configFile', None):
+        nodes = ServerConfiguration.load(options.configFile).nodes
+        print('Topology nodes: ' + (', '.join(sorted(nodes)) or 'none'))
+    trace_files = [path for path in (options.planHistory or '').split(',') if path]
+    estimates, measured = install_common.load_step_estimates(trace_files, DEFAULT_STEP_ESTIMATES)
+    scheduler = make_plan(options, secrets)
+    # the nodes of installWorkers take as long as a worker installation
+    install_common.share_estimate(estimates, measured, [name for name in scheduler.steps if name.startswith('install node')], 'worker installer')
+    install_common.print_plan(scheduler, estimates, measured)
+    return 0
+
+# How the exit codes of main are reported in the batch summary
+BATCH_RESULTS = {
+    0: 'succeeded',
+    1: 'failed',
+    2: 'existing installation',
+    3: 'invalid options',
+    4: 'command failed',
+    5: 'gateway probe failed'
+}
+
+class BatchJob(object):
+    ''' One bootstrap file of a batch, and the outcome of running it '''
+
+    def __init__(self, bootstrap_file, log_dir=None):
+        self.bootstrap_file = os.path.abspath(bootstrap_file)
+        self.name = os.path.splitext(os.path.basename(bootstrap_file))[0]
+        self.log_file = os.path.join(log_dir or os.path.dirname(self.bootstrap_file), self.name + '.log')
+        self.options = None
+        self.exit_code = None
+        self.duration = None
+
+    @property
+    def result(self):
+        if self.exit_code is None:
+            return 'not started'
+        return BATCH_RESULTS.get(self.exit_code, 'exit code %d' % self.exit_code)
+
+    def run(self):
+        ''' Runs the validated options of the bootstrap file on this thread, within a context of
+        its own, so that its output, trace and command log are kept apart from the other jobs.
+        The output goes to the log file of the job. '''
+
+        print('Starting %s, logging to %s' % (self.name, self.log_file))
+        started = time.time()
+        try:
+            with open(self.log_file, 'w', buffering=1) as log_file:
+                context = JobContext(self.name, log_file)
+                try:
+                    self.exit_code = context.run(self.run_options)
+                finally:
+                    context.close()
+        except (IOError, OSError) as ex:
+            print_error('Could not write the log of %s: %s' % (self.name, str(ex)))
+            self.exit_code = 1
+        self.duration = time.time() - started
+        print('Finished %s: %s' % (self.name, self.result))
+        return self.exit_code
+
+    def run_options(self):
+        try:
+            return run_options(self.options)
+        except Exception:
+            # like an unhandled exception of a single run, which exits with 1
+            traceback.print_exc()
+            return 1
+
+def get_batch_files(batch):
+    ''' The bootstrap files of a batch directory or manifest. In a directory, the json files with a
+    secretsFile option are the bootstrap files, in name order. '''
+
+    if os.path.isdir(batch):
+        bootstrap_files = []
+        for name in sorted(os.listdir(batch)):
+            file_path = os.path.join(batch, name)
+            if name.lower().endswith('.json') and os.path.isfile(file_path):
+                try:
+                    content = read_json_file(file_path)
+                except OptionsError:
+                    content = None
+                if isinstance(content, dict) and 'secretsFile' in content:
+                    bootstrap_files.append(file_path)
+    else:
+        manifest = read_json_file(batch)
+        if not isinstance(manifest, list) or not all(isinstance(entry, str) for entry in manifest):
+            raise OptionsError('The batch manifest "%s" must be a json list of bootstrap file paths' % batch)
+        bootstrap_files = [os.path.join(os.path.dirname(os.path.abspath(batch)), entry) for entry in manifest]
+    if not bootstrap_files:
+        raise OptionsError('No bootstrap files found in "%s"' % batch)
+    return bootstrap_files
+
+def validate_batch(jobs):
+    ''' Reads the options of every job and runs their preflight checks, then checks that the jobs
+    can run side by side. Raises PreflightError naming every job with a problem. '''
+
+    failed = []
+    for job in jobs:
+        print('Validating %s' % job.bootstrap_file)
+        try:
+            job.options = Options(read_json_object(job.bootstrap_file, 'bootstrap file'))
+            run_preflight(job.options, get_preflight_checks(job.options, before_install=False))
+        except (OptionsError, ExistingInstallationError) as ex:
+            print_error('    %s' % str(ex))
+            failed.append(job.name)
+
+    problems = []
+    names = [job.name for job in jobs]
+    problems.extend('Two bootstrap files are named %s; their logs would collide' % name for name in sorted(set(names)) if names.count(name) > 1)
+    local_installs = [job.name for job in jobs if job.options and job.options.type in ('install', 'installWorker') and not job.options.plan]
+    if len(local_installs) > 1:
+        problems.append('Only one installation can run on this machine, but several jobs install: ' + ', '.join(local_installs))
+    for option in ('traceFile', 'commandLog'):
+        paths = [os.path.abspath(getattr(job.options, option)) for job in jobs if job.options and getattr(job.options, option)]
+        problems.extend('Several jobs write the %s %s' % (option, path) for path in sorted(set(paths)) if paths.count(path) > 1)
+    for problem in problems:
+        print_error(problem)
+    if failed or problems:
+        raise PreflightError('Batch validation failed' + (': ' + ', '.join(failed) if failed else ''))
+
+def print_batch_summary(jobs):
+    ''' Prints one row per job with its mode, result, duration and log file '''
+
+    rows = [('job', 'mode', 'result', 'duration', 'log')]
+    for job in jobs:
+        duration = '-' if job.duration is None else install_common.format_duration(job.duration)
+        rows.append((job.name, job.options.type, job.result, duration, job.log_file))
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]) - 1)]
+    print('Batch summary:')
+    for row in rows:
+        print('    ' + '  '.join(value.ljust(width) for value, width in zip(row, widths)) + '  ' + row[-1])
+
+def run_batch(args):
+    ''' Validates all bootstrap files of a batch before any of them runs, then runs them on at most
+    batchWorkers threads. Returns 0 if every job succeeded, otherwise the exit code of the
+    first failed job. '''
+
+    if args.batchWorkers < 1:
+        raise OptionsError('--batchWorkers must be at least 1')
+    if args.batchLogDir and not os.path.isdir(args.batchLogDir):
+        raise OptionsError('The batch log directory "%s" does not exist' % args.batchLogDir)
+    jobs = [BatchJob(bootstrap_file, args.batchLogDir) for bootstrap_file in get_batch_files(args.batch)]
+    print('Batch of %d bootstrap files' % len(jobs))
+    validate_batch(jobs)
+
+    failed = threading.Event()
+    def run_job(job):
+        if args.stopOnError and failed.is_set():
+            return
+        if job.run() != 0:
+            failed.set()
+
+    # the jobs print to the console streams, which are routed to the log of the job of each thread
+    console = (sys.stdout, sys.stderr)
+    sys.stdout, sys.stderr = JobOutput(sys.stdout), JobOutput(sys.stderr)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.batchWorkers) as pool:
+            for future in [pool.submit(run_job, job) for job in jobs]:
+                future.result()
+    finally:
+        sys.stdout, sys.stderr = console
+        print_batch_summary(jobs)
+    return next((job.exit_code for job in jobs if job.exit_code), 0)
+
 def get_options():
     ''' Parses the command line arguments and configuration files specified by the user '''
 
@@ -433,7 +2171,7 @@ def get_options():
         # read the options from the bootstrap file
         cmd_parser = make_bootstrap_cmd_line_parser()
         bootstrap_file = cmd_parser.parse_args().bootstrapFile
-        bootstrap_options = read_json_file(bootstrap_file)
+        bootstrap_options = read_json_object(bootstrap_file, 'bootstrap file')
         options = Options(bootstrap_options)
     else:
         # read the options from the command line
@@ -443,16 +2181,33 @@ def get_options():
 
     return options
 
+def is_installer_url(installer):
+    return installer.lower().startswith(('http://', 'https://'))
+
+def resolve_installer(options):
+    ''' Replaces the installer with its verified copy in the artifact cache. An installer URL is
+    always fetched, a local or share path only when --artifactCache is given. Raises OptionsError
+    if the installer can't be fetched, or does not match --installerSha256. '''
+
+    if not (is_installer_url(options.installer) or options.artifactCache):
+        return
+    import artifact_cache
+    cache = artifact_cache.ArtifactCache(options.artifactCache or artifact_cache.default_cache_dir(), int(options.downloadConnections))
+    try:
+        with TRACE.span('fetch installer'):
+            options.installer = cache.fetch(options.installer, options.installerSha256)
+    except (artifact_cache.ArtifactError, OSError) as ex:
+        raise OptionsError('Could not fetch the installer: %s' % ex)
+
 def get_secrets(options):
     ''' Retrieves the secrets from the user specified file '''
 
-    return read_json_file(options.secretsFile)
+    return read_json_object(options.secretsFile, 'secrets file')
 
 def is_server_installed():
     ''' Checks if there is an existing installation of Tableau Server '''
 
-    out = subprocess.check_output(['sc', 'query', 'type=', 'service', 'state=', 'all'])
-    return ('Tableau Server' in str(out))
+    return ('Tableau Server' in SYSTEM.list_services())
 
 def assert_no_existing_installation():
     ''' Raises an error if there is an existing installation of Tableau Server '''
@@ -463,68 +2218,464 @@ def assert_no_existing_installation():
             'Data currently in Tableau server will be preserved during this process.')
 
 
-def get_nodes_and_apply_topology(config_file, tsm_path, secrets, port, apply_and_restart=False):
-    ''' Retrieves the nodes from the config file and apply topology update if all nodes are ready '''
+# Ports given on the command line or in the bootstrap file that must not collide
+PORT_OPTIONS = [
+    'controllerPort',
+    'coordinationserviceClientPort',
+    'coordinationservicePeerPort',
+    'coordinationserviceLeaderPort',
+    'licenseserviceVendorDaemonPort',
+    'agentFileTransferPort'
+]
+
+# Keys every secrets file needs, by mode
+REQUIRED_SECRETS = {
+    'install': ['local_admin_user', 'local_admin_pass', 'content_admin_user', 'content_admin_pass'],
+    'installWorker': ['local_admin_user', 'local_admin_pass'],
+    'installWorkers': ['local_admin_user', 'local_admin_pass'],
+    'updateTopology': ['local_admin_user', 'local_admin_pass']
+}
+
+# Placeholder text of the json templates that has to be replaced before use
+TEMPLATE_PLACEHOLDER = '****'
+
+class PreflightError(OptionsError):
+    ''' One or more preflight checks failed '''
+    pass
+
+def find_placeholders(value, path=''):
+    ''' Returns the paths of the template placeholders left in a json document '''
+
+    if isinstance(value, dict):
+        return [found for key, item in value.items() for found in find_placeholders(key, path + '/' + key) + find_placeholders(item, path + '/' + key)]
+    if isinstance(value, list):
+        return [found for index, item in enumerate(value) for found in find_placeholders(item, '%s/%d' % (path, index))]
+    if isinstance(value, str) and TEMPLATE_PLACEHOLDER in value:
+        return [path or '/']
+    return []
 
-    config = read_json_file(config_file)
-    expected_nodes = set()
-    if 'nodes' in config['topologyVersion']:
-        # See if nodes are in entities, if yes get them
-        nodes = config['topologyVersion']['nodes']
-        for nodeId in nodes:
-            expected_nodes.add(nodeId)
-        nodes_output_list = run_tsm_command(tsm_path, secrets, ['topology', 'list-nodes'], port, return_tsm_result=True)
-        actual_nodes = set(nodes_output_list.splitlines())
-        if not expected_nodes.issubset(actual_nodes):
+def parse_port(value, name):
+    ''' Returns the port number, or raises OptionsError if it isn't a valid port '''
+
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        raise OptionsError('%s "%s" is not a port number' % (name, value))
+    if not 1 <= port <= 65535:
+        raise OptionsError('%s %d is not between 1 and 65535' % (name, port))
+    return port
+
+def check_files(options):
+    ''' Every file given in the options exists '''
+
+    problems = []
+    for name in ['secretsFile', 'registrationFile', 'configFile', 'nodeConfigurationFile', 'installer']:
+        path = getattr(options, name, None)
+        if name == 'installer' and path and is_installer_url(path):
+            # fetched into the artifact cache after the preflight checks
+            continue
+        if path and not os.path.isfile(path):
+            problems.append('%s "%s" does not exist' % (name, path))
+    return problems
+
+def check_secrets(options):
+    ''' The secrets file contains the credentials the mode needs '''
+
+    secrets = read_json_object(options.secretsFile, 'secrets file')
+    problems = ['secrets file has no "%s"' % key for key in REQUIRED_SECRETS[options.type] if not secrets.get(key)]
+    problems += ['secrets file still contains a template placeholder at ' + path for path in find_placeholders(secrets)]
+    return problems
+
+def check_json_file(path, name):
+    ''' The json file parses and has no template placeholders left '''
+
+    return ['%s still contains a template placeholder at %s' % (name, found) for found in find_placeholders(read_json_object(path, name))]
+
+def check_configuration(options):
+    ''' The configuration file has a valid gateway port and valid node ids '''
+
+    config = ServerConfiguration.load(options.configFile)
+    problems = ['configuration file still contains a template placeholder at ' + path for path in find_placeholders(config.document)]
+    if options.type == 'install':
+        gateway = config.gateway_port(warn=False)
+        if gateway is None:
+            problems.append('configuration file has configKeys but no gateway port')
+        else:
+            try:
+                if parse_port(gateway, 'gateway port') == int(options.controllerPort):
+                    problems.append('gateway port and controllerPort both use port %s' % options.controllerPort)
+            except (OptionsError, ValueError) as ex:
+                problems.append(str(ex))
+    if options.type in ('installWorkers', 'updateTopology') and not config.nodes:
+        problems.append('configuration file has no topologyVersion nodes')
+    for node_id in sorted(config.nodes):
+        if not re.match(r'^node[0-9]+$', node_id):
+            problems.append('"%s" is not a node id; node ids look like node1, node2, ...' % node_id)
+    problems += check_topology_rules(config.document.get('topologyVersion', {}).get('nodes', {}))
+    return problems
+
+# Names of the coordination service (ZooKeeper) in topology files
+COORDINATION_SERVICES = ['appzookeeper', 'coordinationservice']
+
+# Sizes a coordination service ensemble can have; an even size can't outvote a failed member
+ENSEMBLE_SIZES = [1, 3, 5]
+
+def check_topology_rules(nodes):
+    ''' The topologyVersion nodes form a valid cluster: the coordination service runs as an
+    ensemble of 1, 3 or 5 nodes with one instance each. Topologies without a coordination
+    service are left to tsm. '''
+
+    counts = TopologyDiff.instance_counts(nodes)
+    ensemble = dict((node_id, sum(services.get(name, 0) for name in COORDINATION_SERVICES)) for node_id, services in counts.items())
+    members = sorted(node_id for node_id, count in ensemble.items() if count)
+    if not members:
+        return []
+    problems = ['%s runs %d coordination service instances; a node runs at most one' % (node_id, ensemble[node_id]) for node_id in members if ensemble[node_id] > 1]
+    if len(members) not in ENSEMBLE_SIZES:
+        problems.append('the coordination service runs on %d nodes (%s); the ensemble must have %s nodes' % (
+            len(members), ', '.join(members), ', '.join(str(size) for size in ENSEMBLE_SIZES[:-1]) + ' or ' + str(ENSEMBLE_SIZES[-1])))
+    return problems
+
+def check_ports(options):
+    ''' The ports are valid, distinct, inside the port range, and not in use on this machine '''
+
+    problems = []
+    ports = {}
+    for name in PORT_OPTIONS:
+        value = getattr(options, name, None)
+        if value is None:
+            continue
+        try:
+            port = parse_port(value, name)
+        except OptionsError as ex:
+            problems.append(str(ex))
+            continue
+        if port in ports:
+            problems.append('%s and %s both use port %d' % (ports[port], name, port))
+        ports[port] = name
+
+    port_range = []
+    for name in ['portRangeMin', 'portRangeMax']:
+        value = getattr(options, name, None)
+        if value is not None:
+            try:
+                port_range.append(parse_port(value, name))
+            except OptionsError as ex:
+                problems.append(str(ex))
+    if len(port_range) == 2 and port_range[0] > port_range[1]:
+        problems.append('portRangeMin %d is larger than portRangeMax %d' % tuple(port_range))
+
+    for port, name in sorted(ports.items()):
+        if not is_port_free(port):
+            problems.append('%s %d is already in use on this machine' % (name, port))
+    return problems
+
+def is_port_free(port):
+    ''' Whether a listening socket can be bound to the port '''
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('', port))
+        return True
+    except OSError:
+        return False
+    finally:
+        listener.close()
+
+def check_disk_space(options):
+    ''' The data directory has at least minimumFreeDiskSpaceGB free '''
+
+    # the data directory is created by the installer, so look at its closest existing parent
+    path = os.path.abspath(options.dataDir)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    free = shutil.disk_usage(path).free / float(1024 ** 3)
+    required = float(options.minimumFreeDiskSpaceGB)
+    if free < required:
+        return ['%.1f GB free for dataDir %s, at least %.1f GB needed' % (free, options.dataDir, required)]
+    return []
+
+def check_gateway_probe(options):
+    ''' The gateway probe options are valid and the baseline file can be written '''
+
+    problems = []
+    for name in ['gatewayProbeRequests', 'gatewayProbeConcurrency']:
+        try:
+            if int(getattr(options, name)) < (0 if name == 'gatewayProbeRequests' else 1):
+                problems.append('%s %s is too small' % (name, getattr(options, name)))
+        except (TypeError, ValueError):
+            problems.append('%s "%s" is not a number' % (name, getattr(options, name)))
+    parse_probe_thresholds(options.gatewayProbeThresholds)
+    get_probe_urls(options, 80)
+    baseline_dir = os.path.dirname(os.path.abspath(get_probe_baseline_path(options)))
+    if not os.path.isdir(baseline_dir):
+        problems.append('directory of the gateway probe baseline "%s" does not exist' % baseline_dir)
+    return problems
+
+def check_existing_installation(options):
+    ''' There is no existing installation of Tableau Server '''
+
+    assert_no_existing_installation()
+    return []
+
+def get_preflight_checks(options, before_install=True):
+    ''' The preflight checks for the mode of the options. The existing installation and port
+    checks are left out when the installer already ran, in a resumed installation. '''
+
+    checks = [('files', check_files), ('secrets', check_secrets)]
+    if getattr(options, 'configFile', None):
+        checks.append(('configuration', check_configuration))
+    if getattr(options, 'registrationFile', None):
+        checks.append(('registration', lambda options: check_json_file(options.registrationFile, 'registration file')))
+    if getattr(options, 'nodeConfigurationFile', None):
+        checks.append(('node configuration', lambda options: check_json_file(options.nodeConfigurationFile, 'node configuration file')))
+    if options.type in ('install', 'installWorker'):
+        checks.append(('disk space', check_disk_space))
+        if before_install:
+            checks.append(('existing installation', check_existing_installation))
+    if options.type == 'install' and before_install:
+        checks.append(('ports', check_ports))
+    if options.type in ('install', 'updateTopology') and options.gatewayProbeRequests not in (None, '0', 0):
+        checks.append(('gateway probe', check_gateway_probe))
+    return checks
+
+def run_preflight(options, checks):
+    ''' Runs all checks at the same time and prints one report. Raises PreflightError if any
+    check failed, or ExistingInstallationError if that is the only problem. '''
+
+    results = {}
+    timings = {}
+    def run_check(name, check):
+        started = time.time()
+        try:
+            results[name] = (None, check(options))
+        except (OptionsError, ExistingInstallationError, OSError) as ex:
+            results[name] = (ex, [str(ex)])
+        except Exception as ex:
+            # a check that breaks on unexpected input still fails only that check
+            results[name] = (ex, ['%s: %s' % (type(ex).__name__, str(ex))])
+        timings[name] = time.time() - started
+
+    started = time.time()
+    with TRACE.span('preflight'):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(checks)) as pool:
+            for future in [pool.submit(JobContext.wrap(run_check), name, check) for name, check in checks]:
+                future.result()
+
+    failed = [name for name, check in checks if results[name][1]]
+    print('Preflight checks (%.0fms):' % ((time.time() - started) * 1000))
+    for name, check in checks:
+        print('    %s: %s (%.0fms)' % (name, 'FAILED' if name in failed else 'ok', timings[name] * 1000))
+        for problem in results[name][1]:
+            print('        ' + problem)
+    if failed == ['existing installation']:
+        raise results['existing installation'][0]
+    if failed:
+        raise PreflightError('Preflight checks failed: ' + ', '.join(failed))
+
+
+# Where tsm.cmd of each installation directory was found, so that a non-standard layout only has to be
+# searched once
+BINARIES_INDEX_PATH = os.path.join(tempfile.gettempdir(), 'SilentInstallerBinaries.json')
+
+def get_tsm_path(options):
+    ''' Finds tsm.cmd of the newest package under the installation directory, see
+    install_common.find_binaries_directory. A plan leaves the binaries index unchanged. '''
+
+    tsm_dir = install_common.find_binaries_directory(options.installDir, 'tsm.cmd', BINARIES_INDEX_PATH, write_index=not options.plan)
+    if tsm_dir is None:
+        raise OptionsError('Could not find tsm under directory %s. Please provide correct value in the installDir option' % options.installDir)
+    return os.path.join(tsm_dir, 'tsm.cmd')
+
+# Services that can't be changed with tsm topology set-process; a change to one of them is
+# applied by importing the whole topology
+FULL_IMPORT_SERVICES = COORDINATION_SERVICES + ['tabadmincontroller', 'clientfileservice']
+
+# Above this many process changes, importing the whole topology is faster than running
+# set-process for each one
+MAX_PROCESS_CHANGES = 10
+
+class TopologyDiff(object):
+    ''' The difference between the current topology of the cluster and a desired topology,
+    given as node id to {service: instance count} mappings '''
+
+    def __init__(self, current, desired):
+        self.current = current
+        self.desired = desired
+        self.removed_nodes = sorted(set(current) - set(desired))
+        self.added_nodes = sorted(set(desired) - set(current))
+        self.process_changes = []
+        for node_id in sorted(desired):
+            current_services = current.get(node_id, {})
+            for service in sorted(set(current_services) | set(desired[node_id])):
+                current_count = current_services.get(service, 0)
+                desired_count = desired[node_id].get(service, 0)
+                if current_count != desired_count:
+                    self.process_changes.append((node_id, service, current_count, desired_count))
+
+    @staticmethod
+    def instance_counts(nodes):
+        ''' Maps the nodes of a topologyVersion to {service: instance count} '''
+        return dict((node_id, dict((service, len(settings.get('instances', []))) for service, settings in node.get('services', {}).items()))
+            for node_id, node in nodes.items())
+
+    def is_empty(self):
+        return not (self.removed_nodes or self.process_changes)
+
+    def needs_full_import(self):
+        ''' New nodes, nodes without processes yet, nodes to remove that still run processes,
+        structural services and large change sets are imported as a whole topology '''
+        if len(self.process_changes) > MAX_PROCESS_CHANGES:
+            return True
+        if any(any(self.current[node_id].values()) for node_id in self.removed_nodes):
+            return True
+        for node_id, service, current_count, desired_count in self.process_changes:
+            if service in FULL_IMPORT_SERVICES or not any(self.current.get(node_id, {}).values()):
+                return True
+        return False
+
+    def needs_restart(self):
+        ''' pending-changes apply restarts the processes it has to; removing nodes needs a
+        restart of the cluster '''
+        return bool(self.removed_nodes)
+
+    def print_summary(self):
+        print('Topology changes:')
+        if self.is_empty():
+            print('    none')
+        for node_id, service, current_count, desired_count in self.process_changes:
+            print('    %s %s: %d -> %d instances' % (node_id, service, current_count, desired_count))
+        for node_id in self.removed_nodes:
+            print('    remove node %s' % node_id)
+
+def get_current_topology(tsm):
+    ''' Exports the settings of the cluster and returns the nodes of its topologyVersion '''
+
+    with tempfile.NamedTemporaryFile(prefix='TableauServerExport_', suffix='.json', delete=False) as export_file:
+        export_path = export_file.name
+    try:
+        tsm.run(['settings', 'export', '--output-config-file', export_path])
+        return read_json_object(export_path, 'exported configuration').get('topologyVersion', {}).get('nodes', {})
+    finally:
+        os.remove(export_path)
+
+def apply_topology_changes(config, tsm, actual_nodes):
+    ''' Applies the difference between the current topology and the topology of the config file:
+    only the changed processes are set, extra nodes are removed with one call, and a running
+    server is restarted only if nodes were removed. If the server was running, waits until it is
+    running again with no failed services. '''
+
+    current = TopologyDiff.instance_counts(get_current_topology(tsm))
+    # nodes that joined the cluster but have no processes yet
+    for node_id in actual_nodes:
+        current.setdefault(node_id, {})
+    diff = TopologyDiff(current, TopologyDiff.instance_counts(config.topology['topologyVersion'].get('nodes', {})))
+    diff.print_summary()
+    if diff.is_empty():
+        print('Topology is already up to date.')
+        return
+
+    monitor = StatusMonitor(tsm)
+    monitor.refresh()
+    was_running = monitor.status == 'RUNNING'
+    if diff.needs_full_import():
+        tsm.run(['settings', 'import', '--topology-only', '-f', config.fragment_file('topology')])
+    else:
+        for node_id, service, current_count, desired_count in diff.process_changes:
+            tsm.run(['topology', 'set-process', '-n', node_id, '-pr', service, '-c', str(desired_count)])
+    if diff.needs_full_import() or diff.process_changes:
+        print('Topology applied')
+        tsm.run(['pending-changes', 'apply', '--ignore-prompt', '--ignore-warnings'])
+        print('Topology change has been applied.')
+
+    if diff.removed_nodes:
+        # nodes not listed in topology will be removed for consistency
+        print('Removing extra nodes: ' + ', '.join(diff.removed_nodes))
+        tsm.run(['topology', 'remove-nodes', '-n', ','.join(diff.removed_nodes)])
+        print('Nodes %s have been removed. Please uninstall Tableau server from them for complete clean up.' % ', '.join(diff.removed_nodes))
+
+    if diff.needs_restart() and monitor.status == 'STOPPED':
+        print('Server is stopped, the removed nodes take effect when it is started.')
+    elif diff.needs_restart():
+        print('Restarting server...')
+        OperationTracker(tsm, 'RUNNING', monitor).run(['restart', '--request-timeout', '1800'])
+        print('Server is running after restart.')
+    if was_running:
+        monitor.wait_until(ServerStatus.is_healthy, HEALTH_CHECK_TIMEOUT, 'topology health check')
+        print('Server is running with %d service instances on %d nodes.' % (len(monitor.current.instances), len(monitor.current.nodes)))
+
+def get_nodes_and_apply_topology(config_file, tsm, apply_and_restart=False, wait_timeout=0):
+    ''' Retrieves the nodes from the config file and apply topology update as soon as all nodes are ready.
+    Waits up to wait_timeout seconds for missing nodes. With apply_and_restart, only the changes to
+    the current topology are applied. Returns whether the topology was applied. '''
+
+    config = ServerConfiguration.load(config_file)
+    if 'nodes' in config.topology['topologyVersion']:
+        expected_nodes = config.nodes
+        actual_nodes, ready = wait_for_nodes(tsm, expected_nodes, wait_timeout)
+        if not ready:
             # topology not ready with all expected nodes, return with no-op
             print('Not all nodes in desired topology are ready. Please make sure all worker nodes are installed properly then rerun SilentInstaller with updateTopology option.')
             print('Expected nodes: ' + ', '.join(expected_nodes))
             print('Actual nodes: ' + ', '.join(actual_nodes))
-            return
-        run_tsm_command(tsm_path, secrets, ['settings', 'import', '--topology-only', '-f', config_file], port)
-        print('Topology applied')
+            return False
         if apply_and_restart:
-            run_tsm_command(tsm_path, secrets, ['pending-changes', 'apply', '--ignore-prompt', '--ignore-warnings'], port)
-            print('Topology change has been applied.')
-            for node in actual_nodes - expected_nodes:
-                # nodes not listed in topology will be removed for consistency
-                print('Removing extra node: ' + node)
-                run_tsm_command(tsm_path, secrets, ['topology', 'remove-nodes', '-n', node], port)
-                print('Node ' + node + 'has been removed. Please uninstall Tableau server from the node for complete clean up.')
-            print('Restarting server...')
-            run_tsm_command(tsm_path, secrets, ['restart'], port)
-            print('Server is running after restart.')
+            apply_topology_changes(config, tsm, actual_nodes)
+        else:
+            tsm.run(['settings', 'import', '--topology-only', '-f', config.fragment_file('topology')])
+            print('Topology applied')
+    return True
 
 
-def main():
+def run_options(options):
+    ''' Runs the mode of the options and returns the exit code '''
+
     try:
-        options = get_options()
+        if options.plan:
+            return run_plan(options)
+        if options.traceFile:
+            TRACE.open(options.traceFile)
+        if options.commandLog:
+            open_command_log(options.commandLog)
+        checkpoint = None
+        if options.type == 'install':
+            checkpoint = InstallCheckpoint(get_checkpoint_path(options), options.resume)
+        # validate every input before anything is changed on this machine
+        run_preflight(options, get_preflight_checks(options, before_install=checkpoint is None or not checkpoint.is_complete('install')))
+        # a remote worker executor passes the installer on, and every host fetches it into its own cache
+        if (options.type in ('install', 'installWorker') and (checkpoint is None or not checkpoint.is_complete('install'))) \
+                or (options.type == 'installWorkers' and options.workerExecutor == 'local'):
+            resolve_installer(options)
         secrets = get_secrets(options)
         if options.type == 'updateTopology':
-            package_path = os.path.join(options.installDir, "packages")
-            lst = os.listdir(package_path)
-            lst.sort(reverse=True)
-            for subdir in lst:
-                if "bin." in subdir:
-                    tsm_path = os.path.join(package_path, subdir, "tsm.cmd")
-                    found_tsm = False
-                    if os.path.isfile(tsm_path):
-                        get_nodes_and_apply_topology(options.configFile, tsm_path, secrets, options.controllerPort, apply_and_restart=True)
-                        found_tsm = True
-                        break
-                    if not found_tsm:
-                        raise OptionsError('Could not find tsm under directory %s. Please provide correct value in the installDir option' % options.installDir)
-        else:
-            assert_no_existing_installation()
-            if options.type == 'installWorker':
-                # install worker node
+            with make_tsm_session(get_tsm_path(options), secrets, options) as tsm:
+                with TRACE.span('update topology'):
+                    applied = get_nodes_and_apply_topology(options.configFile, tsm, apply_and_restart=True, wait_timeout=int(options.nodeWaitTimeout))
+            if applied and int(options.gatewayProbeRequests):
+                with TRACE.span('gateway probe'):
+                    run_gateway_probe(options, getGatewayPort(options.configFile))
+        elif options.type == 'installWorkers':
+            with TRACE.span('install workers'):
+                run_install_workers(options, secrets)
+        elif options.type == 'installWorker':
+            # install worker node
+            with TRACE.span('worker installer'):
                 run_worker_installer(options, secrets)
+        else:
+            # install and set up first node
+            if checkpoint.is_complete('install'):
+                print('Skipping install, completed at %s' % checkpoint.steps['install']['completed'])
+                package_version = checkpoint.result('install')
             else:
-                # install and set up first node
-                package_version = run_wix_installer(options)
+                checkpoint.start()
+                with TRACE.span('installer'):
+                    package_version = run_wix_installer(options)
                 # only configure if we can determine the version that was installed.
                 if package_version != 'none':
-                    run_setup(options, secrets, package_version)
+                    checkpoint.record('install', package_version)
+            if package_version != 'none':
+                with TRACE.span('setup'):
+                    run_setup(options, secrets, package_version, checkpoint)
         return 0
 
     # by default exceptions exit with 1
@@ -536,6 +2687,22 @@ def main():
         return 3
     except ExitCodeError as ex:
         return 4
+    except GatewayProbeError as ex:
+        print_error(str(ex))
+        return 5
+    finally:
+        TRACE.close()
+
+def main():
+    try:
+        if any([arg == '--batch' or arg.startswith('--batch=') for arg in sys.argv]):
+            return run_batch(make_batch_cmd_line_parser().parse_args())
+        return run_options(get_options())
+    except OptionsError as ex:
+        print_error(str(ex))
+        return 3
+    finally:
+        ServerConfiguration.cleanup()
 
 
 if __name__ == '__main__':
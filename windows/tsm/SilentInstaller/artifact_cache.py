@@ -0,0 +1,351 @@
+''' A content-addressed cache for installer artifacts.
+
+Installers are kept under <cache>/sha256/<digest>/<file name>, and only ever placed there after
+their SHA-256 was verified, so a cached installer is used again without hashing it. A download
+is split into chunks that are fetched in parallel, with HTTP range requests for a URL or reads at
+an offset for a local or share path. The chunks already written are recorded next to the partial
+file, so an interrupted download resumes where it stopped:
+
+    python artifact_cache.py fetch https://bucket.s3.amazonaws.com/TableauServer.exe --sha256 <digest> --cache C:\\TableauCache
+'''
+
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import http.client as httplib
+    from urllib.parse import urlsplit, urljoin
+except ImportError:
+    import httplib
+    from urlparse import urlsplit, urljoin
+
+CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_CONNECTIONS = 4
+READ_SIZE = 1024 * 1024
+MAX_REDIRECTS = 5
+
+
+class ArtifactError(Exception):
+    ''' An artifact could not be fetched, or its content does not match the expected digest '''
+    pass
+
+
+def is_url(source):
+    return source.lower().startswith(('http://', 'https://'))
+
+def default_cache_dir():
+    ''' ProgramData on Windows, so that the cache outlives the temporary directory of a user '''
+    return os.path.join(os.environ.get('ProgramData') or tempfile.gettempdir(), 'Tableau', 'InstallerCache')
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as artifact:
+        for block in iter(lambda: artifact.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def link_or_copy(source, destination):
+    ''' Hard links the file, or copies it when the destination is on another volume '''
+    try:
+        os.link(source, destination)
+    except (AttributeError, OSError):
+        shutil.copyfile(source, destination)
+
+def read_json(path, default):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (IOError, OSError, ValueError):
+        return default
+
+def write_json(path, content):
+    ''' Writes through a temporary file, so that a crash never leaves a truncated file behind '''
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as json_file:
+        json.dump(content, json_file, indent=4)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temporary_path, path)
+
+
+class HttpSource(object):
+    ''' An artifact behind an http or https URL. Redirects, e.g. to a pre-signed S3 URL, are followed. '''
+
+    def __init__(self, url, timeout=60):
+        self.url = url
+        self.timeout = timeout
+        self.name = os.path.basename(urlsplit(url).path) or 'artifact'
+
+    def request(self, method, headers=None):
+        url = self.url
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            connection_class = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+            connection = connection_class(parts.hostname, parts.port, timeout=self.timeout)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+            except (httplib.HTTPException, IOError, OSError) as ex:
+                connection.close()
+                raise ArtifactError('%s %s failed: %s' % (method, url, ex))
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                connection.close()
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            return connection, response
+        raise ArtifactError('Too many redirects fetching %s' % self.url)
+
+    def probe(self):
+        ''' Returns (size, validator, supports_ranges). The validator changes when the artifact does.
+        Asks for the first byte instead of the headers only, because pre-signed URLs are only
+        valid for GET. A server that ignores the range answers 200 with the whole artifact, so
+        only the one byte of a 206 is read; otherwise the connection is closed unread. '''
+        connection, response = self.request('GET', {'Range': 'bytes=0-0'})
+        try:
+            if response.status == 206:
+                response.read()
+            if response.status not in (200, 206):
+                raise ArtifactError('GET %s returned %d' % (self.url, response.status))
+            if response.status == 206:
+                size = int((response.getheader('Content-Range') or '/-1').rsplit('/', 1)[1].replace('*', '-1'))
+            else:
+                size = int(response.getheader('Content-Length') or -1)
+            validator = response.getheader('ETag') or response.getheader('Last-Modified') or str(size)
+            return size, validator, response.status == 206 and size > 0
+        finally:
+            connection.close()
+
+    def copy_range(self, start, end, output):
+        ''' Writes bytes start to end, inclusive, to output at the same offset '''
+        connection, response = self.request('GET', {'Range': 'bytes=%d-%d' % (start, end)})
+        try:
+            if response.status != 206:
+                raise ArtifactError('Range request for %s returned %d' % (self.url, response.status))
+            output.seek(start)
+            copy_stream(response, output, end - start + 1)
+        finally:
+            connection.close()
+
+    def copy_all(self, output):
+        connection, response = self.request('GET')
+        try:
+            if response.status != 200:
+                raise ArtifactError('GET %s returned %d' % (self.url, response.status))
+            copy_stream(response, output)
+        finally:
+            connection.close()
+
+
+class FileSource(object):
+    ''' An artifact on a local disk or a file share '''
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def probe(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError as ex:
+            raise ArtifactError('Cannot read %s: %s' % (self.path, ex))
+        return stat.st_size, '%d-%d' % (stat.st_size, int(stat.st_mtime)), stat.st_size > 0
+
+    def copy_range(self, start, end, output):
+        with open(self.path, 'rb') as source:
+            source.seek(start)
+            output.seek(start)
+            copy_stream(source, output, end - start + 1)
+
+    def copy_all(self, output):
+        with open(self.path, 'rb') as source:
+            copy_stream(source, output)
+
+
+def copy_stream(source, output, length=None):
+    remaining = length
+    while remaining is None or remaining > 0:
+        block = source.read(READ_SIZE if remaining is None else min(READ_SIZE, remaining))
+        if not block:
+            break
+        output.write(block)
+        if remaining is not None:
+            remaining -= len(block)
+    if remaining:
+        raise ArtifactError('Source ended %d bytes early' % remaining)
+
+def make_source(source):
+    return HttpSource(source) if is_url(source) else FileSource(source)
+
+
+class ArtifactCache(object):
+    ''' The cache directory. index.json remembers the digest of every source fetched before,
+    with its validator, so that a source fetched without --sha256 is still found again. '''
+
+    def __init__(self, root, connections=DEFAULT_CONNECTIONS, chunk_size=CHUNK_SIZE):
+        self.root = os.path.abspath(root)
+        self.connections = max(1, int(connections))
+        self.chunk_size = chunk_size
+        self.index_path = os.path.join(self.root, 'index.json')
+        for directory in ['sha256', 'partial']:
+            if not os.path.isdir(os.path.join(self.root, directory)):
+                os.makedirs(os.path.join(self.root, directory))
+
+    def artifact_path(self, digest, name):
+        return os.path.join(self.root, 'sha256', digest, name)
+
+    def lookup(self, digest, name):
+        ''' The verified artifact with the digest, under the given file name, or None. Installers
+        check their own file name, so content cached under another name is hard linked. '''
+        directory = os.path.join(self.root, 'sha256', digest)
+        if not os.path.isdir(directory):
+            return None
+        names = sorted(entry for entry in os.listdir(directory) if not entry.endswith('.tmp'))
+        if not names:
+            return None
+        path = self.artifact_path(digest, name)
+        if name not in names:
+            link_or_copy(os.path.join(directory, names[0]), path)
+        return path
+
+    def fetch(self, source, sha256=None, log=print):
+        ''' Returns the local path of the verified artifact. Downloads it only when it is not
+        cached yet. Without sha256 the digest from an earlier fetch of the same, unchanged source
+        is used. '''
+        artifact = make_source(source)
+        expected = sha256.lower() if sha256 else None
+        if expected:
+            path = self.lookup(expected, artifact.name)
+            if path:
+                log('Using cached %s (sha256 %s)' % (path, expected))
+                return path
+
+        size, validator, supports_ranges = artifact.probe()
+        index = read_json(self.index_path, {})
+        entry = index.get(source)
+        if entry and entry['validator'] == validator and entry['size'] == size and (not expected or entry['sha256'] == expected):
+            path = self.lookup(entry['sha256'], artifact.name)
+            if path:
+                log('Using cached %s, %s is unchanged' % (path, source))
+                return path
+
+        key = expected or hashlib.sha256(source.encode('utf-8')).hexdigest()
+        partial_path = os.path.join(self.root, 'partial', key + '.part')
+        started = time.time()
+        self.download(artifact, partial_path, size, validator, supports_ranges, log)
+        downloaded = time.time()
+        digest = sha256_file(partial_path)
+        log('Fetched %s (%.0f MB) in %.1fs, verified in %.1fs' % (source, max(size, 0) / 1048576.0, downloaded - started, time.time() - downloaded))
+        if expected and digest != expected:
+            os.remove(partial_path)
+            os.remove(partial_path + '.json')
+            raise ArtifactError('%s has sha256 %s, expected %s' % (source, digest, expected))
+
+        path = self.artifact_path(digest, artifact.name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if os.path.exists(path):
+            os.remove(partial_path)
+        else:
+            # installers are executables
+            os.chmod(partial_path, 0o755)
+            os.rename(partial_path, path)
+        os.remove(partial_path + '.json')
+        index = read_json(self.index_path, {})
+        index[source] = {'sha256': digest, 'size': size, 'validator': validator}
+        write_json(self.index_path, index)
+        return path
+
+    def download(self, artifact, partial_path, size, validator, supports_ranges, log):
+        ''' Fetches the chunks that the journal next to the partial file does not list yet.
+        Sources that can't be read at an offset are fetched in one piece. '''
+        journal_path = partial_path + '.json'
+        journal = read_json(journal_path, {})
+        if not supports_ranges:
+            with open(partial_path, 'wb') as output:
+                artifact.copy_all(output)
+            write_json(journal_path, {'size': size, 'validator': validator})
+            return
+
+        chunk_count = (size + self.chunk_size - 1) // self.chunk_size
+        done = set()
+        if os.path.isfile(partial_path) and journal.get('size') == size and journal.get('validator') == validator and journal.get('chunkSize') == self.chunk_size:
+            done = set(journal.get('done', []))
+            if done:
+                log('Resuming %s, %d of %d chunks already fetched' % (artifact.name, len(done), chunk_count))
+        else:
+            with open(partial_path, 'wb') as output:
+                output.truncate(size)
+        pending = [chunk for chunk in range(chunk_count) if chunk not in done]
+        lock = threading.Lock()
+        errors = []
+
+        def fetch_chunks():
+            with open(partial_path, 'r+b') as output:
+                while True:
+                    with lock:
+                        if not pending or errors:
+                            return
+                        chunk = pending.pop(0)
+                    try:
+                        start = chunk * self.chunk_size
+                        artifact.copy_range(start, min(start + self.chunk_size, size) - 1, output)
+                        output.flush()
+                    except Exception as ex:
+                        with lock:
+                            errors.append(ex)
+                        return
+                    with lock:
+                        done.add(chunk)
+                        write_json(journal_path, {'size': size, 'validator': validator, 'chunkSize': self.chunk_size, 'done': sorted(done)})
+
+        threads = [threading.Thread(target=fetch_chunks) for _ in range(min(self.connections, len(pending)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise ArtifactError('Fetching %s stopped after %d of %d chunks, run again to resume: %s' % (artifact.name, len(done), chunk_count, errors[0]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Content-addressed cache for installer artifacts')
+    subparsers = parser.add_subparsers(dest='action')
+    fetch_parser = subparsers.add_parser('fetch', help='Fetch an artifact into the cache and print its local path')
+    fetch_parser.add_argument('source', help='URL, local path or share path of the artifact')
+    fetch_parser.add_argument('--sha256', help='Expected SHA-256 of the artifact', default=None)
+    fetch_parser.add_argument('--cache', help='Cache directory', default=default_cache_dir())
+    fetch_parser.add_argument('--connections', type=int, help='Chunks fetched at the same time', default=DEFAULT_CONNECTIONS)
+    fetch_parser.add_argument('--link', help='Also hard link the artifact to this path', default=None)
+    args = parser.parse_args()
+    if args.action != 'fetch':
+        parser.print_usage()
+        return 2
+
+    try:
+        path = ArtifactCache(args.cache, args.connections).fetch(args.source, args.sha256, log=lambda message: print(message, file=sys.stderr))
+    except (ArtifactError, IOError, OSError) as ex:
+        print(str(ex), file=sys.stderr)
+        return 1
+    if args.link:
+        if os.path.exists(args.link):
+            os.remove(args.link)
+        link_or_copy(path, args.link)
+        path = args.link
+    print(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,275 @@
+''' Generates the topologyVersion of a configuration file from the hardware of the nodes.
+
+The spec names the nodes with their cores and memory, and the workload profile of the cluster.
+The instance counts of vizqlserver, cacheserver, dataserver and backgrounder are sized to the
+cores and memory of each node, the singleton services are placed on node1, and the coordination
+service ensemble is sized to the cluster:
+
+    {
+        "profile": "interactive",
+        "nodes": {
+            "node1": {"cores": 16, "ramGB": 64},
+            "node2": {"cores": 16, "ramGB": 64},
+            "node3": {"cores": 32, "ramGB": 128, "profile": "extract"}
+        }
+    }
+
+    python topology_generator.py --spec cluster.json --baseConfig config.json --output myconfig.json
+    python topology_generator.py --nodes node1=16:64,node2=16:64 --profile extract --output myconfig.json
+
+The output is a configuration file for --configFile of install, installWorkers and updateTopology.
+The configEntities and configKeys are copied from --baseConfig. '''
+
+from __future__ import print_function
+import argparse
+import json
+import re
+import sys
+from collections import OrderedDict
+
+from SilentInstaller import ENSEMBLE_SIZES, OptionsError, check_topology_rules, read_json_object
+
+# Cores per instance of each sized service, by workload profile. The first service of a profile
+# gets at least one instance on every node of that profile.
+PROFILES = {
+    'interactive': OrderedDict([('vizqlserver', 4), ('cacheserver', 4), ('dataserver', 8), ('backgrounder', 8)]),
+    'balanced': OrderedDict([('vizqlserver', 4), ('backgrounder', 4), ('cacheserver', 8), ('dataserver', 8)]),
+    'extract': OrderedDict([('backgrounder', 2), ('vizqlserver', 8), ('dataserver', 8), ('cacheserver', 8)])
+}
+
+# Memory used by one instance of each sized service
+INSTANCE_MEMORY_GB = {'vizqlserver': 4, 'backgrounder': 4, 'dataserver': 2, 'cacheserver': 1, 'appzookeeper': 1}
+
+# Cores and memory kept free on every node for the agents and the cluster controller, and in
+# addition on node1 for the singleton services
+RESERVED = {'cores': 1, 'ramGB': 4}
+INITIAL_NODE_RESERVED = {'cores': 2, 'ramGB': 8}
+
+# The recommended hardware of a production node. The minimum follows from the reservations, see
+# minimum_node.
+RECOMMENDED_NODE = {'cores': 8, 'ramGB': 32}
+
+# Services of every node, of node1 only, and of the nodes of the coordination service ensemble
+NODE_SERVICES = ['tabadminagent', 'tabsvc', 'clustercontroller']
+INITIAL_NODE_SERVICES = ['tabadmincontroller', 'licenseservice', 'pgsql', 'searchserver', 'elasticserver', 'activemqserver', 'gateway', 'vizportal', 'dataengine', 'filestore']
+ENSEMBLE_SERVICES = ['appzookeeper', 'clientfileservice']
+
+# Services a worker runs next to the sized services: serving views needs the gateway and the
+# application server, and extracts are read through the data engine and file store
+SERVING_SERVICES = ['gateway', 'vizportal']
+EXTRACT_SERVICES = ['dataengine', 'filestore']
+
+
+class NodeSpec(object):
+    ''' The hardware and workload profile of one node '''
+
+    def __init__(self, node_id, cores, ram_gb, profile):
+        self.node_id = node_id
+        self.cores = cores
+        self.ram_gb = ram_gb
+        self.profile = profile
+
+    @property
+    def number(self):
+        return int(self.node_id[len('node'):])
+
+
+def reserved(node_id):
+    ''' The cores and memory kept free on the node '''
+
+    initial = node_id == 'node1'
+    return dict((resource, RESERVED[resource] + (INITIAL_NODE_RESERVED[resource] if initial else 0)) for resource in RESERVED)
+
+def minimum_node(node_id, profile):
+    ''' The least hardware that leaves a core and the memory of one instance of the first service
+    of the profile next to the reservation of the node '''
+
+    minimum = reserved(node_id)
+    return {'cores': minimum['cores'] + 1, 'ramGB': minimum['ramGB'] + INSTANCE_MEMORY_GB[list(PROFILES[profile])[0]]}
+
+def parse_spec(spec):
+    ''' Validates the spec document. Returns the node specs, ordered by node number, and the
+    requested ensemble size or None. '''
+
+    profile = spec.get('profile', 'balanced')
+    if profile not in PROFILES:
+        raise OptionsError('Unknown profile "%s"; use one of %s' % (profile, ', '.join(sorted(PROFILES))))
+    nodes = spec.get('nodes')
+    if not isinstance(nodes, dict) or not nodes:
+        raise OptionsError('The spec has no nodes')
+    specs = []
+    for node_id, node in nodes.items():
+        if not re.match(r'^node[0-9]+$', node_id):
+            raise OptionsError('"%s" is not a node id; node ids look like node1, node2, ...' % node_id)
+        try:
+            cores = int(node['cores'])
+            ram_gb = float(node['ramGB'])
+        except (KeyError, TypeError, ValueError):
+            raise OptionsError('%s needs a number of cores and ramGB' % node_id)
+        node_profile = node.get('profile', profile)
+        if node_profile not in PROFILES:
+            raise OptionsError('Unknown profile "%s" of %s; use one of %s' % (node_profile, node_id, ', '.join(sorted(PROFILES))))
+        minimum = minimum_node(node_id, node_profile)
+        if cores < minimum['cores'] or ram_gb < minimum['ramGB']:
+            raise OptionsError('%s has %d cores and %gGB of memory; %s needs at least %d cores and %dGB' % (
+                node_id, cores, ram_gb, 'the initial node' if node_id == 'node1' else 'a node', minimum['cores'], minimum['ramGB']))
+        specs.append(NodeSpec(node_id, cores, ram_gb, node_profile))
+    specs.sort(key=lambda spec: spec.number)
+    if specs[0].node_id != 'node1':
+        raise OptionsError('The spec has no node1, the initial node')
+
+    ensemble_size = spec.get('coordinationEnsembleSize')
+    if ensemble_size is not None:
+        ensemble_size = int(ensemble_size)
+        if ensemble_size not in ENSEMBLE_SIZES or ensemble_size > len(specs):
+            raise OptionsError('coordinationEnsembleSize %d is not possible with %d nodes; use 1, 3 or 5 nodes, at most one per node' % (ensemble_size, len(specs)))
+    return specs, ensemble_size
+
+def parse_nodes_argument(value):
+    ''' Parses node1=16:64,node2=8:32[:profile] into the nodes of a spec '''
+
+    nodes = OrderedDict()
+    for item in value.split(','):
+        match = re.match(r'^\s*(\w+)=(\d+):(\d+(?:\.\d+)?)(?::(\w+))?\s*$', item)
+        if not match:
+            raise OptionsError('"%s" is not NODEID=CORES:RAMGB[:PROFILE]' % item)
+        nodes[match.group(1)] = {'cores': int(match.group(2)), 'ramGB': float(match.group(3))}
+        if match.group(4):
+            nodes[match.group(1)]['profile'] = match.group(4)
+    return nodes
+
+def recommended_ensemble_size(node_count):
+    ''' One coordination service for up to 2 nodes, 3 up to 6 nodes, and 5 for larger clusters '''
+
+    if node_count < 3:
+        return 1
+    return 3 if node_count < 7 else 5
+
+def size_node(spec, warnings):
+    ''' Instance counts of the sized services on one node. Counts follow the cores of the node,
+    and are then lowered, least important service first, until they fit in its memory. '''
+
+    reserved_cores = reserved(spec.node_id)['cores']
+    reserved_ram = reserved(spec.node_id)['ramGB']
+    usable_cores = max(spec.cores - reserved_cores, 1)
+    profile = PROFILES[spec.profile]
+    counts = OrderedDict((service, usable_cores // cores) for service, cores in profile.items())
+    primary = list(profile)[0]
+    counts[primary] = max(counts[primary], 1)
+
+    available = spec.ram_gb - reserved_ram
+    for service in reversed(list(profile)):
+        minimum = 1 if service == primary else 0
+        while counts[service] > minimum and memory_gb(counts) > available:
+            counts[service] -= 1
+    if memory_gb(counts) > available:
+        raise OptionsError('%s has too little memory for one %s: %gGB needed, %gGB available after %gGB reserved' % (
+            spec.node_id, primary, memory_gb(counts), max(available, 0), reserved_ram))
+    if spec.cores < RECOMMENDED_NODE['cores'] or spec.ram_gb < RECOMMENDED_NODE['ramGB']:
+        warnings.append('%s has less than the %d cores and %dGB recommended for a production node' % (spec.node_id, RECOMMENDED_NODE['cores'], RECOMMENDED_NODE['ramGB']))
+    return counts
+
+def memory_gb(counts):
+    return sum(INSTANCE_MEMORY_GB.get(service, 0) * count for service, count in counts.items())
+
+def instances(count):
+    return {'instances': [{'instanceId': str(index)} for index in range(count)]}
+
+def generate(spec):
+    ''' Returns the topologyVersion nodes for the spec, a row of sizing details per node and
+    the warnings. Raises OptionsError if the spec can't form a valid cluster. '''
+
+    specs, ensemble_size = parse_spec(spec)
+    warnings = []
+    sized = OrderedDict((node.node_id, size_node(node, warnings)) for node in specs)
+
+    # every sized service runs somewhere; a missing one goes to the node with the most memory left
+    for service in PROFILES['balanced']:
+        if not any(counts[service] for counts in sized.values()):
+            node = max(specs, key=lambda node: (node.ram_gb - memory_gb(sized[node.node_id]), -node.number))
+            sized[node.node_id][service] = 1
+            warnings.append('%s gets the only %s of the cluster' % (node.node_id, service))
+
+    recommended = recommended_ensemble_size(len(specs))
+    if ensemble_size is None:
+        ensemble_size = recommended
+    elif ensemble_size < recommended:
+        warnings.append('a coordination service ensemble of %d on %d nodes does not survive the loss of a member; %d is recommended' % (ensemble_size, len(specs), recommended))
+    # node1 is always a member; the others are the nodes with the most memory left
+    others = sorted(specs[1:], key=lambda node: (-(node.ram_gb - memory_gb(sized[node.node_id])), node.number))
+    ensemble = ['node1'] + sorted([node.node_id for node in others[:ensemble_size - 1]], key=lambda node_id: int(node_id[len('node'):]))
+
+    nodes = OrderedDict()
+    rows = []
+    for node in specs:
+        counts = sized[node.node_id]
+        services = list(NODE_SERVICES)
+        if node.node_id == 'node1':
+            services += INITIAL_NODE_SERVICES
+        if node.node_id in ensemble:
+            services += ENSEMBLE_SERVICES
+            counts['appzookeeper'] = 1
+        if counts['vizqlserver']:
+            services += SERVING_SERVICES
+        if counts['vizqlserver'] or counts['backgrounder']:
+            services += EXTRACT_SERVICES
+        node_services = OrderedDict()
+        for service in sorted(set(services) | set(service for service, count in counts.items() if count)):
+            node_services[service] = instances(counts.get(service) or 1)
+        nodes[node.node_id] = {'services': node_services}
+        rows.append((node, counts))
+
+    problems = check_topology_rules(nodes)
+    if problems:
+        raise OptionsError('The generated topology is not valid: ' + '; '.join(problems))
+    return nodes, rows, warnings
+
+def print_summary(rows, warnings, output=sys.stderr):
+    services = list(PROFILES['balanced']) + ['appzookeeper']
+    print('%-8s %5s %7s %-12s %s %9s' % ('node', 'cores', 'ram', 'profile', ' '.join('%12s' % service for service in services), 'sized ram'), file=output)
+    for node, counts in rows:
+        print('%-8s %5d %6gG %-12s %s %8gG' % (node.node_id, node.cores, node.ram_gb, node.profile,
+            ' '.join('%12d' % counts.get(service, 0) for service in services), memory_gb(counts)), file=output)
+    for warning in warnings:
+        print('Warning: ' + warning, file=output)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates the topologyVersion of a configuration file from the hardware of the nodes')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--spec', help='Json file with the profile and the cores and ramGB of each node')
+    source.add_argument('--nodes', help='Comma separated NODEID=CORES:RAMGB[:PROFILE], e.g. node1=16:64,node2=16:64')
+    parser.add_argument('--profile', choices=sorted(PROFILES), help='Workload profile of the nodes without their own. Overrides the profile of --spec')
+    parser.add_argument('--coordinationEnsembleSize', type=int, help='Number of nodes running the coordination service. Defaults to 1 for up to 2 nodes, 3 up to 6 nodes and 5 above')
+    parser.add_argument('--baseConfig', help='Configuration file whose configEntities and configKeys are copied to the output')
+    parser.add_argument('--output', help='Configuration file to write. Defaults to standard output')
+    args = parser.parse_args()
+
+    try:
+        spec = read_json_object(args.spec, 'spec file') if args.spec else {'nodes': parse_nodes_argument(args.nodes)}
+        if args.profile:
+            spec['profile'] = args.profile
+        if args.coordinationEnsembleSize is not None:
+            spec['coordinationEnsembleSize'] = args.coordinationEnsembleSize
+        nodes, rows, warnings = generate(spec)
+        base_config = read_json_object(args.baseConfig, 'base configuration file') if args.baseConfig else {}
+    except OptionsError as ex:
+        print('Error: ' + str(ex), file=sys.stderr)
+        return 3
+
+    config = OrderedDict()
+    for key, value in base_config.items():
+        if key != 'topologyVersion':
+            config[key] = value
+    config['topologyVersion'] = {'nodes': nodes}
+    print_summary(rows, warnings)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(config, output, indent=4)
+        print('Configuration written to ' + args.output, file=sys.stderr)
+    else:
+        print(json.dumps(config, indent=4))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
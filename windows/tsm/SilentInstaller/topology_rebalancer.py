@@ -0,0 +1,440 @@
+''' Redistributes the backgrounder, vizqlserver and cacheserver instances of a cluster by its load.
+
+The metrics give the cores, memory and CPU and memory use samples of every node, and queue or
+latency samples of the services, as fractions, jobs and milliseconds:
+
+    {
+        "nodes": {
+            "node1": {"cores": 16, "ramGB": 64, "cpu": [0.97, 0.95], "memory": [0.71, 0.74]},
+            "node2": {"cores": 16, "ramGB": 64, "cpu": [0.94, 0.98], "memory": [0.68, 0.70]},
+            "node3": {"cores": 16, "ramGB": 64, "cpu": [0.12, 0.15], "memory": [0.30, 0.31]}
+        },
+        "services": {
+            "backgrounder": {"queue": [42, 55]},
+            "vizqlserver": {"latencyMs": [850, 920]},
+            "cacheserver": {"latencyMs": [4, 6]}
+        }
+    }
+
+    python topology_rebalancer.py --metrics metrics.json --configFile myconfig.json --output rebalanced.json
+    python topology_rebalancer.py --collector http://node1:9100/metrics --samples 30 --interval 10 --apply --secretsFile secrets.json --output rebalanced.json
+
+The load measured on each node is split over its instances, and a service whose queue or latency
+is over its target gets more instances. Instances are then moved from the busiest to the least
+busy node, one at a time, while that lowers the load of the busiest node and the memory of the
+receiving node allows it. With --apply, the current topology is read from the cluster and the
+result is applied like updateTopology does. '''
+
+from __future__ import print_function
+import argparse
+import copy
+import json
+import math
+import sys
+import time
+from collections import OrderedDict
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+import SilentInstaller
+from SilentInstaller import ExitCodeError, OptionsError, check_topology_rules, percentile, read_json_object
+from topology_generator import EXTRACT_SERVICES, INSTANCE_MEMORY_GB, PROFILES, RESERVED, SERVING_SERVICES, instances, reserved
+
+# The services whose instances are moved, and the metric and default target of each. A queue is
+# the number of jobs waiting per instance, a latency is the p90 in milliseconds.
+REBALANCED_SERVICES = OrderedDict([
+    ('backgrounder', ('queue', 2)),
+    ('vizqlserver', ('latencyMs', 1000)),
+    ('cacheserver', ('latencyMs', 50))
+])
+
+# How the measured load of a node is split over its instances: in proportion to the cores the
+# generator sizes per instance of each service
+CORES_PER_INSTANCE = dict((service, min(profile[service] for profile in PROFILES.values())) for service in REBALANCED_SERVICES)
+
+# The percentile of the samples used as the load of a node or service
+LOAD_PERCENTILE = 0.9
+
+# A service never grows by more than this factor in one rebalance, so that the next measurement
+# shows the effect before more instances are added
+MAX_GROWTH = 2
+
+# Moves are stopped after this many, and each move has to lower the load of the busiest node by
+# at least this fraction of its cores
+MAX_MOVES = 100
+MIN_MOVE_GAIN = 0.02
+
+
+class NodeLoad(object):
+    ''' The capacity and measured load of one node, and its instances while they are moved '''
+
+    def __init__(self, node_id, cores, ram_gb, cpu, memory, counts):
+        self.node_id = node_id
+        self.cores = cores
+        self.ram_gb = ram_gb
+        self.cpu = cpu
+        self.free_gb = ram_gb * (1 - memory)
+        self.counts = counts
+        self.planned = OrderedDict(counts)
+        # the agents, the controller and the singleton services of node1 are not moved
+        used = cpu * cores
+        self.base = min(used, reserved(node_id)['cores']) if self.weight() else used
+
+    def movable_load(self):
+        ''' The cores used beyond the base load '''
+        return self.cpu * self.cores - self.base
+
+    def weight(self):
+        return sum(count * CORES_PER_INSTANCE[service] for service, count in self.counts.items())
+
+    def attributed(self, service):
+        ''' The cores used by the instances of the service on this node, by the share of its weight '''
+        if not self.weight():
+            return 0.0
+        return self.movable_load() * self.counts[service] * CORES_PER_INSTANCE[service] / self.weight()
+
+    def load(self, instance_load, counts=None):
+        ''' The projected fraction of the cores used with the planned instances, or the given counts '''
+        return (self.base + sum(count * instance_load[service] for service, count in (counts or self.planned).items())) / self.cores
+
+    def planned_free_gb(self):
+        return self.free_gb - sum((self.planned[service] - self.counts[service]) * INSTANCE_MEMORY_GB[service] for service in self.planned)
+
+    def fits(self, service):
+        ''' One more instance of the service leaves the memory kept free on every node '''
+        return self.planned_free_gb() - INSTANCE_MEMORY_GB[service] >= RESERVED['ramGB']
+
+
+def samples(document, name, where):
+    ''' The samples of a metric, as a list of numbers '''
+
+    values = document.get(name)
+    if values is None:
+        raise OptionsError('The metrics have no %s samples of %s' % (name, where))
+    if not isinstance(values, list):
+        values = [values]
+    try:
+        values = sorted(float(value) for value in values)
+    except (TypeError, ValueError):
+        raise OptionsError('%s of %s must be numbers' % (name, where))
+    if not values:
+        raise OptionsError('The metrics have no %s samples of %s' % (name, where))
+    return values
+
+def parse_targets(value):
+    ''' Parses service=target,... into the target of each rebalanced service '''
+
+    targets = dict((service, target) for service, (metric, target) in REBALANCED_SERVICES.items())
+    for item in [item.strip() for item in (value or '').split(',') if item.strip()]:
+        service, _, target = item.partition('=')
+        if service.strip() not in REBALANCED_SERVICES:
+            raise OptionsError('Unknown service "%s" in the targets, expected one of %s' % (service.strip(), ', '.join(REBALANCED_SERVICES)))
+        try:
+            targets[service.strip()] = float(target)
+        except ValueError:
+            raise OptionsError('Target of %s "%s" is not a number' % (service.strip(), target.strip()))
+    return targets
+
+def load_nodes(metrics, topology):
+    ''' The load of every node of the topology. Raises OptionsError if a node has no metrics. '''
+
+    node_metrics = metrics.get('nodes') or {}
+    nodes = []
+    for node_id in sorted(topology, key=lambda node_id: int(node_id[len('node'):])):
+        if node_id not in node_metrics:
+            raise OptionsError('The metrics have no samples of %s' % node_id)
+        node = node_metrics[node_id]
+        try:
+            cores = int(node['cores'])
+            ram_gb = float(node['ramGB'])
+        except (KeyError, TypeError, ValueError):
+            raise OptionsError('%s needs a number of cores and ramGB in the metrics' % node_id)
+        cpu = percentile(samples(node, 'cpu', node_id), LOAD_PERCENTILE)
+        memory = percentile(samples(node, 'memory', node_id), LOAD_PERCENTILE)
+        if not (0 <= cpu <= 1 and 0 <= memory <= 1):
+            raise OptionsError('cpu and memory of %s must be fractions between 0 and 1' % node_id)
+        services = topology[node_id].get('services', {})
+        counts = OrderedDict((service, len(services.get(service, {}).get('instances', []))) for service in REBALANCED_SERVICES)
+        nodes.append(NodeLoad(node_id, cores, ram_gb, cpu, memory, counts))
+    return nodes
+
+def solve(matrix, vector):
+    ''' Solves a small linear system by Gaussian elimination. Returns None if it is singular. '''
+
+    size = len(vector)
+    rows = [list(matrix[row]) + [vector[row]] for row in range(size)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda row: abs(rows[row][column]))
+        if abs(rows[pivot][column]) < 1e-9:
+            return None
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+        for row in range(size):
+            if row != column:
+                factor = rows[row][column] / rows[column][column]
+                rows[row] = [value - factor * pivot_value for value, pivot_value in zip(rows[row], rows[column])]
+    return [rows[row][size] / rows[row][row] for row in range(size)]
+
+def fit_instance_load(nodes, services, prior):
+    ''' The cores used per instance of each service that best explain the load of all nodes, by
+    non-negative least squares over the subsets of the services. The fit is pulled slightly
+    towards the prior, which decides between services that run in the same mix on every node. '''
+
+    loaded = [node for node in nodes if node.weight()]
+    if not loaded or not services:
+        return dict(prior)
+    normal = dict(((first, second), sum(node.counts[first] * node.counts[second] for node in loaded)) for first in services for second in services)
+    ridge = 0.01 * max(1.0, sum(normal[(service, service)] for service in services) / len(services))
+    best = None
+    for mask in range(1, 2 ** len(services)):
+        subset = [service for index, service in enumerate(services) if mask & (1 << index)]
+        values = solve([[normal[(first, second)] + (ridge if first == second else 0) for second in subset] for first in subset],
+            [sum(node.counts[service] * node.movable_load() for node in loaded) + ridge * prior[service] for service in subset])
+        if values is None or min(values) < 0:
+            continue
+        fitted = dict((service, 0.0) for service in services)
+        fitted.update(zip(subset, values))
+        cost = sum((node.movable_load() - sum(node.counts[service] * fitted[service] for service in services)) ** 2 for node in loaded)
+        cost += ridge * sum((fitted[service] - prior[service]) ** 2 for service in services)
+        if best is None or cost < best[0]:
+            best = (cost, fitted)
+    return best[1] if best else dict(prior)
+
+def needed_instances(service, current, metrics, target):
+    ''' The instances the service needs to meet its target. Never fewer than it has. '''
+
+    metric = REBALANCED_SERVICES[service][0]
+    service_metrics = (metrics.get('services') or {}).get(service)
+    if not current or not service_metrics or metric not in service_metrics:
+        return current
+    measured = percentile(samples(service_metrics, metric, service), LOAD_PERCENTILE)
+    if metric == 'queue':
+        needed = int(math.ceil(measured / target)) if target else current
+    else:
+        # latency falls about in proportion to the instances the requests are spread over
+        needed = int(math.ceil(current * measured / target)) if target else current
+    return min(max(needed, current), current * MAX_GROWTH)
+
+def plan(nodes, metrics, targets, max_utilization):
+    ''' Adds the instances the services need and moves instances from the busiest to the least
+    busy nodes. Returns the projected load per instance of each service, the added instances,
+    the services that could not grow as needed, and the moves. '''
+
+    # split the load of each node in proportion to the size of its instances, then fit
+    prior = {}
+    for service in REBALANCED_SERVICES:
+        current = sum(node.counts[service] for node in nodes)
+        prior[service] = sum(node.attributed(service) for node in nodes) / current if current else float(CORES_PER_INSTANCE[service])
+    instance_load = dict(prior)
+    instance_load.update(fit_instance_load(nodes, [service for service in REBALANCED_SERVICES if any(node.counts[service] for node in nodes)], prior))
+    added = []
+    short = []
+    for service in REBALANCED_SERVICES:
+        current = sum(node.counts[service] for node in nodes)
+        needed = needed_instances(service, current, metrics, targets[service])
+        if needed > current and REBALANCED_SERVICES[service][0] == 'latencyMs':
+            # the same requests are spread over more instances
+            instance_load[service] = instance_load[service] * current / needed
+        for _ in range(needed - current):
+            candidates = [node for node in nodes if node.fits(service)
+                and node.load(instance_load) + instance_load[service] / node.cores <= max_utilization]
+            if not candidates:
+                short.append((service, needed, current + len([item for item in added if item[1] == service])))
+                break
+            node = min(candidates, key=lambda node: (node.load(instance_load), -node.planned_free_gb()))
+            node.planned[service] += 1
+            added.append((node.node_id, service))
+
+    moves = []
+    for _ in range(MAX_MOVES):
+        busiest = max(nodes, key=lambda node: node.load(instance_load))
+        move = None
+        for node in sorted(nodes, key=lambda node: node.load(instance_load)):
+            if node is busiest:
+                break
+            for service in sorted(REBALANCED_SERVICES, key=lambda service: -instance_load[service]):
+                if not busiest.planned[service] or not node.fits(service):
+                    continue
+                busiest_after = busiest.load(instance_load) - instance_load[service] / busiest.cores
+                node_after = node.load(instance_load) + instance_load[service] / node.cores
+                if max(busiest_after, node_after) <= busiest.load(instance_load) - MIN_MOVE_GAIN:
+                    move = (node, service)
+                    break
+            if move:
+                break
+        if not move:
+            break
+        busiest.planned[move[1]] -= 1
+        move[0].planned[move[1]] += 1
+        moves.append((move[1], busiest.node_id, move[0].node_id))
+    return instance_load, added, short, moves
+
+def rebalanced_topology(topology, nodes):
+    ''' The topology with the planned instance counts. A node that gets its first vizqlserver or
+    backgrounder also gets the services the generator puts next to them. '''
+
+    result = copy.deepcopy(topology)
+    for node in nodes:
+        services = result[node.node_id].setdefault('services', {})
+        for service, count in node.planned.items():
+            if count:
+                services[service] = instances(count)
+            else:
+                services.pop(service, None)
+        companions = []
+        if node.planned['vizqlserver'] and not node.counts['vizqlserver']:
+            companions += SERVING_SERVICES
+        if (node.planned['vizqlserver'] or node.planned['backgrounder']) and not (node.counts['vizqlserver'] or node.counts['backgrounder']):
+            companions += EXTRACT_SERVICES
+        for service in companions:
+            services.setdefault(service, instances(1))
+    return result
+
+def rebalance(metrics, topology, targets, max_utilization=0.85, min_improvement=0.1):
+    ''' Returns the rebalanced topology, or None if it stays as it is, and a summary of the node
+    loads and changes. Raises OptionsError if the metrics don't cover the topology. '''
+
+    nodes = load_nodes(metrics, topology)
+    instance_load, added, short, moves = plan(nodes, metrics, targets, max_utilization)
+    # the current instances are projected with the same load per instance as the plan
+    before = dict((node.node_id, node.load(instance_load, node.counts)) for node in nodes)
+    after = dict((node.node_id, node.load(instance_load)) for node in nodes)
+
+    summary = {'nodes': nodes, 'instanceLoad': instance_load, 'before': before, 'after': after, 'added': added, 'short': short, 'moves': moves, 'warnings': []}
+    improvement = max(before.values()) - max(after.values())
+    if not added and (not moves or improvement < min_improvement):
+        if moves:
+            summary['warnings'].append('moving instances would lower the busiest node by only %.0f%% of its cores' % (improvement * 100))
+        for node in nodes:
+            node.planned = OrderedDict(node.counts)
+        summary['after'] = before
+        summary['moves'] = []
+        return None, summary
+    result = rebalanced_topology(topology, nodes)
+    problems = check_topology_rules(result)
+    if problems:
+        raise OptionsError('The rebalanced topology is not valid: ' + '; '.join(problems))
+    for node in nodes:
+        if after[node.node_id] > max_utilization:
+            summary['warnings'].append('%s stays at %.0f%% of its cores; the cluster needs more nodes' % (node.node_id, after[node.node_id] * 100))
+    return result, summary
+
+def collect(url, sample_count, interval):
+    ''' Reads the metrics endpoint sample_count times, interval seconds apart, and returns the
+    samples of every node and service as one metrics document '''
+
+    metrics = {'nodes': {}, 'services': {}}
+    for index in range(sample_count):
+        if index:
+            time.sleep(interval)
+        try:
+            snapshot = json.loads(urlopen(url, timeout=30).read().decode('utf-8'))
+        except (IOError, ValueError) as ex:
+            raise OptionsError('Could not read the metrics from %s: %s' % (url, ex))
+        for section in ['nodes', 'services']:
+            for name, values in (snapshot.get(section) or {}).items():
+                collected = metrics[section].setdefault(name, {})
+                for key, value in values.items():
+                    if key in ('cores', 'ramGB'):
+                        collected[key] = value
+                    else:
+                        collected.setdefault(key, []).append(value)
+    return metrics
+
+def count_items(items):
+    counts = OrderedDict()
+    for item in items:
+        counts[item] = counts.get(item, 0) + 1
+    return counts
+
+def print_summary(summary, output=sys.stderr):
+    print('Cores used per instance: ' + ', '.join('%s %.2f' % (service, summary['instanceLoad'][service]) for service in REBALANCED_SERVICES), file=output)
+    print('%-8s %5s %7s %6s %8s %8s  %s' % ('node', 'cores', 'ram', 'cpu', 'load', 'planned', '  '.join('%14s' % service for service in REBALANCED_SERVICES)), file=output)
+    for node in summary['nodes']:
+        counts = '  '.join('%14s' % ('%d -> %d' % (node.counts[service], node.planned[service]) if node.counts[service] != node.planned[service] else str(node.counts[service]))
+            for service in REBALANCED_SERVICES)
+        print('%-8s %5d %6gG %5.0f%% %7.0f%% %7.0f%%  %s' % (node.node_id, node.cores, node.ram_gb, node.cpu * 100, summary['before'][node.node_id] * 100, summary['after'][node.node_id] * 100, counts), file=output)
+    for (node_id, service), count in count_items(summary['added']).items():
+        print('Adding %d instances of %s on %s' % (count, service, node_id), file=output)
+    for (service, source, destination), count in count_items(summary['moves']).items():
+        print('Moving %d instances of %s from %s to %s' % (count, service, source, destination), file=output)
+    for service, needed, placed in summary['short']:
+        print('Warning: %s needs %d instances, only %d fit on the nodes' % (service, needed, placed), file=output)
+    for warning in summary['warnings']:
+        print('Warning: ' + warning, file=output)
+
+def write_config(config, path):
+    if path:
+        with open(path, 'w') as output:
+            json.dump(config, output, indent=4)
+        print('Configuration written to ' + path, file=sys.stderr)
+    else:
+        print(json.dumps(config, indent=4))
+
+def main():
+    parser = argparse.ArgumentParser(description='Redistributes the backgrounder, vizqlserver and cacheserver instances of a cluster by its load')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--metrics', help='Json file with the cores, ramGB, cpu and memory samples of each node and the queue or latency samples of the services')
+    source.add_argument('--collector', help='URL of a metrics endpoint that returns one sample of every node and service per request')
+    parser.add_argument('--samples', type=int, default=10, help='Number of samples read from --collector')
+    parser.add_argument('--interval', type=float, default=6, help='Seconds between the samples read from --collector')
+    parser.add_argument('--configFile', help='Configuration file with the current topology. Its configEntities and configKeys are copied to the output. With --apply, the topology is read from the cluster instead')
+    parser.add_argument('--targets', help='Comma separated service=target: jobs waiting per backgrounder, p90 latency in milliseconds of vizqlserver and cacheserver. Defaults to backgrounder=2,vizqlserver=1000,cacheserver=50')
+    parser.add_argument('--maxUtilization', type=float, default=0.85, help='Share of the cores of a node that added instances may bring it to')
+    parser.add_argument('--minImprovement', type=float, default=0.1, help='Share of the cores by which moves have to lower the load of the busiest node, or the topology stays as it is')
+    parser.add_argument('--output', help='Configuration file to write. Defaults to standard output')
+    parser.add_argument('--apply', action='store_true', help='Apply the rebalanced topology to the cluster, like updateTopology')
+    parser.add_argument('--secretsFile', help='User credentials json file, for --apply')
+    parser.add_argument('--installDir', default=SilentInstaller.Options.defaults['installDir'], help='Installation directory, for --apply')
+    parser.add_argument('--controllerPort', default=SilentInstaller.Options.defaults['controllerPort'], help='TSM controller port, for --apply')
+    parser.add_argument('--transport', choices=['cli', 'rest'], default=SilentInstaller.Options.defaults['transport'], help='Apply through the tsm command line, or the TSM controller REST API')
+    args = parser.parse_args()
+    if args.apply and not (args.secretsFile and args.output):
+        parser.error('--apply needs --secretsFile and --output')
+    if not args.apply and not args.configFile:
+        parser.error('--configFile is needed without --apply')
+
+    try:
+        targets = parse_targets(args.targets)
+        metrics = read_json_object(args.metrics, 'metrics file') if args.metrics else collect(args.collector, args.samples, args.interval)
+        config = OrderedDict()
+        if args.configFile:
+            for key, value in read_json_object(args.configFile, 'config file').items():
+                config[key] = value
+        if not args.apply:
+            result, summary = rebalance(metrics, config.get('topologyVersion', {}).get('nodes', {}), targets, args.maxUtilization, args.minImprovement)
+            print_summary(summary)
+            if result is None:
+                print('Topology is balanced, nothing to change.', file=sys.stderr)
+                return 0
+            config['topologyVersion'] = {'nodes': result}
+            write_config(config, args.output)
+            return 0
+
+        options = SilentInstaller.Options({'type': 'updateTopology', 'secretsFile': args.secretsFile, 'configFile': args.output,
+            'installDir': args.installDir, 'controllerPort': args.controllerPort, 'transport': args.transport})
+        secrets = SilentInstaller.get_secrets(options)
+        with SilentInstaller.make_tsm_session(SilentInstaller.get_tsm_path(options), secrets, options) as tsm:
+            result, summary = rebalance(metrics, SilentInstaller.get_current_topology(tsm), targets, args.maxUtilization, args.minImprovement)
+            print_summary(summary)
+            if result is None:
+                print('Topology is balanced, nothing to change.', file=sys.stderr)
+                return 0
+            config['topologyVersion'] = {'nodes': result}
+            write_config(config, args.output)
+            if not SilentInstaller.get_nodes_and_apply_topology(args.output, tsm, apply_and_restart=True):
+                return 1
+        return 0
+    except OptionsError as ex:
+        print('Error: ' + str(ex), file=sys.stderr)
+        return 3
+    except ExitCodeError:
+        return 4
+    finally:
+        SilentInstaller.ServerConfiguration.cleanup()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+''' A pure Python client for the TSM controller REST API.
+
+SilentInstaller can use this client instead of starting a tsm.cmd process for every
+setup step. All requests go over a small pool of keep-alive HTTPS connections to the
+controller, and long running operations (pending-changes apply, initialize, start) are
+tracked by polling their asynchronous job until it finishes. '''
+
+from __future__ import print_function
+import json
+import ssl
+import time
+import threading
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+API_VERSION = '0.5'
+
+# Paths of the controller endpoints used by the installer, relative to /api/<API_VERSION>
+ENDPOINTS = {
+    'login': '/login',
+    'logout': '/logout',
+    'nodes': '/nodes',
+    'bootstrap_file': '/nodes/bootstrapFile',
+    'remove_nodes': '/nodes/remove',
+    'activate_trial': '/licensing/productKeys/activateTrial',
+    'activate_key': '/licensing/productKeys/activate',
+    'licenses': '/licensing/productKeys',
+    'registration': '/licensing/registration',
+    'settings_import': '/pendingChanges/settingsImport',
+    'apply': '/pendingChanges/apply',
+    'initialize': '/initialize',
+    'start': '/enable',
+    'stop': '/disable',
+    'status': '/status',
+    'async_job': '/asyncJobs/{}',
+}
+
+# Terminal states of an asynchronous job
+JOB_SUCCEEDED = 'Succeeded'
+JOB_FAILED_STATES = ('Failed', 'Cancelled')
+
+
+class TsmRestError(Exception):
+    ''' A controller request failed, or an asynchronous job did not succeed '''
+
+    def __init__(self, message, status=None):
+        super(TsmRestError, self).__init__(message)
+        self.status = status
+
+
+class ConnectionPool(object):
+    ''' A bounded pool of keep-alive connections to one controller '''
+
+    def __init__(self, host, port, scheme='https', verify_ssl=False, timeout=60, max_connections=4):
+        self.host = host
+        self.port = int(port)
+        self.scheme = scheme
+        self.timeout = timeout
+        self.ssl_context = None
+        if scheme == 'https':
+            # TSM uses a self-signed certificate unless one has been configured
+            self.ssl_context = ssl.create_default_context() if verify_ssl else ssl._create_unverified_context()
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+
+    def new_connection(self):
+        if self.scheme == 'https':
+            return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.ssl_context)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def acquire(self):
+        ''' Returns a connection, and whether it was reused from the idle list '''
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.new_connection(), False
+
+    def release(self, connection, reusable=True):
+        if reusable:
+            with self.lock:
+                self.idle.append(connection)
+        else:
+            connection.close()
+        self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle = []
+
+
+class TsmRestClient(object):
+    ''' Talks to the TSM controller REST API on the controller port '''
+
+    def __init__(self, host, port, username, password, scheme='https', verify_ssl=False,
+                 timeout=60, max_connections=4, poll_interval=1.0, max_poll_interval=15.0):
+        self.username = username
+        self.password = password
+        self.base_path = '/api/' + API_VERSION
+        self.pool = ConnectionPool(host, port, scheme, verify_ssl, timeout, max_connections)
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.cookie = None
+
+    def __enter__(self):
+        self.login()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.logout()
+        return False
+
+    def request(self, method, endpoint, body=None, query=''):
+        ''' Sends one request and returns the decoded json response, if any '''
+        path = self.base_path + endpoint + query
+        headers = {'Accept': 'application/json', 'Connection': 'keep-alive'}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+
+        while True:
+            connection, reused = self.pool.acquire()
+            try:
+                connection.request(method, path, body=payload, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, OSError) as ex:
+                self.pool.release(connection, reusable=False)
+                # an idle connection may have been closed by the controller, so retry on a fresh one
+                if reused:
+                    continue
+                raise TsmRestError('%s %s failed: %s' % (method, path, str(ex)))
+            self.pool.release(connection, reusable=not response.will_close)
+            break
+
+        set_cookie = response.getheader('Set-Cookie')
+        if set_cookie:
+            self.cookie = set_cookie.split(';')[0]
+        if response.status >= 400:
+            raise TsmRestError('%s %s returned HTTP %d: %s' % (method, path, response.status, data.decode('utf-8', 'replace')), response.status)
+        if not data:
+            return None
+        return json.loads(data.decode('utf-8'))
+
+    def login(self):
+        self.request('POST', ENDPOINTS['login'], {'authentication': {'name': self.username, 'password': self.password}})
+
+    def logout(self):
+        if self.cookie is None:
+            return
+        try:
+            self.request('POST', ENDPOINTS['logout'])
+        except TsmRestError:
+            pass
+        self.cookie = None
+        self.pool.close()
+
+    def wait_for_job(self, response, timeout=None):
+        ''' Polls the asynchronous job returned by a request until it finishes. The
+        polling interval grows from poll_interval up to max_poll_interval. '''
+        job = (response or {}).get('asyncJob')
+        if job is None:
+            return response
+        deadline = time.time() + timeout if timeout else None
+        interval = self.poll_interval
+        while job.get('status') != JOB_SUCCEEDED:
+            if job.get('status') in JOB_FAILED_STATES:
+                raise TsmRestError('Job %s %s: %s' % (job.get('id'), job.get('status').lower(), job.get('statusMessage', '')))
+            if deadline and time.time() + interval > deadline:
+                raise TsmRestError('Job %s did not finish within %d seconds' % (job.get('id'), timeout))
+            time.sleep(interval)
+            interval = min(interval * 2, self.max_poll_interval)
+            job_id = job.get('id')
+            job = (self.request('GET', ENDPOINTS['async_job'].format(job_id)) or {}).get('asyncJob')
+            if job is None:
+                raise TsmRestError('Polling job %s returned no job status' % job_id)
+        return job
+
+    def activate_trial(self):
+        return self.request('POST', ENDPOINTS['activate_trial'])
+
+    def activate_license(self, product_key):
+        return self.request('POST', ENDPOINTS['activate_key'], {'productKey': product_key})
+
+    def list_licenses(self):
+        return (self.request('GET', ENDPOINTS['licenses']) or {}).get('productKeys', [])
+
+    def register(self, registration):
+        return self.request('POST', ENDPOINTS['registration'], registration)
+
+    def import_settings(self, settings):
+        return self.request('POST', ENDPOINTS['settings_import'], settings)
+
+    def apply_pending_changes(self, timeout=None):
+        return self.wait_for_job(self.request('POST', ENDPOINTS['apply'], query='?ignoreWarnings=true'), timeout)
+
+    def initialize(self, timeout=None):
+        return self.wait_for_job(self.request('POST', ENDPOINTS['initialize']), timeout)
+
+    def start(self, timeout=None):
+        return self.wait_for_job(self.request('POST', ENDPOINTS['start']), timeout)
+
+    def stop(self, timeout=None):
+        return self.wait_for_job(self.request('POST', ENDPOINTS['stop']), timeout)
+
+    def list_nodes(self):
+        return [node['nodeId'] for node in (self.request('GET', ENDPOINTS['nodes']) or {}).get('clusterNodes', [])]
+
+    def remove_nodes(self, node_ids, timeout=None):
+        return self.wait_for_job(self.request('POST', ENDPOINTS['remove_nodes'], {'nodeIds': list(node_ids)}), timeout)
+
+    def get_bootstrap_file(self):
+        return self.request('GET', ENDPOINTS['bootstrap_file'])
+
+    def status(self):
+        return self.request('GET', ENDPOINTS['status'])
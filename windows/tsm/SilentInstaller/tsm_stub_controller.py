@@ -0,0 +1,249 @@
+''' A local stand-in for the TSM controller REST API.
+
+Implements the endpoints used by tsm_rest.TsmRestClient with in-memory state, so the
+REST transport of SilentInstaller can be exercised without a Tableau Server:
+
+    python tsm_stub_controller.py --port 8850 --nodes node1,node2
+
+Asynchronous jobs (pending-changes apply, initialize, start, ...) report Running until
+--jobDuration seconds have passed, and then Succeeded. '''
+
+from __future__ import print_function
+import argparse
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from tsm_rest import API_VERSION, ENDPOINTS
+
+AUTH_COOKIE = 'AUTH_COOKIE'
+
+
+class StubControllerState(object):
+    ''' The in-memory state of the stub controller '''
+
+    def __init__(self, username, password, nodes, job_duration=0.0):
+        self.username = username
+        self.password = password
+        self.nodes = list(nodes)
+        self.job_duration = job_duration
+        self.sessions = set()
+        self.product_keys = []
+        self.registration = None
+        self.settings = {}
+        self.topology = None
+        self.initialized = False
+        self.running = False
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def new_job(self, name, on_success=None):
+        with self.lock:
+            job_id = str(next(self.job_ids))
+            self.jobs[job_id] = {'id': job_id, 'name': name, 'started': time.time(), 'on_success': on_success, 'done': False}
+        return self.job_status(job_id)
+
+    def job_status(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+            status = 'Running'
+            if time.time() - job['started'] >= self.job_duration:
+                status = 'Succeeded'
+                if not job['done']:
+                    job['done'] = True
+                    if job['on_success']:
+                        job['on_success']()
+        return {'asyncJob': {'id': job_id, 'jobType': job['name'], 'status': status, 'statusMessage': ''}}
+
+    def cluster_status(self):
+        ''' The status of every node, with the service instances of the imported topology '''
+        process_status = 'Active' if self.running else 'Stopped'
+        rollup_status = 'Running' if self.running else 'Stopped'
+        topology = (self.topology or {}).get('nodes', {})
+        nodes = []
+        for node_id in self.nodes:
+            services = []
+            for service, settings in sorted(topology.get(node_id, {}).get('services', {}).items()):
+                instances = [{'instanceId': str(instance.get('instanceId', index)), 'processStatus': process_status}
+                    for index, instance in enumerate(settings.get('instances', []))]
+                services.append({'serviceName': service, 'rollupStatus': rollup_status, 'instances': instances})
+            nodes.append({'nodeId': node_id, 'rollupStatus': rollup_status, 'services': services})
+        return {'clusterStatus': {'rollupStatus': rollup_status, 'nodes': nodes}}
+
+
+class StubControllerHandler(BaseHTTPRequestHandler):
+    ''' Routes requests to the in-memory controller state '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body=None, headers=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def authenticated(self):
+        cookie = self.headers.get('Cookie') or ''
+        return any(part.strip() in self.server.state.sessions for part in cookie.split(';'))
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        state = self.server.state
+        prefix = '/api/' + API_VERSION
+        path = self.path.split('?')[0]
+        body = self.read_body()
+        state.requests.append((method, path))
+        if not path.startswith(prefix):
+            return self.send_json(404, {'error': 'not found'})
+        endpoint = path[len(prefix):]
+
+        if method == 'POST' and endpoint == ENDPOINTS['login']:
+            credentials = (body or {}).get('authentication', {})
+            if credentials.get('name') != state.username or credentials.get('password') != state.password:
+                return self.send_json(401, {'error': 'invalid credentials'})
+            session = '%s=%d' % (AUTH_COOKIE, len(state.sessions) + 1)
+            state.sessions.add(session)
+            return self.send_json(204, headers={'Set-Cookie': session + '; Path=/; Secure; HttpOnly'})
+
+        if not self.authenticated():
+            return self.send_json(401, {'error': 'not logged in'})
+
+        job_match = re.match('^' + ENDPOINTS['async_job'].format('([^/]+)') + '$', endpoint)
+        if method == 'GET' and job_match:
+            if job_match.group(1) not in state.jobs:
+                return self.send_json(404, {'error': 'no such job'})
+            return self.send_json(200, state.job_status(job_match.group(1)))
+
+        route = (method, endpoint)
+        if route == ('POST', ENDPOINTS['logout']):
+            return self.send_json(204)
+        if route == ('GET', ENDPOINTS['nodes']):
+            return self.send_json(200, {'clusterNodes': [{'nodeId': node} for node in state.nodes]})
+        if route == ('GET', ENDPOINTS['bootstrap_file']):
+            return self.send_json(200, {'initialNodeId': state.nodes[0], 'controllerPort': self.server.server_port})
+        if route == ('POST', ENDPOINTS['remove_nodes']):
+            removed = set((body or {}).get('nodeIds', []))
+            def remove():
+                state.nodes = [node for node in state.nodes if node not in removed]
+            return self.send_json(202, state.new_job('removeNodes', remove))
+        if route == ('POST', ENDPOINTS['activate_trial']):
+            state.product_keys.append('trial')
+            return self.send_json(200, {})
+        if route == ('POST', ENDPOINTS['activate_key']):
+            state.product_keys.append((body or {}).get('productKey'))
+            return self.send_json(200, {})
+        if route == ('GET', ENDPOINTS['licenses']):
+            return self.send_json(200, {'productKeys': [{'key': key} for key in state.product_keys]})
+        if route == ('POST', ENDPOINTS['registration']):
+            state.registration = body
+            return self.send_json(200, {})
+        if route == ('POST', ENDPOINTS['settings_import']):
+            if 'topologyVersion' in (body or {}):
+                state.topology = body['topologyVersion']
+            state.settings.update(dict((k, v) for k, v in (body or {}).items() if k != 'topologyVersion'))
+            return self.send_json(200, {})
+        if route == ('POST', ENDPOINTS['apply']):
+            return self.send_json(202, state.new_job('applyPendingChanges'))
+        if route == ('POST', ENDPOINTS['initialize']):
+            def initialize():
+                state.initialized = True
+            return self.send_json(202, state.new_job('initialize', initialize))
+        if route == ('POST', ENDPOINTS['start']):
+            def start():
+                state.running = True
+            return self.send_json(202, state.new_job('start', start))
+        if route == ('POST', ENDPOINTS['stop']):
+            def stop():
+                state.running = False
+            return self.send_json(202, state.new_job('stop', stop))
+        if route == ('GET', ENDPOINTS['status']):
+            return self.send_json(200, state.cluster_status())
+        return self.send_json(404, {'error': 'not found'})
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubController(object):
+    ''' Runs the stub controller on a background thread. Port 0 picks a free port. '''
+
+    def __init__(self, username='admin', password='admin', nodes=('node1',), job_duration=0.0, host='127.0.0.1', port=0):
+        self.state = StubControllerState(username, password, nodes, job_duration)
+        self.server = ThreadingHTTPServer((host, port), StubControllerHandler)
+        self.server.state = self.state
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_port
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the TSM controller REST API')
+    parser.add_argument('--port', type=int, default=8850, help='Port to listen on')
+    parser.add_argument('--username', default='admin', help='Accepted TSM user name')
+    parser.add_argument('--password', default='admin', help='Accepted TSM password')
+    parser.add_argument('--nodes', default='node1', help='Comma separated list of registered node ids')
+    parser.add_argument('--jobDuration', type=float, default=0.0, help='Seconds before an asynchronous job succeeds')
+    args = parser.parse_args()
+
+    controller = StubController(args.username, args.password, args.nodes.split(','), args.jobDuration, port=args.port)
+    print('Stub TSM controller listening on http://127.0.0.1:%d/api/%s' % (controller.port, API_VERSION))
+    try:
+        controller.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())